@@ -0,0 +1,112 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+# BC1 (a.k.a. DXT1, GL_EXT_texture_compression_s3tc) texture compression.
+#
+# Clerk encodes covers once, so clients can upload them to the GPU as-is at
+# an eighth of the size of raw RGB (4 bits per pixel). The encoder is a
+# simple one: per 4x4 block, the darkest and brightest pixels are the
+# endpoints, and every pixel gets the nearest of the four interpolated colors.
+# That is plenty for cover thumbnails, and needs nothing but Python.
+#
+# Blobs are a small header followed by the blocks, in the same top-to-bottom
+# row order as other pixel data.
+
+import struct
+
+
+
+MAGIC = b'BC1\0'
+HEADER = struct.Struct('<4sHHB')
+
+
+
+class Error(Exception):
+	pass
+
+
+
+def rgb565(r, g, b):
+	return ((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3)
+
+
+
+def encode_block(pixels):
+	"""pixels: 16 (r, g, b) tuples, row by row. Returns 8 bytes."""
+	lumas = [r * 2 + g * 4 + b for r, g, b in pixels]
+	hi = pixels[lumas.index(max(lumas))]
+	lo = pixels[lumas.index(min(lumas))]
+	c0, c1 = rgb565(*hi), rgb565(*lo)
+
+	# c0 > c1 selects 4-color mode. Equal endpoints: flat block, all index 0.
+	if c0 == c1:
+		return struct.pack('<HHI', c0, c1, 0)
+	if c0 < c1:
+		c0, c1, hi, lo = c1, c0, lo, hi
+
+	dr, dg, db = hi[0] - lo[0], hi[1] - lo[1], hi[2] - lo[2]
+	length = dr * dr + dg * dg + db * db
+	indices = 0
+	for i, (r, g, b) in enumerate(pixels):
+		# Position between lo (0) and hi (1), rounded to thirds
+		t = ((r - lo[0]) * dr + (g - lo[1]) * dg + (b - lo[2]) * db) * 3 / length if length else 0
+		step = min(max(round(t), 0), 3)
+		# Palette order is c0, c1, 2/3 c0 + 1/3 c1, 1/3 c0 + 2/3 c1
+		indices |= (1, 3, 2, 0)[step] << (i * 2)
+	return struct.pack('<HHI', c0, c1, indices)
+
+
+
+def blocks_size(width, height):
+	return ((width + 3) // 4) * ((height + 3) // 4) * 8
+
+
+
+def encode(pixels, width, height):
+	"""Encode raw RGB bytes. Partial blocks at the right and bottom edges
+	(small mip levels) are padded by repeating the last column and row.
+	"""
+	stride = width * 3
+	columns = [min(x, width - 1) * 3 for x in range(width + 3)]
+	blocks = []
+	for by in range(0, height, 4):
+		for bx in range(0, width, 4):
+			block = []
+			for y in range(by, by + 4):
+				row = min(y, height - 1) * stride
+				for x in columns[bx:bx + 4]:
+					block.append((pixels[row + x], pixels[row + x + 1], pixels[row + x + 2]))
+			blocks.append(encode_block(block))
+	return b''.join(blocks)
+
+
+
+def pack(width, height, levels):
+	"""Blob with header for a list of encoded mip levels, largest first."""
+	return HEADER.pack(MAGIC, width, height, len(levels)) + b''.join(levels)
+
+
+
+def unpack(blob):
+	"""Returns width, height and a list of (width, height, data) mip levels."""
+	try:
+		magic, width, height, count = HEADER.unpack_from(blob)
+	except struct.error as e:
+		raise Error(f'Invalid BC1 header: {e}')
+	if magic != MAGIC:
+		raise Error(f'Invalid BC1 magic {magic}')
+
+	levels = []
+	offset = HEADER.size
+	w, h = width, height
+	for i in range(count):
+		size = blocks_size(w, h)
+		if offset + size > len(blob):
+			raise Error(f'BC1 blob truncated at level {i}')
+		levels.append((w, h, blob[offset:offset + size]))
+		offset += size
+		w, h = max(w // 2, 1), max(h // 2, 1)
+	return width, height, levels
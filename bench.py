@@ -0,0 +1,348 @@
+#! /usr/bin/env python3
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+# Reproducible benchmarks for the folder-open and scan paths.
+# Generates a synthetic library (tiny MKVs with embedded covers, short test
+# pattern videos without, folder covers), times Clerk's scan() and process_state_queue() on it, then
+# the client's folder reading, tile model, cover decoding and text rendering.
+# Results go to stdout (or --output) as JSON, to be compared across commits.
+#
+#   ./bench.py --folders 20 --files 50 --runs 3 > bench-$(git rev-parse --short HEAD).json
+
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import struct
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import statistics
+import subprocess
+
+import PIL.Image
+
+import dbs
+import config
+import loghelper
+
+log = loghelper.get_logger('Bench', loghelper.Color.Magenta)
+
+RESULTS_VERSION = 1
+# Seconds of video in the files without a cover
+VIDEO_DURATION = 4
+
+
+
+#### Minimal Matroska writer; just enough for enzyme (duration, attachments)
+def ebml_element(element_id, payload):
+	"""Element with the given (marker bits included) ID; sizes are always 8 bytes."""
+	return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + b'\x01' + len(payload).to_bytes(7, 'big') + payload
+
+def ebml_uint(element_id, value, length=None):
+	if length is None:
+		length = max((value.bit_length() + 7) // 8, 1)
+	return ebml_element(element_id, value.to_bytes(length, 'big'))
+
+def ebml_float(element_id, value):
+	return ebml_element(element_id, struct.pack('>d', value))
+
+def ebml_string(element_id, value):
+	return ebml_element(element_id, value.encode('utf8'))
+
+
+def mkv(duration, cover=None, uid=1):
+	"""Bytes of a track-less Matroska file of duration seconds, with cover
+	(JPEG bytes) attached as the cover image if given.
+	"""
+	header = ebml_element(0x1A45DFA3,
+		ebml_uint(0x4286, 1) +
+		ebml_uint(0x42F7, 1) +
+		ebml_uint(0x42F2, 4) +
+		ebml_uint(0x42F3, 8) +
+		ebml_string(0x4282, 'matroska') +
+		ebml_uint(0x4287, 4) +
+		ebml_uint(0x4285, 2))
+
+	elements = [(0x1549A966, ebml_element(0x1549A966,
+		ebml_uint(0x2AD7B1, 1000000) +
+		ebml_float(0x4489, duration * 1000) +
+		ebml_string(0x4D80, 'fabella-bench') +
+		ebml_string(0x5741, 'fabella-bench')))]
+	if cover is not None:
+		elements.append((0x1941A469, ebml_element(0x1941A469, ebml_element(0x61A7,
+			ebml_string(0x466E, 'cover.jpg') +
+			ebml_string(0x4660, 'image/jpeg') +
+			ebml_element(0x465C, cover) +
+			ebml_uint(0x46AE, uid, 8)))))
+
+	def seek_head(positions):
+		return ebml_element(0x114D9B74, b''.join(
+			ebml_element(0x4DBB, ebml_element(0x53AB, element_id.to_bytes(4, 'big')) + ebml_uint(0x53AC, position, 8))
+			for (element_id, _), position in zip(elements, positions)))
+
+	# Fixed-size positions, so the seek head is as long as its placeholder
+	offset = len(seek_head([0] * len(elements)))
+	positions = []
+	for _, data in elements:
+		positions.append(offset)
+		offset += len(data)
+
+	return header + ebml_element(0x18538067, seek_head(positions) + b''.join(data for _, data in elements))
+
+
+def video(duration):
+	"""Bytes of a Matroska file with duration seconds of ffmpeg's test
+	pattern, for Clerk to thumbnail; None if there is no ffmpeg.
+	"""
+	if shutil.which('ffmpeg') is None:
+		return None
+	sp = subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'testsrc=duration={duration}:size=640x360:rate=10', '-f', 'matroska', '-'], capture_output=True, check=True)
+	return sp.stdout
+
+
+def jpeg(width, height, rng):
+	"""Bytes of a noisy, single-hued JPEG; noisy so it compresses like a picture."""
+	color = tuple(rng.randrange(256) for i in range(3))
+	solid = PIL.Image.new('RGB', (width, height), color)
+	noise = PIL.Image.effect_noise((width, height), 64).convert('RGB')
+	buffer = io.BytesIO()
+	PIL.Image.blend(solid, noise, 0.3).save(buffer, format='JPEG', quality=85)
+	return buffer.getvalue()
+
+
+
+def generate(root, folders, files, covers, seed=0):
+	"""Fill root with folders subfolders of files MKVs each; a fraction covers
+	of the MKVs get an embedded cover, the rest are a short test pattern video
+	for Clerk to thumbnail. Every folder gets a folder cover. Deterministic
+	for a seed.
+	"""
+	log.info(f'Generating {folders} folders of {files} files in {root}')
+	rng = random.Random(seed)
+	uid = 1
+	# The same one for all of them; ffmpeg is slow enough as it is
+	thumbnail_source = video(VIDEO_DURATION)
+	if thumbnail_source is None:
+		log.warning('No ffmpeg: files without a cover have no video either, so Clerk fails to thumbnail them and clerk.scan.cold is not representative')
+	for f in range(folders):
+		path = os.path.join(root, f'Series {f:04d}')
+		os.makedirs(path, exist_ok=True)
+		with open(os.path.join(path, '.cover.jpg'), 'wb') as fd:
+			fd.write(jpeg(640, 400, rng))
+
+		for i in range(files):
+			cover = jpeg(640, 400, rng) if rng.random() < covers else None
+			with open(os.path.join(path, f'Episode {i:04d} - {uuid.UUID(int=rng.getrandbits(128)).hex[:8]}.mkv'), 'wb') as fd:
+				duration = rng.uniform(600, 3600)
+				if cover is None and thumbnail_source is not None:
+					fd.write(thumbnail_source)
+				else:
+					fd.write(mkv(duration, cover, uid))
+			uid += 1
+
+
+def library_folders(root):
+	"""All folders of the library, deepest first, so a scan of root sees the
+	covers of its subfolders.
+	"""
+	folders = sorted(entry.path for entry in os.scandir(root) if entry.is_dir() and not entry.name.startswith('.'))
+	return folders + [root]
+
+
+def index_names(index):
+	return index.names() if isinstance(index, dbs.BinaryIndex) else [entry['name'] for entry in index]
+
+
+def remove_dbs(root):
+	for path in library_folders(root):
+		shutil.rmtree(os.path.join(path, os.path.dirname(dbs.INDEX_DB_NAME)), ignore_errors=True)
+
+
+
+#### Timing
+def measure(results, name, func, runs, setup=None):
+	"""Time func() runs times, calling setup() untimed before every run."""
+	times = []
+	for run in range(runs):
+		if setup:
+			setup()
+		start = time.perf_counter()
+		func()
+		times.append(time.perf_counter() - start)
+	results[name] = {
+		'runs': runs,
+		'min': min(times),
+		'median': statistics.median(times),
+		'max': max(times),
+	}
+	log.info(f'{name}: median {statistics.median(times) * 1000:.1f}ms over {runs} runs')
+
+
+
+def bench_clerk(root, runs, results):
+	import clerk
+	from worker import Pool
+
+	folders = library_folders(root)
+	pool = Pool('analyze', threads=4, maxsize=64)
+
+	def scan_all():
+		for path in folders:
+			clerk.scan(path, pool=pool)
+
+	measure(results, 'clerk.scan.cold', scan_all, runs, setup=lambda: remove_dbs(root))
+	measure(results, 'clerk.scan.warm', scan_all, runs)
+
+	# Like a client does: some positions and tags per folder, in a few queue files
+	rng = random.Random(1)
+	def queue_updates():
+		for path in folders[:-1]:
+			names = [entry['name'] for entry in dbs.json_read(os.path.join(path, dbs.INDEX_DB_NAME), dbs.INDEX_DB_SCHEMA)['files']]
+			for i in range(4):
+				updates = {name: {'position': rng.random(), 'tagged': rng.random() < 0.1} for name in rng.sample(names, min(len(names), 8))}
+				dbs.json_write(os.path.join(path, dbs.QUEUE_DIR_NAME, str(uuid.uuid4())), updates)
+
+	def process_all():
+		for path in folders:
+			clerk.process_state_queue(path, [root])
+
+	measure(results, 'clerk.process_state_queue', process_all, runs, setup=queue_updates)
+
+
+
+def bench_client(root, runs, results):
+	"""The client's folder-open path, minus GL: everything up to the point
+	where textures are staged for upload.
+	"""
+	import zipfile
+	import font
+	from menu import Menu
+	from tile import Tile, TileModel
+	from image import Image
+	from upload import Uploader
+	from worker import Pool
+
+	folders = library_folders(root)
+	pool = Pool('render', threads=3)
+
+	measure(results, 'client.read_folder', lambda: [Menu.read_folder(path, config.prefetch.covers) for path in folders], runs)
+
+	read = [Menu.read_folder(path) for path in folders]
+	measure(results, 'client.tile_model', lambda: [TileModel.from_index(f.path, f.index, f.state, None, None) for f in read], runs)
+
+	def decode_covers():
+		images = []
+		for folder in read:
+			with zipfile.ZipFile(folder.cover_db_name, 'r') as fd:
+				size = Menu.cover_size(fd)
+				for name in index_names(folder.index):
+					cover = Tile.read_cover(fd, name, size)
+					if cover and cover[3]:
+						mode, width, height, data = cover
+						image = Image(None, width, height, name, pool=pool, mode=mode, mipmap=True)
+						image.source = data
+						images.append(image)
+		pool.join()
+		Uploader.staged.clear()
+
+	measure(results, 'client.decode_covers', decode_covers, runs)
+
+	tile_font = font.Font(config.tile.text_font, config.tile.text_size)
+	def clear_render_cache():
+		with font.render_cache.lock:
+			font.render_cache.entries.clear()
+			font.render_cache.bytes = 0
+
+	def render_titles():
+		for f in read:
+			for name in index_names(f.index):
+				tile_font.text(name, config.tile.width, config.tile.text_lines, pool=pool)
+		pool.join()
+		Uploader.staged.clear()
+
+	measure(results, 'client.render_titles', render_titles, runs, setup=clear_render_cache)
+
+
+
+def git_commit():
+	try:
+		sp = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+		return sp.stdout.decode('ascii').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark Clerk and the client on a synthetic library.')
+	parser.add_argument('--library', help='library to (re)use; generated in a temporary directory if not given')
+	parser.add_argument('--folders', type=int, default=10, help='number of folders to generate')
+	parser.add_argument('--files', type=int, default=50, help='number of files per folder')
+	parser.add_argument('--covers', type=float, default=0.5, help='fraction of files with an embedded cover')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--runs', type=int, default=3, help='runs per benchmark')
+	parser.add_argument('--skip', action='append', default=[], choices=['clerk', 'client'], help='skip a group of benchmarks')
+	parser.add_argument('--output', help='write results here instead of stdout')
+	args = parser.parse_args()
+
+	# Per-file messages would drown out the results
+	loghelper.set_up_logging(20, 0, levels={name: 'warning' for name in ['Clerk', 'DBs', 'Menu', 'Tile', 'Font', 'Image', 'Upload', 'Worker']})
+
+	temporary = None
+	root = args.library
+	if root is None:
+		root = temporary = tempfile.mkdtemp(prefix='fabella-bench-')
+	root = os.path.abspath(root)
+	if not library_folders(root)[:-1]:
+		generate(root, args.folders, args.files, args.covers, args.seed)
+	folders = len(library_folders(root)) - 1
+
+	results = {}
+	try:
+		if 'clerk' not in args.skip:
+			bench_clerk(root, args.runs, results)
+		if 'client' not in args.skip:
+			if not os.path.isfile(os.path.join(root, dbs.INDEX_DB_NAME)):
+				log.error('Library has not been scanned; the client benchmarks need Clerk\'s DBs')
+			else:
+				bench_client(root, args.runs, results)
+	finally:
+		if temporary:
+			shutil.rmtree(temporary, ignore_errors=True)
+
+	report = {
+		'version': RESULTS_VERSION,
+		'commit': git_commit(),
+		'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		'python': platform.python_version(),
+		'machine': platform.machine(),
+		'cpus': os.cpu_count(),
+		'library': {
+			'folders': folders,
+			'files': args.files,
+			'covers': args.covers,
+			'seed': args.seed,
+		},
+		'results': results,
+	}
+	if args.output:
+		with open(args.output, 'w') as fd:
+			json.dump(report, fd, indent=4)
+	else:
+		json.dump(report, sys.stdout, indent=4)
+		print()
+
+
+
+if __name__ == '__main__':
+	main()
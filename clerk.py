@@ -5,14 +5,27 @@
 # Licensed under GPL v2.0, or (at your option) any later version.
 # (SPDX GPL-2.0-or-later) See LICENSE file for details.
 
-COVER_META_TAG = '.meta'
-COVER_WIDTH = 320
-COVER_HEIGHT = 200
+# Covers are stored in all these sizes, so clients never have to resample them.
+# Must include dbs.COVER_DEFAULT_SIZE.
+COVER_SIZES = [(160, 100), (320, 200), (640, 400)]
+# Also store covers BC1-compressed, with mipmaps, for clients to upload as-is.
+# Only in dbs.COVER_DEFAULT_SIZE, the size tiles are drawn at: the encoder is
+# pure Python, and other sizes are rare enough for the client to upload JPEGs.
+COVER_COMPRESSED = True
+# Also write the index and cover DBs of a folder into one file, which clients read with one open
+BUNDLE = True
 
 THUMB_VIDEO_POSITION = 0.25
 FOLDER_COVER_FILE = '.cover.jpg'
 MKV_COVER_FILE = 'cover.jpg'
 EVENT_COOLDOWN_SECONDS = 0.5
+# Seconds between logging worker pool stats (0 disables), and a UNIX socket serving them (None disables)
+STATS_INTERVAL = 60
+STATS_SOCKET = None
+# Level of clerk.log; 10 to also write debug messages, which costs time on every hot path
+LOG_FILE_LEVEL = 15
+# {logger name: level} to silence chatty loggers; messages below level aren't even formatted
+LOG_LEVELS = {'Worker': 'info'}
 
 
 
@@ -32,17 +45,20 @@ import subprocess
 import PIL.Image
 import PIL.ImageOps
 
+import bc1
 import loghelper
 import colorpicker
 from watch import Watcher
+import worker
 from worker import Pool
 import dbs
 
-loghelper.set_up_logging(15, 0, 'clerk.log')
 log = loghelper.get_logger('Clerk', loghelper.Color.Red)
 # Enzyme spams the logs with stuff we don't care about
 logging.getLogger('enzyme').setLevel(logging.CRITICAL)
-log.info('Starting Clerk.')
+
+# {size: formats} of the covers in the cover DB
+COVER_VARIANTS = {size: ['jpeg', 'bc1'] if COVER_COMPRESSED and size == dbs.COVER_DEFAULT_SIZE else ['jpeg'] for size in COVER_SIZES}
 
 
 
@@ -79,25 +95,63 @@ class BaseTile:
 
 
 	def scale_encode(self, fd):
-		"""Takes file-like object, reads image from it, scales, encodes to JPEG, returns bytes."""
+		"""Takes file-like object, reads image from it, returns all cover variants
+		as {(width, height, format): bytes}.
+		"""
 		try:
-			with PIL.Image.open(fd) as cover:
-				cover = cover.convert('RGB')
-				cover = PIL.ImageOps.fit(cover, (COVER_WIDTH, COVER_HEIGHT))
+			with PIL.Image.open(fd) as image:
+				image = image.convert('RGB')
 		except PIL.UnidentifiedImageError as e:
 			raise TileError(f'Loading image for {self.path}: {str(e)}')
 
 		# Choose a representative color from the cover image
 		# Don't like setting this from here, but we need it later anyway.
+		cover = PIL.ImageOps.fit(image, dbs.COVER_DEFAULT_SIZE)
 		self.tile_color = '#' + ''.join(f'{c:02x}' for c in colorpicker.pick(cover))
 
-		buffer = io.BytesIO()
-		cover.save(buffer, format='JPEG', quality=90, subsampling=0, optimize=True)
-		return buffer.getvalue()
+		return self.encode_variants(image, COVER_VARIANTS)
+
+
+	@staticmethod
+	def encode_variants(image, variants):
+		"""Takes PIL image, returns {(width, height, format): bytes} for variants {(width, height): formats}."""
+		covers = {}
+		for (width, height), formats in variants.items():
+			cover = PIL.ImageOps.fit(image, (width, height))
+
+			if 'jpeg' in formats:
+				buffer = io.BytesIO()
+				cover.save(buffer, format='JPEG', quality=90, subsampling=0, optimize=True)
+				covers[width, height, 'jpeg'] = buffer.getvalue()
+
+			if 'bc1' in formats:
+				# Full mip chain, so clients get mipmaps without resampling anything
+				levels = []
+				level = cover
+				while True:
+					levels.append(bc1.encode(level.tobytes(), level.width, level.height))
+					if level.width == 1 and level.height == 1:
+						break
+					level = level.resize((max(level.width // 2, 1), max(level.height // 2, 1)), PIL.Image.BOX)
+				covers[width, height, 'bc1'] = bc1.pack(width, height, levels)
+		return covers
+
+
+	def missing_variants(self):
+		"""Returns {(width, height): [formats]} of variants the cover DB lacks for this tile."""
+		if not self.covers:
+			# No cover at all
+			return {}
+		missing = {}
+		for (width, height), formats in COVER_VARIANTS.items():
+			formats = [fmt for fmt in formats if (width, height, fmt) not in self.covers]
+			if formats:
+				missing[width, height] = formats
+		return missing
 
 
 	def get_folder_cover(self):
-		"""Find cover image for folder, scale, return bytes."""
+		"""Find cover image for folder, return its variants."""
 		cover_file = os.path.join(self.full_path, FOLDER_COVER_FILE)
 		if not os.path.isfile(cover_file):
 			raise TileError(f'Cover image {cover_file} not found')
@@ -108,7 +162,7 @@ class BaseTile:
 
 
 	def get_file_cover(self):
-		"""Find cover image for file, scale, return bytes."""
+		"""Find cover image for file, return its variants."""
 		# FIXME: Hmm. Not sure; image files are ignored earlier in the process anyway.
 		if self.name.endswith(('.jpg', '.png')):
 			log.info(f'Using image file as its own cover: {self.full_path}')
@@ -159,21 +213,40 @@ class BaseTile:
 				return float(sp.stdout)
 			except (subprocess.CalledProcessError, ValueError) as e:
 				log.error(f'Getting video duration for {self.name}: {e}')
-				return none
+				return None
+
+
+	def update_covers(self):
+		try:
+			if self.isdir:
+				self.covers = self.get_folder_cover()
+			else:
+				self.covers = self.get_file_cover()
+		except TileError as e:
+			log.error(str(e))
+			self.covers = {}
 
 
 	def analyze(self):
 		if self.cover_needs_update:
-			try:
-				if self.isdir:
-					self.cover_image = self.get_folder_cover()
-				else:
-					self.cover_image = self.get_file_cover()
-			except TileError as e:
-				log.error(str(e))
-				self.cover_image = None
+			self.update_covers()
 			self.cover_needs_update = False
 
+		# Cover from an older DB, or COVER_SIZES/COVER_VARIANTS changed
+		missing = self.missing_variants()
+		if missing:
+			# Derive them from the largest stored JPEG if that is large enough,
+			# otherwise go back to the source.
+			largest = max(((w, h) for w, h, fmt in self.covers if fmt == 'jpeg'), default=(0, 0))
+			if all(w <= largest[0] and h <= largest[1] for w, h in missing):
+				log.info(f'Adding cover variants {missing} for {self.full_path}')
+				with PIL.Image.open(io.BytesIO(self.covers[largest[0], largest[1], 'jpeg'])) as image:
+					image = image.convert('RGB')
+				self.covers.update(self.encode_variants(image, missing))
+			else:
+				log.info(f'Regenerating covers for {self.full_path}, missing {missing}')
+				self.update_covers()
+
 		# Maybe duration was set from getting the cover, maybe not.
 		if self.duration is None and not self.isdir and self.name.endswith(dbs.VIDEO_EXTENSIONS):
 			try:
@@ -229,7 +302,7 @@ class IndexedTile(BaseTile):
 
 		self.path = path
 		self.full_path = os.path.join(path, self.name)
-		self.cover_image = None
+		self.covers = {}
 		self.cover_needs_update = True
 
 
@@ -237,13 +310,13 @@ class IndexedTile(BaseTile):
 class RealTile(BaseTile):
 	def __init__(self, parent_path, name):
 		self.name = name
-		self.path = path
-		self.full_path = os.path.join(path, name)
+		self.path = parent_path
+		self.full_path = os.path.join(parent_path, name)
 
 		# Not yet determined
 		self.duration = None
 		self.tile_color = None
-		self.cover_image = None
+		self.covers = {}
 		self.cover_needs_update = True
 
 		# Get file attrs
@@ -358,23 +431,30 @@ def scan(path, pool):
 	#### Covers DB
 	cover_db_name = os.path.join(path, dbs.COVER_DB_NAME)
 	cover_db_fingerprint = None
+	cover_db_variants = None
 	try:
 		with zipfile.ZipFile(cover_db_name, 'r') as fd:
 			log.debug(f'Found existing covers DB {cover_db_name}')
-			cover_meta = json.loads(fd.read(COVER_META_TAG))
+			cover_meta = json.loads(fd.read(dbs.COVER_META_TAG))
 			if cover_meta['version'] != dbs.INDEX_META_VERSION:
-				log.info(f'Existing {covers.db_name} outdated version, discarding')
-			elif cover_meta['dimensions'] != f'{COVER_WIDTH}x{COVER_HEIGHT}':
-				log.info(f'Existing {covers.db_name} has wrong cover dimensions, discarding')
+				log.info(f'Existing {cover_db_name} outdated version, discarding')
 			elif cover_meta['fingerprint'] != Meta.fingerprint(indexed_tiles):
 				log.warning(f'Existing {cover_db_name} fingerprint doesn\'t match {index_db_name}, discarding')
 			else:
+				# Variants in sizes we no longer make are dropped; missing ones are added by analyze()
+				names = set(fd.namelist())
 				for tile in indexed_tiles:
-					tile.cover_image = fd.read(tile.name)
-					if tile.cover_image == b'':
-						tile.cover_image = None
+					tile.covers = {}
+					# The default entry is empty if no cover is known
+					if fd.getinfo(tile.name).file_size:
+						for (width, height), formats in COVER_VARIANTS.items():
+							for fmt in formats:
+								entry = dbs.cover_entry(tile.name, (width, height), fmt)
+								if entry in names:
+									tile.covers[width, height, fmt] = fd.read(entry)
 					tile.cover_needs_update = False
 				cover_db_fingerprint = cover_meta['fingerprint']
+				cover_db_variants = (cover_meta.get('sizes'), cover_meta.get('formats'))
 	except FileNotFoundError:
 		log.info(f'Cover DB {cover_db_name} missing')
 	except (OSError, zipfile.BadZipFile, json.JSONDecodeError, KeyError, TypeError) as e:
@@ -414,39 +494,61 @@ def scan(path, pool):
 	for i in range(len(real_tiles)):
 		name = real_tiles[i].name
 		if real_tiles[i] == indexed_tiles.get(name):
-			log.debug(f'Tile for {name} is up to date, reusing')
+			log.debug('Tile for %s is up to date, reusing', name)
 			real_tiles[i] = indexed_tiles[name]
 		else:
-			log.debug(f'Tile for {name} is stale, re-inspecting')
+			log.debug('Tile for %s is stale, re-inspecting', name)
 
 	#### Update covers/tile_color/duration etc; this is the expensive part
 	for tile in real_tiles:
 		pool.schedule(tile.analyze)
 	pool.join()
 
+	#### Compare covers
+	real_fingerprint = Meta.fingerprint(real_tiles)
+	real_variants = ([f'{w}x{h}' for w, h in COVER_SIZES], {f'{w}x{h}': formats for (w, h), formats in COVER_VARIANTS.items()})
+	covers_need_update = cover_db_fingerprint != real_fingerprint or cover_db_variants != real_variants
+
+	#### Remove the bundle before changing what it copies
+	# Clients use a bundle without looking at the separate DBs, so it must not
+	# outlive them; if writing the new one fails, they fall back to those.
+	bundle_name = os.path.join(path, dbs.BUNDLE_NAME)
+	if (index_needs_update or covers_need_update or not BUNDLE) and os.path.isfile(bundle_name):
+		log.info(f'Removing {bundle_name}')
+		os.remove(bundle_name)
+
 	#### Write index
+	index_bin_name = os.path.join(path, dbs.INDEX_BIN_NAME)
 	if index_needs_update:
 		dbs.json_write(index_db_name, Meta.full_json(real_tiles))
+	if index_needs_update or dbs.BinaryIndex.read_source(index_bin_name) != dbs.source_stamp(dbs.stamp(index_db_name)):
+		dbs.binary_index_write(index_bin_name, [tile.to_json() for tile in real_tiles], index_db_name)
 
 	#### Write covers
 	# FIXME: error checking
-	real_fingerprint = Meta.fingerprint(real_tiles)
-	if cover_db_fingerprint == real_fingerprint:
+	if not covers_need_update:
 		log.info(f'Existing cover DB {cover_db_name} is up to date, skipping')
 	else:
 		if real_tiles:
 			log.info(f'Writing new cover DB {cover_db_name}')
 			with zipfile.ZipFile(cover_db_name + dbs.NEW_SUFFIX, 'w') as fd:
+				sizes, formats = real_variants
 				meta = {
 					'version': dbs.INDEX_META_VERSION,
-					'dimensions': f'{COVER_WIDTH}x{COVER_HEIGHT}',
+					'dimensions': '{}x{}'.format(*dbs.COVER_DEFAULT_SIZE),
+					'sizes': sizes,
+					'formats': formats,
 					'fingerprint': real_fingerprint,
 				}
-				fd.writestr(COVER_META_TAG, json.dumps(meta, indent=4))
+				fd.writestr(dbs.COVER_META_TAG, json.dumps(meta, indent=4))
 
-				# Write cover images
+				# Write cover images; the default entry exists for every tile, empty if there's no cover
 				for tile in real_tiles:
-					fd.writestr(tile.name, tile.cover_image or b'')
+					fd.writestr(tile.name, tile.covers.get((*dbs.COVER_DEFAULT_SIZE, 'jpeg'), b''))
+					for (width, height, fmt), data in tile.covers.items():
+						entry = dbs.cover_entry(tile.name, (width, height), fmt)
+						if entry != tile.name:
+							fd.writestr(entry, data)
 			with open(cover_db_name + dbs.NEW_SUFFIX) as fd:
 				os.fdatasync(fd)
 			os.rename(cover_db_name + dbs.NEW_SUFFIX, cover_db_name)
@@ -457,6 +559,29 @@ def scan(path, pool):
 			else:
 				log.debug(f'No files here, not writing {cover_db_name}')
 
+	#### Write bundle
+	if BUNDLE and (index_needs_update or covers_need_update or not bundle_current(path)):
+		write_bundle(path)
+
+
+
+def bundle_current(path):
+	"""Whether the bundle of path was written from its current index and cover DBs."""
+	bundle_name = os.path.join(path, dbs.BUNDLE_NAME)
+	try:
+		with open(bundle_name, 'rb') as fd:
+			bundle = dbs.Bundle(fd, bundle_name)
+	except (OSError, dbs.BundleError):
+		return False
+	return all(dbs.stamp(os.path.join(path, db_name)) == stamp for db_name, stamp in bundle.sources.items())
+
+
+def write_bundle(path):
+	"""Copy the index and cover DBs of path into its bundle."""
+	index_db_name = os.path.join(path, dbs.INDEX_DB_NAME)
+	index = dbs.json_read(index_db_name, dbs.INDEX_DB_SCHEMA, default={'files': []})
+	dbs.bundle_write(os.path.join(path, dbs.BUNDLE_NAME), index['files'], index_db_name, os.path.join(path, dbs.COVER_DB_NAME))
+
 
 
 def process_state_queue(path, roots):
@@ -501,7 +626,7 @@ def process_state_queue(path, roots):
 
 	for meta, updates in sorted(state_queue.items()):
 		for name, update in updates.items():
-			log.debug(f'State update for {name}: {update}')
+			log.debug('State update for %s: %s', name, update)
 
 			if name not in state:
 				state[name] = {}
@@ -550,80 +675,95 @@ def process_state_queue(path, roots):
 
 	for update_mtime, update_name in state_queue.keys():
 		try:
-			log.debug(f'Removing {update_name}')
+			log.debug('Removing %s', update_name)
 			os.unlink(update_name)
 		except OSError as e:
 			log.error(f'Removing {update_name}: {str(e)}')
 
 
 
-roots = [os.path.abspath(root) for root in sys.argv[1:]]
-if not roots:
-	print('Must specify at least one root')
-	exit(1)
-watcher = Watcher(roots)
-for root in roots:
-	watcher.push(root, recursive=True)
+def main():
+	loghelper.set_up_logging(15, LOG_FILE_LEVEL, 'clerk.log', LOG_LEVELS)
+	log.info('Starting Clerk.')
+	worker.start_reporter(STATS_INTERVAL, STATS_SOCKET)
 
-analyze_pool = Pool('analyze', threads=4)
-scan_dirty = {}
-state_dirty = {}
-for event in watcher.events(timeout=1):
-	if event:
-		log.debug(f'Got event: {event}')
+	roots = [os.path.abspath(root) for root in sys.argv[1:]]
+	if not roots:
+		print('Must specify at least one root')
+		exit(1)
+	watcher = Watcher(roots)
+	for root in roots:
+		watcher.push(root, recursive=True)
 
-	now = time.time()
+	# Bounded, so scanning a huge folder doesn't queue up every tile at once
+	analyze_pool = Pool('analyze', threads=4, maxsize=64)
+	scan_dirty = {}
+	state_dirty = {}
+	for event in watcher.events(timeout=1):
+		if event:
+			log.debug('Got event: %s', event)
 
-	if event:
-		if event.isdir and not event.hidden():
-			# Case: path/ itself
-			if event.evtype in {'modified'}:
-				scan_dirty[event.path] = now
+		now = time.time()
 
-			# Case: path/foo/
-			if event.evtype in {'created', 'deleted'}:
-				watcher.push(os.path.dirname(event.path))
+		if event:
+			if event.isdir and not event.hidden():
+				# Case: path/ itself
+				if event.evtype in {'modified'}:
+					scan_dirty[event.path] = now
 
-		if not event.isdir:
-			# Case: path/.fabella/queue/foo
-			if os.path.dirname(event.path).endswith('/' + dbs.QUEUE_DIR_NAME):
-				if not event.path.endswith(dbs.NEW_SUFFIX):
-					state_dirty[os.path.dirname(os.path.dirname(os.path.dirname(event.path)))] = now
+				# Case: path/foo/
+				if event.evtype in {'created', 'deleted'}:
+					watcher.push(os.path.dirname(event.path))
 
-			# Case: path/.fabella/state.json.gz
-			elif event.path.endswith('/' + dbs.STATE_DB_NAME):
-				state_dirty[os.path.dirname(os.path.dirname(event.path))] = now
+			if not event.isdir:
+				# Case: path/.fabella/queue/foo
+				if os.path.dirname(event.path).endswith('/' + dbs.QUEUE_DIR_NAME):
+					if not event.path.endswith(dbs.NEW_SUFFIX):
+						state_dirty[os.path.dirname(os.path.dirname(os.path.dirname(event.path)))] = now
 
-			# Case: path/.fabella/index.json.gz
-			elif event.path.endswith('/' + dbs.INDEX_DB_NAME):
-				watcher.push(os.path.dirname(os.path.dirname(event.path)))
+				# Case: path/.fabella/state.json.gz
+				elif event.path.endswith('/' + dbs.STATE_DB_NAME):
+					state_dirty[os.path.dirname(os.path.dirname(event.path))] = now
 
-			# Case: path/.fabella/covers.zip
-			elif event.path.endswith('/' + dbs.COVER_DB_NAME):
-				watcher.push(os.path.dirname(os.path.dirname(event.path)))
+				# Case: path/.fabella/index.json.gz
+				elif event.path.endswith('/' + dbs.INDEX_DB_NAME):
+					watcher.push(os.path.dirname(os.path.dirname(event.path)))
+
+				# Case: path/.fabella/index.bin, path/.fabella/bundle.bin
+				elif event.path.endswith(('/' + dbs.INDEX_BIN_NAME, '/' + dbs.BUNDLE_NAME)):
+					watcher.push(os.path.dirname(os.path.dirname(event.path)))
+
+				# Case: path/.fabella/covers.zip
+				elif event.path.endswith('/' + dbs.COVER_DB_NAME):
+					watcher.push(os.path.dirname(os.path.dirname(event.path)))
+
+				# Case: path/.cover.jpg
+				elif event.path.endswith('/' + FOLDER_COVER_FILE):
+					watcher.push(os.path.dirname(os.path.dirname(event.path)))
+
+				# Case: path/foo.bar
+				else:
+					# Only do something for file extensions we care about
+					if event.path.endswith(dbs.VIDEO_EXTENSIONS):
+						watcher.push(os.path.dirname(event.path))
+
+		# Full scan
+		for path, age in list(scan_dirty.items()):
+			if now - age > EVENT_COOLDOWN_SECONDS:
+				del scan_dirty[path]
+				scan(path, pool=analyze_pool)
+				state_dirty[path] = now
+
+		# Process state
+		for path, age in list(state_dirty.items()):
+			if now - age > EVENT_COOLDOWN_SECONDS:
+				del state_dirty[path]
+				process_state_queue(path, roots)
+
+		#if not dirty:
+		#	break
 
-			# Case: path/.cover.jpg
-			elif event.path.endswith('/' + FOLDER_COVER_FILE):
-				watcher.push(os.path.dirname(os.path.dirname(event.path)))
 
-			# Case: path/foo.bar
-			else:
-				# Only do something for file extensions we care about
-				if event.path.endswith(dbs.VIDEO_EXTENSIONS):
-					watcher.push(os.path.dirname(event.path))
 
-	# Full scan
-	for path, age in list(scan_dirty.items()):
-		if now - age > EVENT_COOLDOWN_SECONDS:
-			del scan_dirty[path]
-			scan(path, pool=analyze_pool)
-			state_dirty[path] = now
-
-	# Process state
-	for path, age in list(state_dirty.items()):
-		if now - age > EVENT_COOLDOWN_SECONDS:
-			del state_dirty[path]
-			process_state_queue(path, roots)
-
-	#if not dirty:
-	#	break
+if __name__ == '__main__':
+	main()
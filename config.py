@@ -22,10 +22,22 @@ class tile:
 
 	thumb_dirs = ['covers']
 	thumb_files = ['cover.jpg']
+	# Use the BC1-compressed covers from Clerk, if the GPU supports them
+	compressed_covers = True
 
 	shadow_color = (0, 0, 0, 1)
 	highlight_color = (0.4, 0.7, 1, 1)
 
+	# Decorations, baked into a texture pack cached in cache.path
+	shadow_blursize = 32
+	shadow_expand = 4
+	shadow_offset = 8
+	highlight_blursize = 19
+	highlight_expand = 10
+	emblem_size = 48
+	# Emblem drop shadow: (blur radius, blur count)
+	emblem_shadow = (2, 12)
+
 	text_color = (0.6, 0.6, 0.6, 1)
 	text_hl_color = (1, 1, 1, 1)
 
@@ -35,3 +47,63 @@ class menu:
 	text_size = 36
 	header_hspace = 64
 	header_vspace = 32
+
+	# Duration of scroll and selection animations, in seconds; 0 disables them
+	animation_time = 0.15
+	# Seconds between checks of the folder DBs for changes by Clerk or other clients
+	refresh_interval = 2
+
+class font:
+	# Draw single-line labels (clock, durations, breadcrumbs) from a glyph atlas
+	# instead of rendering them with Pango; needs no rasterization per change.
+	glyph_atlas = True
+
+class prefetch:
+	# Read the selected folder, its neighbours and the parent in the background
+	enabled = True
+	# Folders to keep in memory, and covers to read ahead for each of them
+	folders = 8
+	covers = 24
+
+class journal:
+	# Seconds to collect state updates before writing them out together
+	delay = 1.0
+
+class stats:
+	# Seconds between logging worker pool stats (0 disables), and a UNIX
+	# socket serving them as JSON (None disables)
+	interval = 60
+	socket = None
+
+class cache:
+	path = '~/.cache/fabella'
+
+class profiler:
+	# Frames kept for the HUD graph (F12) and the percentiles logged on exit
+	frames = 600
+	hud = False
+
+class logging:
+	# Level of fabella.log; 10 to also write debug messages, at a cost on every hot path
+	file_level = 15
+	# {logger name: level}; messages below level aren't even formatted.
+	# The per-job and per-redraw debug messages are the chattiest.
+	levels = {
+		'Worker': 'info',
+		'Redraw': 'info',
+	}
+
+class headless:
+	# fabella.py --headless: offscreen size, and how long nothing must be
+	# redrawn before the next scripted key is pressed
+	width = 1920
+	height = 1080
+	settle = 0.25
+
+class upload:
+	# Per-frame budget for texture uploads; the rest waits for the next frame
+	budget_ms = 4
+	budget_bytes = 4 * 1024 * 1024
+	# Persistently mapped PBO ring the render workers copy pixels into; 0 disables
+	pbo_slots = 32
+	pbo_slot_size = 512 * 1024
@@ -9,7 +9,36 @@
 INDEX_DB_NAME = '.fabella/index.json.gz'
 INDEX_META_VERSION = 1
 
+# Binary copy of the index, for clients; see BinaryIndex
+INDEX_BIN_NAME = '.fabella/index.bin'
+INDEX_BIN_MAGIC = b'FBIX'
+INDEX_BIN_VERSION = 3
+# Magic, format version, index meta version, entry count, string table offset,
+# crc32 of the records and of the string table, mtime (whole seconds) and size
+# of the index DB it was made from
+INDEX_BIN_HEADER_FORMAT = '<4sHHIIIIQQ'
+# Name offset and length in the string table, isdir, flags, tile color (0xrrggbb), duration, src_size, src_mtime
+INDEX_BIN_RECORD_FORMAT = '<IHBBiiqq'
+INDEX_BIN_HAS_COLOR = 1
+INDEX_BIN_HAS_DURATION = 2
+
+# Optional single-file copy of the index (binary) and cover DBs; see Bundle.
+# State changes far more often than these, so it stays in its own DB.
+BUNDLE_NAME = '.fabella/bundle.bin'
+BUNDLE_MAGIC = b'FBBN'
+BUNDLE_VERSION = 2
+# Magic, version, (offset, length) of the index and cover sections, mtime and
+# size of the index DB and mtime of the cover DB they were copied from (the
+# cover section's length being its size), crc32 of the index section.
+# The cover section (a zip) comes last, so the bundle itself can be opened as a zip.
+BUNDLE_HEADER_FORMAT = '<4sHxxQQQQQQQI'
+
 COVER_DB_NAME = '.fabella/covers.zip'
+COVER_META_TAG = '.meta'
+# Covers of this size are stored under the plain file name, for older clients.
+# Other sizes, and GPU-compressed variants, live in the same zip under a prefix.
+COVER_DEFAULT_SIZE = (320, 200)
+COVER_BC1_PREFIX = '.bc1/'
 
 STATE_DB_NAME = '.fabella/state.json.gz'
 QUEUE_DIR_NAME = '.fabella/queue'
@@ -45,6 +74,9 @@ import os
 import gzip
 import zlib
 import json
+import mmap
+import shutil
+import struct
 
 import loghelper
 
@@ -52,6 +84,48 @@ log = loghelper.get_logger('DBs', loghelper.Color.Magenta)
 
 
 
+def stamp(filename):
+	"""(mtime, size) of filename, None if it doesn't exist."""
+	try:
+		stat = os.stat(filename)
+	except FileNotFoundError:
+		return None
+	return (stat.st_mtime_ns, stat.st_size)
+
+
+
+def source_stamp(stamp):
+	"""A stamp() as stored in DB headers: mtime in whole seconds, as every mount
+	reports the same (sshfs doesn't pass on anything finer). None stays None.
+	"""
+	if stamp is None:
+		return None
+	mtime_ns, size = stamp
+	return (mtime_ns // 1_000_000_000, size)
+
+
+
+def cover_entry(name, size, fmt='jpeg'):
+	"""Name of a cover variant in the cover DB: size (width, height), fmt 'jpeg' or 'bc1'."""
+	prefix = '' if tuple(size) == COVER_DEFAULT_SIZE else f'.{size[0]}x{size[1]}'
+	if fmt == 'bc1':
+		return prefix + COVER_BC1_PREFIX + name
+	return prefix + '/' + name if prefix else name
+
+
+
+def closest_cover_size(sizes, width, height):
+	"""Pick the size to display at width x height: the smallest one that is at
+	least as large, or the largest one if none are.
+	"""
+	sizes = sorted(tuple(size) for size in sizes)
+	for size in sizes:
+		if size[0] >= width and size[1] >= height:
+			return size
+	return sizes[-1] if sizes else COVER_DEFAULT_SIZE
+
+
+
 class JsonValidationError(Exception):
 	pass
 
@@ -136,6 +210,7 @@ def json_read(filename, schema, default=...):
 
 
 def json_write(filename, data):
+	"""Write data to filename, atomically; return whether that worked."""
 	openfunc = gzip.open if filename.endswith('.gz') else open
 	new_filename = filename + NEW_SUFFIX
 
@@ -158,3 +233,288 @@ def json_write(filename, data):
 		os.rename(new_filename, filename)
 	except OSError as e:
 		log.error(f'Writing {filename}: {str(e)}')
+		return False
+	return True
+
+
+
+INDEX_BIN_HEADER = struct.Struct(INDEX_BIN_HEADER_FORMAT)
+INDEX_BIN_RECORD = struct.Struct(INDEX_BIN_RECORD_FORMAT)
+BUNDLE_HEADER = struct.Struct(BUNDLE_HEADER_FORMAT)
+
+
+
+class BinaryIndexError(Exception):
+	pass
+
+
+
+def binary_index_pack(files, source=None):
+	"""Pack the 'files' of an index DB as a binary index: a header, a table of
+	fixed-width records and a table of names they point into.
+	source is the source_stamp() of the index DB they were read from.
+	None is stored as -1.
+	"""
+	records = bytearray()
+	strings = bytearray()
+	for data in files:
+		name = data['name'].encode('utf8')
+		flags = 0
+		color = duration = -1
+		if 'tile_color' in data:
+			flags |= INDEX_BIN_HAS_COLOR
+			if data['tile_color'] is not None:
+				color = int(data['tile_color'].strip('#'), 16)
+		if 'duration' in data:
+			flags |= INDEX_BIN_HAS_DURATION
+			if data['duration'] is not None:
+				duration = int(data['duration'])
+		records += INDEX_BIN_RECORD.pack(
+			len(strings), len(name), data['isdir'], flags, color, duration,
+			-1 if data['src_size'] is None else data['src_size'],
+			-1 if data['src_mtime'] is None else data['src_mtime'],
+		)
+		strings += name
+
+	source_mtime, source_size = source or (0, 0)
+	header = INDEX_BIN_HEADER.pack(
+		INDEX_BIN_MAGIC, INDEX_BIN_VERSION, INDEX_META_VERSION,
+		len(files), INDEX_BIN_HEADER.size + len(records),
+		zlib.crc32(records), zlib.crc32(strings), source_mtime, source_size,
+	)
+	return header + records + strings
+
+
+
+def binary_index_write(filename, files, index_db_name):
+	"""Write index 'files', as read from index_db_name, as a binary index."""
+	new_filename = filename + NEW_SUFFIX
+	log.info(f'Writing DB {filename}')
+	try:
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with open(new_filename, 'wb') as fd:
+			fd.write(binary_index_pack(files, source_stamp(stamp(index_db_name))))
+			os.fdatasync(fd)
+		os.rename(new_filename, filename)
+	except OSError as e:
+		log.error(f'Writing {filename}: {str(e)}')
+
+
+
+class BinaryIndex:
+	"""Read-only binary index, as packed by binary_index_pack().
+	Records and names are checked once, in place; entries are only decoded
+	when asked for, as dicts like those of the JSON index.
+	source is the source_stamp() of the index DB it was made from, None if
+	unknown; when that DB has changed since, the binary index is stale.
+	"""
+	@classmethod
+	def open(cls, filename):
+		with open(filename, 'rb') as fd:
+			try:
+				mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				raise BinaryIndexError('Empty file')
+		# Stays mapped for as long as the index is used
+		return cls(mm, filename)
+
+	@staticmethod
+	def read_source(filename):
+		"""Just the source stamp of a binary index file; None if unreadable."""
+		try:
+			with open(filename, 'rb') as fd:
+				header = fd.read(INDEX_BIN_HEADER.size)
+		except OSError:
+			return None
+		if len(header) < INDEX_BIN_HEADER.size:
+			return None
+		magic, version, meta_version, count, strings_offset, records_crc, strings_crc, source_mtime, source_size = INDEX_BIN_HEADER.unpack(header)
+		if magic != INDEX_BIN_MAGIC or version != INDEX_BIN_VERSION or not source_size:
+			return None
+		return (source_mtime, source_size)
+
+	def __init__(self, data, filename=None):
+		"""data is any buffer: bytes, or an mmap; it is kept, not copied."""
+		self.filename = filename
+		if len(data) < INDEX_BIN_HEADER.size:
+			raise BinaryIndexError('Truncated header')
+		magic, version, meta_version, count, strings_offset, records_crc, strings_crc, source_mtime, source_size = INDEX_BIN_HEADER.unpack_from(data)
+		if magic != INDEX_BIN_MAGIC:
+			raise BinaryIndexError(f'Bad magic {magic}')
+		if version != INDEX_BIN_VERSION or meta_version != INDEX_META_VERSION:
+			raise BinaryIndexError(f'Unsupported version {version}/{meta_version}')
+		if strings_offset != INDEX_BIN_HEADER.size + count * INDEX_BIN_RECORD.size or strings_offset > len(data):
+			raise BinaryIndexError('Truncated records')
+
+		# crc32 straight off the buffer; cheap next to decoding any of it
+		view = memoryview(data)
+		self.records = view[INDEX_BIN_HEADER.size:strings_offset]
+		self.strings = view[strings_offset:]
+		if zlib.crc32(self.records) != records_crc or zlib.crc32(self.strings) != strings_crc:
+			raise BinaryIndexError('Checksum mismatch')
+		self.data = data
+		self.strings_offset = strings_offset
+		self.count = count
+		self.source = (source_mtime, source_size) if source_size else None
+		self.decoded_names = {}
+
+	def __len__(self):
+		return self.count
+
+	def record(self, idx):
+		"""Raw record idx: (name offset, name length, isdir, flags, color, duration, src_size, src_mtime)"""
+		if not 0 <= idx < self.count:
+			raise IndexError(idx)
+		return INDEX_BIN_RECORD.unpack_from(self.records, idx * INDEX_BIN_RECORD.size)
+
+	def all_records(self):
+		return INDEX_BIN_RECORD.iter_unpack(self.records)
+
+	def name(self, idx):
+		"""Name of entry idx, decoded on first use."""
+		name = self.decoded_names.get(idx)
+		if name is None:
+			offset, length, *rest = self.record(idx)
+			name = self.decoded_names[idx] = str(self.strings[offset:offset + length], 'utf8')
+		return name
+
+	def names(self):
+		return [self.name(idx) for idx in range(self.count)]
+
+	def find(self, name):
+		"""Index of the entry called name, None if there is none; without
+		decoding the other names. Names are stored in entry order, so the
+		entry of a match is found by bisecting the name offsets.
+		"""
+		encoded = name.encode('utf8')
+		start = self.strings_offset
+		while True:
+			# Both bytes and mmap find() in place
+			found = self.data.find(encoded, start)
+			if found < 0:
+				return None
+			offset = found - self.strings_offset
+			low, high = 0, self.count
+			while low < high:
+				mid = (low + high) // 2
+				if self.record(mid)[0] < offset:
+					low = mid + 1
+				else:
+					high = mid
+			if low < self.count:
+				record = self.record(low)
+				if record[0] == offset and record[1] == len(encoded):
+					return low
+			start = found + 1
+
+	def __getitem__(self, idx):
+		offset, length, isdir, flags, color, duration, src_size, src_mtime = self.record(idx)
+		data = {
+			'name': self.name(idx),
+			'isdir': bool(isdir),
+			'src_size': None if src_size < 0 else src_size,
+			'src_mtime': None if src_mtime < 0 else src_mtime,
+		}
+		if flags & INDEX_BIN_HAS_COLOR:
+			data['tile_color'] = None if color < 0 else f'#{color:06x}'
+		if flags & INDEX_BIN_HAS_DURATION:
+			data['duration'] = None if duration < 0 else duration
+		return data
+
+	def __str__(self):
+		return f'BinaryIndex({self.filename}, {self.count} entries)'
+
+	def __repr__(self):
+		return self.__str__()
+
+
+
+class BundleError(Exception):
+	pass
+
+
+
+def bundle_write(filename, files, index_db_name, cover_db_name):
+	"""Write index 'files' and a copy of the cover DB as a single file,
+	stamped with the index and cover DBs they came from.
+	"""
+	index_db_mtime, index_db_size = stamp(index_db_name) or (0, 0)
+	index = binary_index_pack(files, source_stamp(stamp(index_db_name)))
+	try:
+		covers = open(cover_db_name, 'rb')
+	except FileNotFoundError:
+		covers = None
+
+	new_filename = filename + NEW_SUFFIX
+	log.info(f'Writing DB {filename}')
+	try:
+		index_offset = BUNDLE_HEADER.size
+		covers_offset = index_offset + len(index)
+		covers_length = covers_mtime = 0
+		if covers:
+			stat = os.fstat(covers.fileno())
+			covers_length, covers_mtime = stat.st_size, stat.st_mtime_ns
+		header = BUNDLE_HEADER.pack(
+			BUNDLE_MAGIC, BUNDLE_VERSION,
+			index_offset, len(index), covers_offset, covers_length,
+			index_db_mtime, index_db_size, covers_mtime, zlib.crc32(index),
+		)
+
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with open(new_filename, 'wb') as fd:
+			fd.write(header)
+			fd.write(index)
+			if covers:
+				shutil.copyfileobj(covers, fd)
+			os.fdatasync(fd)
+		os.rename(new_filename, filename)
+	except OSError as e:
+		log.error(f'Writing {filename}: {str(e)}')
+	finally:
+		if covers:
+			covers.close()
+
+
+
+class Bundle:
+	"""A folder's bundle file, read from the open file fd: the index with one
+	read; the covers stay in the file, which zipfile can open directly (fd too).
+	Clerk removes the bundle before it changes the DBs it copies, so one that
+	is there and intact is current; clients need not look at those DBs.
+	sources holds the stamp()s of the index and cover DBs it was made from
+	(None if there was none), for Clerk to tell whether to rewrite it.
+	"""
+	def __init__(self, fd, filename=None):
+		self.filename = filename
+		header = fd.read(BUNDLE_HEADER.size)
+		if len(header) < BUNDLE_HEADER.size:
+			raise BundleError('Truncated header')
+		(magic, version, index_offset, index_length, covers_offset, covers_length,
+			index_db_mtime, index_db_size, covers_mtime, crc) = BUNDLE_HEADER.unpack(header)
+		if magic != BUNDLE_MAGIC:
+			raise BundleError(f'Bad magic {magic}')
+		if version != BUNDLE_VERSION:
+			raise BundleError(f'Unsupported version {version}')
+
+		# Usually right behind the header already
+		fd.seek(index_offset)
+		data = fd.read(index_length)
+		if len(data) < index_length or zlib.crc32(data) != crc:
+			raise BundleError('Truncated or corrupt index section')
+
+		try:
+			self.index = BinaryIndex(data, filename)
+		except BinaryIndexError as e:
+			raise BundleError(str(e))
+
+		self.has_covers = covers_length > 0
+		self.sources = {
+			INDEX_DB_NAME: (index_db_mtime, index_db_size) if index_db_size else None,
+			COVER_DB_NAME: (covers_mtime, covers_length) if covers_length else None,
+		}
+
+	def __str__(self):
+		return f'Bundle({self.filename}, {len(self.index)} entries)'
+
+	def __repr__(self):
+		return self.__str__()
@@ -0,0 +1,238 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+# Tile decorations: drop shadow, selection highlight and the state emblems
+# (with their own drop shadows). Blurring these with PIL is slow, so they are
+# baked once into a single texture pack, which is cached on disk as a PNG
+# (with the sprite rectangles in a text chunk). The cache file name is a
+# hash of everything that goes into the pack, so changing the config or an
+# emblem simply bakes a new one. Shadow and highlight are small nine-slice
+# squares, stretched around each tile when drawn.
+
+import os
+import json
+import hashlib
+import PIL.Image, PIL.ImageOps, PIL.ImageFilter, PIL.PngImagePlugin
+import OpenGL.GL as gl
+
+import config
+import loghelper
+from draw import TexturedQuad, AtlasQuad
+from upload import Uploader
+
+log = loghelper.get_logger('Decor', loghelper.Color.BrightBlack)
+
+PACK_TAG = 'fabella-decor'
+PACK_VERSION = 2
+
+
+
+class Sprite:
+	def __init__(self, pack, name, x, y, width, height):
+		self.pack = pack
+		self.name = name
+		self.x = x
+		self.y = y
+		self.width = width
+		self.height = height
+		pw, ph = pack.width, pack.height
+		self.uv = (x / pw, y / ph, (x + width) / pw, (y + height) / ph)
+
+	def quad(self, coords, z, color=None):
+		TexturedQuad(coords, z, self.pack.texture, color=color, uv=self.uv)
+
+	def as_quad(self, x, y, z, color=None):
+		if y < 0:
+			y = -y - self.height
+		if x < 0:
+			x = -x - self.width
+		self.quad((x, y, x + self.width, y + self.height), z, color=color)
+
+	def __str__(self):
+		return f'Sprite({self.name}, {self.width}, {self.height})'
+
+	def __repr__(self):
+		return self.__str__()
+
+
+
+class NineSlice(Sprite):
+	"""A blurred square, stretched over any rectangle by drawing its corners
+	as-is and its edges from the centre row/column of texels, and its middle
+	from the centre texel. The middle is drawn too: a moving highlight is not
+	covered by a tile until it settles.
+	"""
+	def quad(self, coords, z, color=None):
+		x1, y1, x2, y2 = coords
+		color = (1, 1, 1, 1) if color is None else color
+		pw, ph = self.pack.width, self.pack.height
+		s = min(self.width // 2, (x2 - x1) // 2, (y2 - y1) // 2)
+
+		# (from, to) in quad coordinates, (from, to) in the sprite's texels
+		cu, cv = self.x + self.width / 2, self.y + self.height / 2
+		columns = [
+			((x1, x1 + s), (self.x, self.x + s)),
+			((x1 + s, x2 - s), (cu, cu)),
+			((x2 - s, x2), (self.x + self.width - s, self.x + self.width)),
+		]
+		rows = [
+			((y2 - s, y2), (self.y, self.y + s)),
+			((y1 + s, y2 - s), (cv, cv)),
+			((y1, y1 + s), (self.y + self.height - s, self.y + self.height)),
+		]
+
+		rects = []
+		for j, ((qy1, qy2), (ty1, ty2)) in enumerate(rows):
+			for i, ((qx1, qx2), (tx1, tx2)) in enumerate(columns):
+				if qx1 >= qx2 or qy1 >= qy2:
+					continue
+				rects.append(((qx1, qy1, qx2, qy2), (tx1 / pw, ty1 / ph, tx2 / pw, ty2 / ph), color))
+		AtlasQuad(coords, z, self.pack.texture, rects)
+
+
+
+class Pack:
+	"""The texture holding all sprites; an upload target for Uploader."""
+	def __init__(self, image):
+		self.width = image.width
+		self.height = image.height
+		self._texture = None
+		self._texture_shape = None
+		Uploader.stage(self, image.tobytes(), self.width, self.height, gl.GL_RGBA, gl.GL_RGBA)
+
+	@property
+	def texture(self):
+		return self._texture
+
+	def uploaded(self, width, height):
+		pass
+
+
+
+def blurred_rect(width, height, blursize, expand):
+	"""White rectangle of width x height, blurred outwards by blursize."""
+	w, h = width + blursize * 2, height + blursize * 2
+	img = PIL.Image.new('RGBA', (w, h), (255, 255, 255, 0))
+	img.paste((255, 255, 255, 255), (blursize - expand, blursize - expand, w - blursize + expand, h - blursize + expand))
+	return img.filter(PIL.ImageFilter.GaussianBlur((blursize - expand) // 2))
+
+
+
+def nine_slice(blursize, expand):
+	"""Blurred rectangle just big enough that its corners and edges are those of
+	any larger one: 4 x blursize square, the inner half of it white.
+	"""
+	return blurred_rect(blursize * 2, blursize * 2, blursize, expand)
+
+
+
+def shadowed_emblem(filename, width, height, blur_radius, blur_count):
+	with PIL.Image.open(filename) as image:
+		image = image.convert('RGBA')
+		if image.width != width or image.height != height:
+			image = PIL.ImageOps.fit(image, (width, height))
+
+	outset = blur_radius + blur_count // 2 + 1
+
+	# Stencil
+	new = PIL.Image.new('RGBA', (width + outset * 2, height + outset * 2))
+	for i in range(blur_count):
+		new.paste((0, 0, 0), (outset - 1, outset - 1), mask=image)
+		new.paste((0, 0, 0), (outset + 1, outset - 1), mask=image)
+		new.paste((0, 0, 0), (outset + 1, outset + 1), mask=image)
+		new.paste((0, 0, 0), (outset - 1, outset + 1), mask=image)
+		new = new.filter(PIL.ImageFilter.GaussianBlur(blur_radius))
+	new.paste(image, (outset, outset), mask=image)
+	return new
+
+
+
+class Decorations:
+	pack = None
+	nine_slices = ('shadow', 'highlight')
+	emblems = {
+		'Unseen': 'img/unseen.png',
+		'Watching': 'img/watching.png',
+		'Tagged': 'img/tagged.png',
+	}
+
+	@classmethod
+	def recipe(cls):
+		"""Everything the pack is made from; its hash names the cache file."""
+		c = config.tile
+		recipe = {
+			'version': PACK_VERSION,
+			'shadow': [c.shadow_blursize, c.shadow_expand],
+			'highlight': [c.highlight_blursize, c.highlight_expand],
+			'emblem': [c.emblem_size, *c.emblem_shadow],
+			'emblems': {},
+		}
+		for name, filename in cls.emblems.items():
+			with open(filename, 'rb') as fd:
+				recipe['emblems'][name] = hashlib.sha256(fd.read()).hexdigest()
+		return recipe
+
+	@classmethod
+	def bake(cls):
+		c = config.tile
+		images = {
+			'shadow': nine_slice(c.shadow_blursize, c.shadow_expand),
+			'highlight': nine_slice(c.highlight_blursize, c.highlight_expand),
+		}
+		for name, filename in cls.emblems.items():
+			images[name] = shadowed_emblem(filename, c.emblem_size, c.emblem_size, *c.emblem_shadow)
+
+		# Simple shelf packing, largest first; 1px gap against bleeding
+		width = max(img.width for img in images.values())
+		rects = {}
+		x = y = shelf = 0
+		for name, img in sorted(images.items(), key=lambda i: -i[1].height):
+			if x + img.width > width:
+				x, y, shelf = 0, y + shelf + 1, 0
+			rects[name] = (x, y, img.width, img.height)
+			x += img.width + 1
+			shelf = max(shelf, img.height)
+
+		pack = PIL.Image.new('RGBA', (width, y + shelf), (0, 0, 0, 0))
+		for name, img in images.items():
+			pack.paste(img, rects[name][:2])
+		return pack, rects
+
+	@classmethod
+	def load(cls):
+		"""Load the pack from the cache, baking it first if needed.
+		Sets a Sprite class attribute for every decoration.
+		"""
+		if cls.pack:
+			return
+
+		recipe = cls.recipe()
+		key = hashlib.sha256(json.dumps(recipe, sort_keys=True).encode('utf8')).hexdigest()[:16]
+		cache_dir = os.path.expanduser(config.cache.path)
+		filename = os.path.join(cache_dir, f'decor-{key}.png')
+
+		try:
+			with PIL.Image.open(filename) as image:
+				image.load()
+				rects = json.loads(image.text[PACK_TAG])
+				pack = image.convert('RGBA')
+			log.info(f'Loaded decorations from {filename}')
+		except (OSError, KeyError, ValueError) as e:
+			log.info(f'Baking decorations ({e})')
+			pack, rects = cls.bake()
+			info = PIL.PngImagePlugin.PngInfo()
+			info.add_text(PACK_TAG, json.dumps(rects))
+			try:
+				os.makedirs(cache_dir, exist_ok=True)
+				pack.save(filename + '.new', format='PNG', pnginfo=info)
+				os.rename(filename + '.new', filename)
+			except OSError as e:
+				log.error(f'Writing {filename}: {e}')
+
+		cls.pack = Pack(pack)
+		for name, rect in rects.items():
+			kind = NineSlice if name in cls.nine_slices else Sprite
+			setattr(cls, name, kind(cls.pack, name, *rect))
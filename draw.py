@@ -11,6 +11,7 @@ import OpenGL.GL as gl
 
 class Quad:
 	quads = set()
+	drawn = (0, 0)  # (quads, glBegin()/glEnd() batches) of the last draw_all()
 
 	def __init__(self, coords, z):
 		self.z = z
@@ -46,14 +47,67 @@ class Quad:
 		width, height = self.x2 - self.x1, self.y2 - self.y1
 		self.x1, self.y1, self.x2, self.y2 = x - width, y - height, x, y
 
+	# Quads with the same batch key (their texture, 0 for none) that end up
+	# next to each other in z-order are emitted in a single glBegin()/glEnd().
+	batch = 0
+
+	def draw(self):
+		self.begin()
+		self.emit()
+		self.end()
+
+	def begin(self):
+		gl.glBegin(gl.GL_QUADS)
+
+	def end(self):
+		gl.glEnd()
+
+	# [(z1, z2, (x1, y1, x2, y2))] for the next draw_all(); see clip()
+	clips = []
+
+	@classmethod
+	def clip(cls, z1, z2, coords):
+		"""Have the next draw_all() cut off quads with z1 <= z < z2 outside coords."""
+		cls.clips.append((z1, z2, coords))
+
 	@classmethod
 	def draw_all(cls):
-		for quad in sorted({q for q in cls.quads if not q.hidden}, key = operator.attrgetter('z')):
-			quad.draw()
+		current = None
+		current_clip = None
+		quads = batches = 0
+		for quad in sorted({q for q in cls.quads if not q.hidden}, key = operator.attrgetter('z', 'batch')):
+			clip = None
+			for z1, z2, coords in cls.clips:
+				if z1 <= quad.z < z2:
+					clip = coords
+					break
+			if current is None or quad.batch != current.batch or clip != current_clip:
+				if current is not None:
+					current.end()
+				if clip != current_clip:
+					# Not allowed between glBegin() and glEnd()
+					if clip is None:
+						gl.glDisable(gl.GL_SCISSOR_TEST)
+					else:
+						x1, y1, x2, y2 = clip
+						gl.glEnable(gl.GL_SCISSOR_TEST)
+						gl.glScissor(int(x1), int(y1), int(x2 - x1), int(y2 - y1))
+					current_clip = clip
+				current = quad
+				quad.begin()
+				batches += 1
+			quad.emit()
+			quads += 1
+		if current is not None:
+			current.end()
+		if current_clip is not None:
+			gl.glDisable(gl.GL_SCISSOR_TEST)
+		cls.drawn = (quads, batches)
 
 		# FIXME: remove
 		# For now, we discard everything after drawing. Reuse later.
 		cls.quads = set()
+		cls.clips = []
 
 
 
@@ -62,14 +116,12 @@ class FlatQuad(Quad):
 		self.color = color
 		super().__init__(coords, z)
 
-	def draw(self):
+	def emit(self):
 		gl.glColor4f(*self.color)
-		gl.glBegin(gl.GL_QUADS)
 		gl.glVertex2f(self.x1, self.y1)
 		gl.glVertex2f(self.x2, self.y1)
 		gl.glVertex2f(self.x2, self.y2)
 		gl.glVertex2f(self.x1, self.y2)
-		gl.glEnd()
 
 
 
@@ -78,8 +130,7 @@ class ShadedQuad(Quad):
 		self.colors = colors
 		super().__init__(coords, z)
 
-	def draw(self):
-		gl.glBegin(gl.GL_QUADS)
+	def emit(self):
 		gl.glColor4f(*self.colors[0])
 		gl.glVertex2f(self.x1, self.y1)
 		gl.glColor4f(*self.colors[1])
@@ -88,29 +139,67 @@ class ShadedQuad(Quad):
 		gl.glVertex2f(self.x2, self.y2)
 		gl.glColor4f(*self.colors[3])
 		gl.glVertex2f(self.x1, self.y2)
-		gl.glEnd()
 
 
 
 class TexturedQuad(Quad):
-	def __init__(self, coords, z, texture, color=None):
+	"""Textured rectangle; uv = (u1, v1, u2, v2) selects part of the texture,
+	with v1 at the top edge (y2) of the quad.
+	"""
+	def __init__(self, coords, z, texture, color=None, uv=(0.0, 0.0, 1.0, 1.0)):
 		self.texture = texture
+		self.batch = texture
 		self.color = (1, 1, 1, 1) if color is None else color
+		self.uv = uv
 		super().__init__(coords, z)
+		if not texture:
+			self.hidden = True
 
-	def draw(self):
-		if not self.texture:
-			return
-		gl.glColor4f(*self.color)
+	def begin(self):
 		gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
 		gl.glBegin(gl.GL_QUADS)
-		gl.glTexCoord2f(0.0, 1.0)
+
+	def end(self):
+		gl.glEnd()
+		gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+
+	def emit(self):
+		u1, v1, u2, v2 = self.uv
+		gl.glColor4f(*self.color)
+		gl.glTexCoord2f(u1, v2)
 		gl.glVertex2f(self.x1, self.y1)
-		gl.glTexCoord2f(1.0, 1.0)
+		gl.glTexCoord2f(u2, v2)
 		gl.glVertex2f(self.x2, self.y1)
-		gl.glTexCoord2f(1.0, 0.0)
+		gl.glTexCoord2f(u2, v1)
 		gl.glVertex2f(self.x2, self.y2)
-		gl.glTexCoord2f(0.0, 0.0)
+		gl.glTexCoord2f(u1, v1)
 		gl.glVertex2f(self.x1, self.y2)
-		gl.glEnd()
-		gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+
+
+
+class AtlasQuad(Quad):
+	"""Many textured rectangles from one atlas texture, drawn in a single glBegin().
+	rects is a list of ((x1, y1, x2, y2), (u1, v1, u2, v2), color), drawn in order.
+	"""
+	def __init__(self, coords, z, texture, rects):
+		self.texture = texture
+		self.batch = texture
+		self.rects = rects
+		super().__init__(coords, z)
+		if not texture:
+			self.hidden = True
+
+	begin = TexturedQuad.begin
+	end = TexturedQuad.end
+
+	def emit(self):
+		for (x1, y1, x2, y2), (u1, v1, u2, v2), color in self.rects:
+			gl.glColor4f(*color)
+			gl.glTexCoord2f(u1, v2)
+			gl.glVertex2f(x1, y1)
+			gl.glTexCoord2f(u2, v2)
+			gl.glVertex2f(x2, y1)
+			gl.glTexCoord2f(u2, v1)
+			gl.glVertex2f(x2, y2)
+			gl.glTexCoord2f(u1, v1)
+			gl.glVertex2f(x1, y2)
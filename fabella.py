@@ -5,45 +5,98 @@
 # Licensed under GPL v2.0, or (at your option) any later version.
 # (SPDX GPL-2.0-or-later) See LICENSE file for details.
 
-import sys
+import os
+import atexit
+import argparse
+
+parser = argparse.ArgumentParser(description='Simple, elegant video library and player.')
+parser.add_argument('path', help='folder to start in')
+parser.add_argument('--headless', action='store_true', help='render offscreen; keys come from --replay and --script, then quit')
+parser.add_argument('--script', metavar='SCRIPT', default='', help='with --headless, press the keys in SCRIPT (a file, or the keys themselves, like "RIGHT*5 ENTER")')
+parser.add_argument('--record', metavar='FILE', help='record key events to FILE')
+parser.add_argument('--replay', metavar='FILE', help='replay the key events recorded in FILE')
+parser.add_argument('--speed', type=float, default=1.0, help='replay this many times faster than recorded')
+parser.add_argument('--frames', metavar='FILE', help='on exit, write the timings and draw calls of the last frames to FILE as JSON')
+args = parser.parse_args()
+
+# PyOpenGL settles on a platform when it is first imported
+if args.headless:
+	os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
 import glfw
 import time
 import OpenGL.GL as gl
 
+import config
+import worker
 import loghelper
-from window import Window
+import redraw
+from window import Window, HeadlessWindow
 from menu import Menu
 from video import Video
 from draw import Quad
+from upload import Uploader
+from journal import StateJournal
+from profiler import Profiler
+
+
+
+# Held down, these repeat; the repeats queued up by a slow frame are handled at once
+VIDEO_REPEAT_KEYS = {glfw.KEY_RIGHT, glfw.KEY_LEFT, glfw.KEY_UP, glfw.KEY_DOWN, glfw.KEY_PAGE_UP, glfw.KEY_PAGE_DOWN}
+MENU_REPEAT_KEYS = {
+	glfw.KEY_UP, glfw.KEY_K, glfw.KEY_DOWN, glfw.KEY_J, glfw.KEY_RIGHT, glfw.KEY_L, glfw.KEY_LEFT, glfw.KEY_H,
+	glfw.KEY_PAGE_UP, glfw.KEY_PAGE_DOWN,
+}
 
 
 
-loghelper.set_up_logging(15, 0, 'fabella.log')
+loghelper.set_up_logging(15, config.logging.file_level, 'fabella.log', config.logging.levels)
 log = loghelper.get_logger('Fabella', loghelper.Color.Red)
 log.info('Starting Fabella.')
+worker.start_reporter(config.stats.interval, config.stats.socket)
 
 
 
-window = Window(1920, 1080, "Fabella")
-menu = Menu(sys.argv[1], enabled=True)
-video = Video()
+if args.headless:
+	script = args.script
+	if os.path.isfile(script):
+		with open(script) as fd:
+			script = fd.read()
+	window = HeadlessWindow(config.headless.width, config.headless.height, "Fabella", script)
+else:
+	window = Window(1920, 1080, "Fabella")
+if args.record:
+	window.record(args.record)
+if args.replay:
+	window.replay(args.replay, args.speed)
+if args.frames:
+	atexit.register(Profiler.dump, args.frames)
+# Before the menu loads covers; it needs to know what formats we can upload
+Uploader.initialize()
+menu = Menu(args.path, enabled=True)
+video = Video(window)
+Profiler.hud_label = menu.menu_font.label(None, pool=menu.render_pool)
 
 #### Main loop
 last_time = 0
 frame_count = 0
+clock_second = 0
+timeout = 0
 osd = False
 log.info('Starting main loop')
 while not window.closed():
-	window.wait()
+	window.wait(timeout)
+	Profiler.begin()
 
 	if not menu.enabled:
-		for key, scancode, action, modifiers in window.get_events():
+		for key, scancode, action, modifiers, count in window.get_events(VIDEO_REPEAT_KEYS):
 			if action == glfw.PRESS:
-				log.info(f'Parsing key {key} in video mode')
+				log.info('Parsing key %s (x%d) in video mode', key, count)
 				if key == glfw.KEY_Q and modifiers == glfw.MOD_CONTROL:
 					log.info('Quitting.')
 					menu.forget()
 					video.stop()
+					StateJournal.flush()
 					window.terminate()
 					exit()
 				if key == glfw.KEY_ESCAPE:
@@ -55,6 +108,9 @@ while not window.closed():
 					menu.open()
 				if key == glfw.KEY_F:
 					window.set_fullscreen()
+				if key == glfw.KEY_F12:
+					Profiler.toggle_hud()
+					redraw.request('profiler')
 				if key == glfw.KEY_O:
 					log.info('Cycling OSD')
 					#video.mpv['osd-level'] ^= 2
@@ -62,17 +118,17 @@ while not window.closed():
 				if key == glfw.KEY_SPACE:
 					video.pause()
 				if key == glfw.KEY_RIGHT:
-					video.seek(5)
+					video.seek(5 * count)
 				if key == glfw.KEY_LEFT:
-					video.seek(-5)
+					video.seek(-5 * count)
 				if key == glfw.KEY_UP:
-					video.seek(60)
+					video.seek(60 * count)
 				if key == glfw.KEY_DOWN:
-					video.seek(-60)
+					video.seek(-60 * count)
 				if key == glfw.KEY_PAGE_UP:
-					video.seek(600)
+					video.seek(600 * count)
 				if key == glfw.KEY_PAGE_DOWN:
-					video.seek(-600)
+					video.seek(-600 * count)
 				if key == glfw.KEY_HOME:
 					video.seek(0, 'absolute')
 				if key == glfw.KEY_END:
@@ -102,17 +158,21 @@ while not window.closed():
 						video.mpv.show_text(f'Subtitles {subid}/{sub_count}: {sublang.upper()}\n{subtitle}')
 
 	if menu.enabled:
-		for key, scancode, action, modifiers in window.get_events():
+		for key, scancode, action, modifiers, count in window.get_events(MENU_REPEAT_KEYS):
 			if action == glfw.PRESS:
-				log.info(f'Parsing key {key} in menu mode')
+				log.info('Parsing key %s (x%d) in menu mode', key, count)
 				if key == glfw.KEY_Q and modifiers == glfw.MOD_CONTROL:
 					log.info('Quitting.')
 					menu.forget()
 					video.stop()
+					StateJournal.flush()
 					window.terminate()
 					exit()
 				if key == glfw.KEY_F:
 					window.set_fullscreen()
+				if key == glfw.KEY_F12:
+					Profiler.toggle_hud()
+					redraw.request('profiler')
 				if key == glfw.KEY_ESCAPE:
 					# FIXME Hmm; the idea is right, but the variable definitely needs a better name.
 					if video.should_render:
@@ -129,47 +189,73 @@ while not window.closed():
 				if key == glfw.KEY_BACKSPACE:
 					menu.back()
 				if key in [glfw.KEY_UP, glfw.KEY_K]:
-					menu.previous_row()
+					menu.previous_row(count)
 				if key in [glfw.KEY_DOWN, glfw.KEY_J]:
-					menu.next_row()
+					menu.next_row(count)
 				if key in [glfw.KEY_RIGHT, glfw.KEY_L]:
-					menu.next()
+					menu.next(count)
 				if key in [glfw.KEY_LEFT, glfw.KEY_H]:
-					menu.previous()
+					menu.previous(count)
 				if key == glfw.KEY_PAGE_UP:
 					# FIXME: actually use the number of rows
-					for i in range(3): menu.previous_row()
+					menu.previous_row(3 * count)
 				if key == glfw.KEY_PAGE_DOWN:
 					# FIXME: actually use the number of rows
-					for i in range(3): menu.next_row()
+					menu.next_row(3 * count)
 				if key == glfw.KEY_HOME:
 					# FIXME: cmon
-					for i in range(100): menu.previous_row()
-					for i in range(4): menu.previous()
+					menu.previous_row(100)
+					menu.previous(4)
 				if key == glfw.KEY_END:
 					# FIXME: cmon
-					for i in range(100): menu.next_row()
-					for i in range(4): menu.next()
+					menu.next_row(100)
+					menu.next(4)
 				if key == glfw.KEY_DELETE:
 					menu.toggle_tagged()
 
+	Profiler.mark('events')
+	timeout = menu.poll()
+
+	# Keep the clock ticking while it is visible
+	if menu.enabled or (video.rendered and (osd or video.mpv.pause)):
+		now = time.time()
+		if int(now) != clock_second:
+			clock_second = int(now)
+			redraw.request('clock')
+		timeout = min(timeout, 1 - now % 1)
+
+	# Nothing changed; don't bother drawing
+	if not redraw.pending():
+		Profiler.cancel()
+		continue
+	redraw.consume()
+	Profiler.mark('poll')
+
 	width, height = window.size()
 	#log.debug(f'Window size {width}x{height}')
 
-	video.render(width, height)
+	# Without the menu over it, the video goes straight to the framebuffer
+	direct = video.render(width, height, direct=not menu.enabled)
 
 	# MPV seems to reset some of this stuff, so re-init
+	gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
 	gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 	gl.glEnable(gl.GL_BLEND)
 	gl.glEnable(gl.GL_TEXTURE_2D)
 
 	gl.glViewport(0, 0, width, height)
-	gl.glClearColor(0.0, 0.0, 0.0, 1)
-	gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+	if not direct:
+		gl.glClearColor(0.0, 0.0, 0.0, 1)
+		gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
 	gl.glMatrixMode(gl.GL_PROJECTION)
 	gl.glLoadIdentity()
 	gl.glOrtho(0.0, width, 0.0, height, 0.0, 1.0)
 	gl.glMatrixMode (gl.GL_MODELVIEW)
+	Profiler.mark('video')
+
+	# New textures from the render pool, as far as this frame's budget allows
+	Uploader.process()
+	Profiler.mark('upload')
 
 	if video.rendered:
 		video.draw(width, height)
@@ -180,16 +266,23 @@ while not window.closed():
 	if menu.enabled:
 		menu.draw(width, height, transparent=video.rendered)
 
+	Profiler.draw_hud(width)
+	Profiler.mark('submit')
+
 	Quad.draw_all()
+	Profiler.mark('draw')
 
 	window.swap_buffers()
+	video.report_swap()
+	Profiler.mark('swap')
+	Profiler.end()
 
 	frame_count += 1
 	new = time.time()
 	if int(new) > last_time:
 		last_time = int(new)
 		#print(f'{frame_count} fps')
-		log.info(f'Rendering at {frame_count} fps')
+		log.info(f'Rendered {frame_count} frames in the last second')
 		frame_count = 0
 
 log.info('End of program.')
@@ -4,6 +4,10 @@
 # Licensed under GPL v2.0, or (at your option) any later version.
 # (SPDX GPL-2.0-or-later) See LICENSE file for details.
 
+import threading
+import functools
+import unicodedata
+import collections
 import OpenGL.GL as gl
 import cairo
 import gi
@@ -12,21 +16,76 @@ from gi.repository import Pango
 gi.require_version('PangoCairo', '1.0')
 from gi.repository import PangoCairo
 
+import config
+import redraw
 import loghelper
-from draw import TexturedQuad
+import worker
+from draw import TexturedQuad, AtlasQuad
+from upload import Uploader
 
 log = loghelper.get_logger('Font', loghelper.Color.BrightBlack)
 
 
+
+class RenderCache:
+	"""Size-bounded LRU cache of rendered text bitmaps, shared by all Text instances.
+	Keys are (font name, font size, stroke width, text, max_width, lines),
+	values are the (data, width, height) tuples Text.render() produces.
+	"""
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			try:
+				self.entries.move_to_end(key)
+			except KeyError:
+				self.misses += 1
+				return None
+			self.hits += 1
+			return self.entries[key]
+
+	def put(self, key, value):
+		size = len(value[0])
+		if size > self.max_bytes:
+			return
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old:
+				self.bytes -= len(old[0])
+			self.entries[key] = value
+			self.bytes += size
+			while self.bytes > self.max_bytes:
+				_, (data, _, _) = self.entries.popitem(last=False)
+				self.bytes -= len(data)
+
+	def __str__(self):
+		return f'RenderCache({len(self.entries)} entries, {self.bytes // 1024} KiB, hits={self.hits}, misses={self.misses})'
+
+	def __repr__(self):
+		return self.__str__()
+
+
+# Identical labels (durations, re-entered folders) are only rasterized once.
+render_cache = RenderCache(64 * 1024 * 1024)
+
+
 class Text:
-	def __init__(self, font, text, max_width=None, lines=1, pool=None):
+	def __init__(self, font, text, max_width=None, lines=1, pool=None, priority=worker.PRIORITY_NORMAL):
 		self._text = None
 		self._max_width = None
+		self.job = None
+		self.priority = priority
 		self.width = 0
 		self.height = 0
-		self.update = None
 		self.rendered = False
 		self._texture = None
+		self._texture_shape = None
 
 		self.font = font
 		self.lines = lines
@@ -46,7 +105,7 @@ class Text:
 		if text != self._text:
 			self._text = text
 			self.rendered = False
-			self.pool.schedule(self.render)
+			self.schedule_render()
 
 	@property
 	def max_width(self):
@@ -56,14 +115,28 @@ class Text:
 		if max_width != self._max_width:
 			self._max_width = max_width
 			self.rendered = False
-			self.pool.schedule(self.render)
+			self.schedule_render()
+
+	def schedule_render(self):
+		# A render for the previous text or width is no longer needed
+		if self.job:
+			self.job.cancel()
+		self.job = self.pool.schedule(self.render, priority=self.priority)
 
 	def render(self):
-		log.debug(f'Rendering text: "{self._text}"')
+		log.debug('Rendering text: "%s"', self._text)
 
 		if self.rendered:
 			log.warning('Already rendered, skipping')
 			return
+		generation = Uploader.generation(self)
+
+		key = (self.font.name, self.font.size, self.font.stroke_width, self._text, self._max_width, self.lines)
+		cached = render_cache.get(key)
+		if cached:
+			Uploader.stage(self, *cached, gl.GL_RGBA, gl.GL_BGRA, generation=generation)
+			self.rendered = True
+			return
 
 		border = self.font.stroke_width
 		layout = PangoCairo.create_layout(self.font.context)
@@ -102,28 +175,21 @@ class Text:
 		context.move_to(border, border)
 		PangoCairo.show_layout(context, layout)
 
-		self.update = (surface.get_data(), width, height)
+		surface.flush()
+		rendered = (bytes(surface.get_data()), width, height)
+		render_cache.put(key, rendered)
+		Uploader.stage(self, *rendered, gl.GL_RGBA, gl.GL_BGRA, generation=generation)
 		self.rendered = True
 
 	@property
 	def texture(self):
-		if not self.update:
-			return self._texture
-
-		data, self.width, self.height = self.update
-		self.update = None
-
-		if self._texture is None:
-			self._texture = gl.glGenTextures(1)
-
-		gl.glBindTexture(gl.GL_TEXTURE_2D, self._texture)
-		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
-		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
-		gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, self.width, self.height, 0, gl.GL_BGRA, gl.GL_UNSIGNED_BYTE, data)
-		gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-
 		return self._texture
 
+	def uploaded(self, width, height):
+		# Only now the texture matches the new size
+		self.width = width
+		self.height = height
+
 	def as_quad(self, x, y, z, color=None):
 		if self.texture:
 			if y < 0:
@@ -139,11 +205,285 @@ class Text:
 		return self.__str__()
 
 
+def clusters(text):
+	"""Split text into the units the glyph atlas caches: characters, plus any
+	combining marks, variation selectors and zero-width joiners attached to them.
+	"""
+	cluster = ''
+	for c in text:
+		if cluster and (unicodedata.combining(c) or 0xfe00 <= ord(c) <= 0xfe0f or c == '\u200d' or cluster[-1] == '\u200d'):
+			cluster += c
+		else:
+			if cluster:
+				yield cluster
+			cluster = c
+	if cluster:
+		yield cluster
+
+
+class Glyph:
+	def __init__(self, page, advance, width, height, baseline, stroke, fill):
+		self.page = page
+		self.advance = advance  # In Pango units, for kerning; see GlyphAtlas.kerning()
+		self.width = width
+		self.height = height
+		self.baseline = baseline  # Pixels from the top of the cell
+		# (u1, v1, u2, v2) of the outline and fill in the page
+		self.stroke = stroke
+		self.fill = fill
+
+
+class GlyphAtlas:
+	"""Stroked and filled glyphs of one Font, rasterized once into texture
+	pages. Labels are drawn from here as batches of quads.
+	Pages are ARGB, like Text's textures, so color emoji keep their colors;
+	outlines and plain glyphs are white, to be tinted when drawn.
+	Glyphs are rasterized on first use, on a worker thread (see Label); pages
+	are uploaded from the render thread when they changed.
+	"""
+	page_size = 1024
+	# Labels are mostly clocks, durations and breadcrumbs; have these ready.
+	charset = '0123456789:?∕ ›MTWFSadehinortu'
+
+	def __init__(self, font):
+		log.info(f'Creating glyph atlas for {font}')
+		self.font = font
+		self.glyphs = {}
+		self.kernings = {}  # (left cluster, right cluster) -> pixels
+		self.pages = []
+		self.textures = []
+		self.dirty = []
+		self.shelf_x = self.shelf_y = self.shelf_height = 0
+		self.lock = threading.RLock()
+		self.add_page()
+
+	def add_page(self):
+		self.pages.append(bytearray(self.page_size * self.page_size * 4))
+		self.textures.append(None)
+		self.dirty.append(True)
+		self.shelf_x = self.shelf_y = self.shelf_height = 0
+
+	def allocate(self, width, height):
+		"""Find room for a width x height cell; returns (page, x, y)."""
+		if self.shelf_x + width > self.page_size:
+			self.shelf_x = 0
+			self.shelf_y += self.shelf_height
+			self.shelf_height = 0
+		if self.shelf_y + height > self.page_size:
+			log.info(f'{self} page {len(self.pages) - 1} is full, adding one')
+			self.add_page()
+		x, y = self.shelf_x, self.shelf_y
+		self.shelf_x += width
+		self.shelf_height = max(self.shelf_height, height)
+		return len(self.pages) - 1, x, y
+
+	def blit(self, page, x, y, surface):
+		width, height, stride = surface.get_width(), surface.get_height(), surface.get_stride()
+		data = surface.get_data()
+		pixels = self.pages[page]
+		row_size = self.page_size * 4
+		for row in range(height):
+			offset = (y + row) * row_size + x * 4
+			pixels[offset:offset + width * 4] = data[row * stride:row * stride + width * 4]
+		self.dirty[page] = True
+		return (x / self.page_size, y / self.page_size, (x + width) / self.page_size, (y + height) / self.page_size)
+
+	def create_layout(self, text):
+		layout = PangoCairo.create_layout(self.font.context)
+		layout.set_font_description(self.font.face)
+		layout.set_text(text, -1)
+		return layout
+
+	def rasterize(self, cluster):
+		log.debug('Rasterizing glyph %r for %s', cluster, self.font)
+		border = self.font.stroke_width
+		layout = self.create_layout(cluster)
+		ink, logical = layout.get_pixel_extents()
+		width, height = logical.width + border * 2, logical.height + border * 2
+		baseline = border + layout.get_baseline() // Pango.SCALE
+
+		page, x, y = self.allocate(width * 2, height)
+
+		# Outline
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+		context = cairo.Context(surface)
+		context.set_source_rgb(1, 1, 1)
+		context.move_to(border, border)
+		PangoCairo.layout_path(context, layout)
+		context.set_line_width(border * 2)
+		context.set_line_join(cairo.LINE_JOIN_ROUND)
+		context.set_line_cap(cairo.LINE_CAP_ROUND)
+		context.stroke()
+		surface.flush()
+		stroke = self.blit(page, x, y, surface)
+
+		# Fill
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+		context = cairo.Context(surface)
+		context.set_source_rgb(1, 1, 1)
+		context.move_to(border, border)
+		PangoCairo.show_layout(context, layout)
+		surface.flush()
+		fill = self.blit(page, x + width, y, surface)
+
+		return Glyph(page, layout.get_size()[0], width, height, baseline, stroke, fill)
+
+	def kerning(self, left, right):
+		"""Pixels to move right by after left, beyond its advance."""
+		pair = self.create_layout(left + right).get_size()[0]
+		return round((pair - self.glyphs[left].advance - self.glyphs[right].advance) / Pango.SCALE)
+
+	def lay_out(self, text, cached_only=False):
+		"""Returns ([(glyph, x)], width, height, baseline) for a line of text,
+		x being relative to the left of the line and baseline the pixels from
+		its top. Rasterizes missing glyphs, unless cached_only: then returns
+		None if anything is missing.
+		"""
+		placed = []
+		x = 0
+		previous = None
+		for cluster in clusters(text):
+			glyph = self.glyphs.get(cluster)
+			kerning = self.kernings.get((previous, cluster)) if previous else 0
+			if glyph is None or kerning is None:
+				if cached_only:
+					return None
+				with self.lock:
+					glyph = self.glyphs.get(cluster)
+					if glyph is None:
+						glyph = self.glyphs[cluster] = self.rasterize(cluster)
+					if previous:
+						kerning = self.kernings.get((previous, cluster))
+						if kerning is None:
+							kerning = self.kernings[previous, cluster] = self.kerning(previous, cluster)
+			x += kerning
+			placed.append((glyph, x))
+			x += round(glyph.advance / Pango.SCALE)
+			previous = cluster
+
+		if not placed:
+			return [], 0, 0, 0
+		baseline = max(glyph.baseline for glyph, offset in placed)
+		height = baseline + max(glyph.height - glyph.baseline for glyph, offset in placed)
+		return placed, x + self.font.stroke_width * 2, height, baseline
+
+	def warm(self):
+		self.lay_out(self.charset)
+
+	def texture(self, page):
+		"""Texture for page, uploading it first if it changed. Render thread only."""
+		if not self.dirty[page]:
+			return self.textures[page]
+		self.dirty[page] = False
+
+		if self.textures[page] is None:
+			self.textures[page] = gl.glGenTextures(1)
+
+		gl.glBindTexture(gl.GL_TEXTURE_2D, self.textures[page])
+		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+		gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, self.page_size, self.page_size, 0, gl.GL_BGRA, gl.GL_UNSIGNED_BYTE, bytes(self.pages[page]))
+		gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+		return self.textures[page]
+
+	def __str__(self):
+		return f'GlyphAtlas({self.font.name} {self.font.size}, {len(self.glyphs)} glyphs, {len(self.pages)} pages)'
+
+	def __repr__(self):
+		return self.__str__()
+
+
+class Label:
+	"""Single line of text drawn from the glyph atlas; a fast path for Text.
+	Setting the text only looks up glyphs, so the clock and durations never
+	rasterize anything once their characters have been seen. Text with new
+	characters is laid out on the pool; until then, the previous text stays up.
+	No wrapping or ellipsizing; use Text for those.
+	"""
+	_texture = None  # Owns no texture, the atlas does
+	rendered = True
+
+	def __init__(self, font, text, pool=None, priority=worker.PRIORITY_NORMAL):
+		self._text = None
+		self.job = None
+		self.pool = pool
+		self.priority = priority
+		self.line = ([], 0, 0, 0)
+		self.width = 0
+		self.height = 0
+
+		self.font = font
+		self.atlas = font.atlas
+		self.text = text
+
+	@property
+	def text(self):
+		return self._text
+	@text.setter
+	def text(self, text):
+		if text != self._text:
+			self._text = text
+			if self.job:
+				self.job.cancel()
+				self.job = None
+			line = self.atlas.lay_out(text, cached_only=True) if text else ([], 0, 0, 0)
+			if line is not None:
+				self.set_line(line)
+			elif self.pool:
+				self.job = self.pool.schedule(functools.partial(self.render, text), priority=self.priority)
+			else:
+				self.set_line(self.atlas.lay_out(text))
+
+	def render(self, text):
+		line = self.atlas.lay_out(text)
+		# Unless the text changed again in the meantime
+		if text == self._text:
+			self.set_line(line)
+			redraw.request('label laid out')
+
+	def set_line(self, line):
+		self.line = line
+		self.width, self.height = line[1], line[2]
+
+	def as_quad(self, x, y, z, color=None):
+		placed, width, height, baseline = self.line
+		if not placed:
+			return
+		if y < 0:
+			y = -y - height
+		if x < 0:
+			x = -x - width
+		if color is None:
+			color = (1, 1, 1, 1)
+		outline = (0, 0, 0, color[3])
+
+		# All outlines go below all fills, like in Text.render().
+		# Glyphs (from fallback fonts, too) line up on the baseline.
+		top = y + height
+		pages = {}
+		for glyph, offset in placed:
+			glyph_top = top - (baseline - glyph.baseline)
+			rect = (x + offset, glyph_top - glyph.height, x + offset + glyph.width, glyph_top)
+			strokes, fills = pages.setdefault(glyph.page, ([], []))
+			strokes.append((rect, glyph.stroke, outline))
+			fills.append((rect, glyph.fill, color))
+
+		for page, (strokes, fills) in pages.items():
+			AtlasQuad((x, y, x + width, y + height), z, self.atlas.texture(page), strokes + fills)
+
+	def __str__(self):
+		return f'Label({self.font.name} {self.font.size}, {repr(self._text)})'
+
+	def __repr__(self):
+		return self.__str__()
+
+
 class Font:
 	face = None
 	name = None
 	size = None
 	stroke_width = 0
+	_atlas = None
 
 	def __init__(self, fontname, size, stroke_width=None):
 		log.info(f'Creating instance for {fontname} {size}')
@@ -160,8 +500,22 @@ class Font:
 		self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 64, 64)
 		self.context = cairo.Context(self.surface)
 
-	def text(self, text, max_width=None, lines=1, pool=None):
-		return Text(self, text, max_width, lines, pool=pool)
+	def text(self, text, max_width=None, lines=1, pool=None, priority=worker.PRIORITY_NORMAL):
+		return Text(self, text, max_width, lines, pool=pool, priority=priority)
+
+	def label(self, text, pool=None):
+		"""Single-line text; drawn from the glyph atlas if that is enabled."""
+		if not config.font.glyph_atlas:
+			return Text(self, text, None, 1, pool=pool)
+		if self._atlas is None:
+			self._atlas = GlyphAtlas(self)
+			if pool:
+				pool.schedule(self._atlas.warm, priority=worker.PRIORITY_LOW)
+		return Label(self, text, pool=pool)
+
+	@property
+	def atlas(self):
+		return self._atlas
 
 	def __str__(self):
 		return f'Font({self.name} {self.size}, {self.stroke_width})'
@@ -6,36 +6,33 @@
 
 import io
 import OpenGL.GL as gl
-import PIL.Image, PIL.ImageOps, PIL.ImageFilter
+import PIL.Image, PIL.ImageOps
+from OpenGL.GL.EXT.texture_compression_s3tc import GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+
+import bc1
 
 import loghelper
+import worker
 from draw import TexturedQuad
+from upload import Uploader
 
 log = loghelper.get_logger('Image', loghelper.Color.BrightBlack)
 
 
 
-class ImgLib:
-	@classmethod
-	def add(cls, name, filename, width, height, pool, shadow=None):
-		with open(filename, 'rb') as fd:
-			data = fd.read()
-		img = Image(data, width, height, name=name, pool=pool, mode='RGBA', shadow=shadow)
-		setattr(cls, name, img)
-
-
-
 class Image:
-	def __init__(self, source, width, height, name='None', pool=None, mode='RGB', shadow=None):
+	def __init__(self, source, width, height, name='None', pool=None, mode='RGB', mipmap=False, priority=worker.PRIORITY_NORMAL):
 		self._source = None
-		self.pixels = None
+		self.job = None
+		self.priority = priority
 		self.rendered = False
 		self._texture = None
+		self._texture_shape = None
 
 		self.width = width
 		self.height = height
 		self.mode = mode
-		self.shadow = shadow
+		self.mipmap = mipmap
 		self.name = name
 		self.pool = pool
 		self.source = source
@@ -52,15 +49,31 @@ class Image:
 		if source != self._source:
 			self._source = source
 			self.rendered = False
-			self.update_texture = False
-			self.pool.schedule(self.render)
+			# A render of the previous source is no longer needed
+			if self.job:
+				self.job.cancel()
+			self.job = self.pool.schedule(self.render, priority=self.priority)
 
 	def render(self):
-		log.debug(f'Rendering image: {self.name}')
+		log.debug('Rendering image: %s', self.name)
 
 		if self.rendered:
 			log.warning('Already rendered, skipping')
 			return
+		generation = Uploader.generation(self)
+
+		if self.mode == 'BC1':
+			# Compressed by Clerk already, upload as-is
+			try:
+				width, height, levels = bc1.unpack(self._source)
+			except bc1.Error as e:
+				log.error(f'Loading {self}: {e}')
+				return
+			self.width, self.height = width, height
+			mipmaps = levels[1:] if self.mipmap else None
+			Uploader.stage(self, levels[0][2], width, height, GL_COMPRESSED_RGB_S3TC_DXT1_EXT, mipmaps=mipmaps, generation=generation)
+			self.rendered = True
+			return
 
 		with PIL.Image.open(io.BytesIO(self._source)) as image:
 			if image.mode != self.mode:
@@ -68,48 +81,19 @@ class Image:
 			if image.width != self.width or image.height != self.height:
 				image = PIL.ImageOps.fit(image, (self.width, self.height))
 
-			if self.shadow:
-				blur_radius, blur_count = self.shadow
-				outset = blur_radius + blur_count // 2 + 1
-
-				# Stencil
-				new = PIL.Image.new('RGBA', (self.width + outset * 2, self.height + outset * 2))
-
-				for i in range(blur_count):
-					new.paste((0, 0, 0), (outset - 1, outset - 1), mask=image)
-					new.paste((0, 0, 0), (outset + 1, outset - 1), mask=image)
-					new.paste((0, 0, 0), (outset + 1, outset + 1), mask=image)
-					new.paste((0, 0, 0), (outset - 1, outset + 1), mask=image)
-					new = new.filter(PIL.ImageFilter.GaussianBlur(blur_radius))
-				new.paste(image, (outset, outset), mask=image)
-
-				image = new.convert(self.mode)
-				self.width = new.width
-				self.height = new.height
-
 			pixels = image.tobytes()
 
-		self.pixels = pixels
+		glmode = {'RGB': gl.GL_RGB, 'RGBA': gl.GL_RGBA}[self.mode]
+		Uploader.stage(self, pixels, self.width, self.height, glmode, glmode, mipmaps=True if self.mipmap else None, generation=generation)
 		self.rendered = True
 
 	@property
 	def texture(self):
-		if not self.pixels:
-			return self._texture
-
-		if self._texture is None:
-			self._texture = gl.glGenTextures(1)
-
-		glmode = {'RGB': gl.GL_RGB, 'RGBA': gl.GL_RGBA}[self.mode]
-		gl.glBindTexture(gl.GL_TEXTURE_2D, self._texture)
-		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
-		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
-		gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, glmode, self.width, self.height, 0, glmode, gl.GL_UNSIGNED_BYTE, self.pixels)
-		gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-
-		self.pixels = None
 		return self._texture
 
+	def uploaded(self, width, height):
+		pass
+
 	def as_quad(self, x, y, z, color=None):
 		if self.texture:
 			if y < 0:
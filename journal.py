@@ -0,0 +1,149 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+# State updates (positions, tags) for Clerk. Writing a queue file means a
+# makedirs, a write, an fdatasync and a rename, over the network; so updates
+# are collected in memory, merged per folder and file, and written by a
+# background thread as one queue file per folder per flush.
+# Until Clerk has merged them into the state DB, reading that DB would undo
+# them; so they are remembered, to be laid over it (see unmerged()).
+
+import os
+import uuid
+import atexit
+import threading
+
+import dbs
+import config
+import loghelper
+
+log = loghelper.get_logger('Journal', loghelper.Color.BrightBlack)
+
+
+
+class StateJournal:
+	pending = {}  # {folder path: {name: state}}
+	written = {}  # {folder path: [(queue file name, {name: state})]}, until Clerk removes the file
+	writing = set()  # Queue file names of written being written right now
+	lock = threading.Lock()
+	flush_lock = threading.Lock()
+	wakeup = threading.Event()
+	hurry = threading.Event()
+	thread = None
+
+	@classmethod
+	def update(cls, path, name, state):
+		"""Queue a state update for file name in folder path."""
+		with cls.lock:
+			cls.pending.setdefault(path, {}).setdefault(name, {}).update(state)
+			if cls.thread is None:
+				cls.thread = threading.Thread(target=cls.run, name='journal', daemon=True)
+				cls.thread.start()
+		cls.wakeup.set()
+
+	@classmethod
+	def unmerged(cls, path, prune=False):
+		"""{name: state} of the updates for folder path that may not be in its
+		state DB yet: pending ones, and ones in queue files Clerk hasn't
+		processed. Take this before reading the state DB, or an update Clerk
+		merges in between is in neither. prune checks which queue files are
+		gone, which means I/O; not for the main thread.
+		"""
+		if prune:
+			cls.prune(path)
+
+		updates = {}
+		with cls.lock:
+			for update_name, state in cls.written.get(path, ()):
+				for name, update in state.items():
+					updates.setdefault(name, {}).update(update)
+			for name, update in cls.pending.get(path, {}).items():
+				updates.setdefault(name, {}).update(update)
+		return updates
+
+	@classmethod
+	def prune(cls, path):
+		"""Forget the written updates for folder path whose queue files Clerk
+		has processed (removed). I/O; not for the main thread.
+		"""
+		with cls.lock:
+			written = [update_name for update_name, state in cls.written.get(path, ()) if update_name not in cls.writing]
+		# Clerk writes the state DB before it removes the queue files
+		gone = {update_name for update_name in written if not os.path.exists(update_name)}
+		if gone:
+			with cls.lock:
+				written = [w for w in cls.written.get(path, ()) if w[0] not in gone]
+				if written:
+					cls.written[path] = written
+				else:
+					cls.written.pop(path, None)
+
+	@staticmethod
+	def overlay(state, updates):
+		"""A copy of state (as read from a state DB) with updates laid over it."""
+		if not updates:
+			return state
+		state = dict(state)
+		for name, update in updates.items():
+			state[name] = dict(state.get(name) or {}, **update)
+		return state
+
+	@classmethod
+	def flush_soon(cls):
+		"""Have the writer flush now, without waiting for more updates."""
+		cls.hurry.set()
+
+	@classmethod
+	def run(cls):
+		while True:
+			cls.wakeup.wait()
+			# Give more updates a chance to be merged into this flush
+			cls.hurry.wait(config.journal.delay)
+			cls.wakeup.clear()
+			cls.hurry.clear()
+			cls.flush()
+
+	@classmethod
+	def flush(cls):
+		"""Write all pending updates; blocks until they are written."""
+		with cls.flush_lock:
+			with cls.lock:
+				pending, cls.pending = cls.pending, {}
+				# Remembered right away, so unmerged() never misses them
+				writes = [(os.path.join(path, dbs.QUEUE_DIR_NAME, str(uuid.uuid4())), path, state) for path, state in pending.items()]
+				for update_name, path, state in writes:
+					cls.written.setdefault(path, []).append((update_name, state))
+					cls.writing.add(update_name)
+			failed = False
+			for update_name, path, state in writes:
+				log.info(f'Writing {len(state)} state updates for {path}')
+				ok = dbs.json_write(update_name, state)
+				with cls.lock:
+					cls.writing.discard(update_name)
+					if not ok:
+						# Back to pending, under any updates made since, to retry
+						failed = True
+						written = [w for w in cls.written[path] if w[0] != update_name]
+						if written:
+							cls.written[path] = written
+						else:
+							del cls.written[path]
+						newer = cls.pending.setdefault(path, {})
+						for name, update in state.items():
+							newer[name] = dict(update, **newer.get(name, {}))
+
+			# Otherwise only pruned when a folder is read again
+			with cls.lock:
+				paths = list(cls.written)
+			for path in paths:
+				cls.prune(path)
+
+			if failed:
+				cls.wakeup.set()
+
+
+# Whatever way we exit, don't lose updates
+atexit.register(StateJournal.flush)
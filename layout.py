@@ -0,0 +1,151 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+import time
+import math
+from array import array
+
+import config
+import loghelper
+
+log = loghelper.get_logger('Layout', loghelper.Color.BrightBlack)
+
+
+
+class Tween:
+	"""A value that eases towards its target over config.menu.animation_time."""
+	def __init__(self, value=0.0):
+		self.start = self.target = float(value)
+		self.start_time = 0
+
+	def set(self, target, animate=True):
+		target = float(target)
+		if target == self.target:
+			return
+		now = time.monotonic()
+		self.start = self.value(now) if animate else target
+		self.target = target
+		self.start_time = now
+
+	def value(self, now=None):
+		t = self.progress(now)
+		if t >= 1:
+			return self.target
+		# Ease out (cubic)
+		t = 1 - (1 - t) ** 3
+		return self.start + (self.target - self.start) * t
+
+	def progress(self, now=None):
+		duration = config.menu.animation_time
+		if duration <= 0:
+			return 1
+		if now is None:
+			now = time.monotonic()
+		return min((now - self.start_time) / duration, 1)
+
+	@property
+	def animating(self):
+		return self.progress() < 1
+
+
+
+class Layout:
+	"""Tile grid of the menu. Positions are computed once per resize or change
+	of the number of tiles; per frame, only the scroll offset and selection
+	highlight are interpolated.
+	"""
+	def __init__(self):
+		self.key = None
+		self.count = 0
+		self.tiles_per_row = 1
+		self.rows = 1
+		self.xs = array('i')
+		self.ys = array('i')
+		self.scroll = Tween()
+		self.highlight_x = Tween()
+		self.highlight_y = Tween()
+		self.selected = None
+
+	def reset(self):
+		"""Forget the grid and selection, so the next frame jumps into place."""
+		self.key = None
+		self.selected = None
+		self.scroll.set(0, animate=False)
+
+	def update(self, width, height, count):
+		"""Recompute the grid for a width x height tile area with count tiles.
+		Returns whether anything changed.
+		"""
+		key = (width, height, count)
+		if key == self.key:
+			return False
+		self.key = key
+
+		tile_width = config.tile.width
+		tile_hspace = config.tile.min_hspace
+		self.tile_htotal = tile_width + tile_hspace
+
+		tile_height = config.tile.thumb_height + config.tile.text_vspace + int(config.tile.text_size * 1.65) * config.tile.text_lines
+		tile_vspace = config.tile.min_vspace
+		self.tile_vtotal = tile_height + tile_vspace
+
+		self.tiles_per_row = max(width // self.tile_htotal, 1)
+		tile_hoffset = (width - self.tiles_per_row * self.tile_htotal + tile_hspace) // 2
+
+		self.rows = max(height // self.tile_vtotal, 1)
+		self.top = height - (height - self.rows * self.tile_vtotal) // 2 - tile_vspace
+		self.height = height
+
+		# Position of every tile, relative to the top of an unscrolled grid
+		columns = [tile_hoffset + x * self.tile_htotal for x in range(self.tiles_per_row)]
+		self.xs = array('i', (columns[i % self.tiles_per_row] for i in range(count)))
+		self.ys = array('i', (-(i // self.tiles_per_row) * self.tile_vtotal for i in range(count)))
+		self.count = count
+
+		log.debug(f'Layout for {width}x{height}, {count} tiles: {self.tiles_per_row} x {self.rows}')
+
+		# Jump, don't animate, to the new positions
+		self.selected = None
+		return True
+
+	def follow(self, idx):
+		"""Scroll (animated) so tile idx is visible, and move the highlight to it."""
+		if idx is None or not self.count:
+			return
+
+		offset = self.scroll.target
+		row = idx // self.tiles_per_row
+		if row < offset:
+			offset = row
+		if row >= offset + self.rows:
+			offset = row - self.rows + 1
+		offset = max(min(offset, (self.count - 1) // self.tiles_per_row + 1 - self.rows), 0)
+
+		animate = self.selected is not None
+		self.scroll.set(offset, animate)
+		if idx != self.selected:
+			self.highlight_x.set(self.xs[idx], animate)
+			self.highlight_y.set(self.ys[idx], animate)
+			self.selected = idx
+
+	@property
+	def animating(self):
+		return self.scroll.animating or self.highlight_x.animating or self.highlight_y.animating
+
+	def visible(self):
+		"""(index, x, y) of every tile that is (partly) in view right now."""
+		scroll = self.scroll.value()
+		first = max(math.floor(scroll) * self.tiles_per_row, 0)
+		last = min(math.ceil(scroll + self.rows) * self.tiles_per_row, self.count)
+		dy = self.top + int(scroll * self.tile_vtotal)
+		xs, ys = self.xs, self.ys
+		for idx in range(first, last):
+			yield idx, xs[idx], ys[idx] + dy
+
+	def highlight(self):
+		"""Current position of the selection highlight."""
+		scroll = self.scroll.value()
+		return int(self.highlight_x.value()), int(self.highlight_y.value()) + self.top + int(scroll * self.tile_vtotal)
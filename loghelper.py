@@ -4,6 +4,14 @@
 # Licensed under GPL v2.0, or (at your option) any later version.
 # (SPDX GPL-2.0-or-later) See LICENSE file for details.
 
+# Records are only put on a queue by the threads that log them; a listener
+# thread formats and writes them. Hot paths pass arguments instead of
+# f-strings (log.debug('Scheduling %s', job)), so that nothing is formatted
+# for a level or logger that is disabled. Debug records are off by default:
+# the log files get level 15 (verbose) and up unless asked for less.
+
+import queue
+import atexit
 import logging
 import logging.handlers
 
@@ -46,26 +54,52 @@ Names = {}
 
 
 class ColoredFormatter(logging.Formatter):
+	format_string = '%(asctime)s %(levelcolor)s%(levelname)8s%(reset)s: %(namecolor)s%(name)20s.%(funcName)-20s%(reset)s -> %(message)s'
+
+	def __init__(self):
+		super().__init__()
+		self.formatters = {}  # {(levelno, name): logging.Formatter}
+
+	def formatter(self, levelno, name):
+		key = (levelno, name)
+		formatter = self.formatters.get(key)
+		if formatter is None:
+			level_color = ''
+			for l, c in Levels.items():
+				if levelno >= l:
+					level_color = c
+					break
+			name_color = Names.get(name, '')
+
+			format = self.format_string
+			format = format.replace('%(levelcolor)s', level_color).replace('%(namecolor)s', name_color).replace('%(reset)s', Color.Reset)
+			formatter = self.formatters[key] = logging.Formatter(format)
+		return formatter
+
 	def format(self, record):
-		level_color = ''
-		for l, c in Levels.items():
-			if record.levelno >= l:
-				level_color = c
-				break
-
-		name_color = Names.get(record.name, '')
-
-		format = '%(asctime)s %(levelcolor)s%(levelname)8s%(reset)s: %(namecolor)s%(name)20s.%(funcName)-20s%(reset)s -> %(message)s'
-		format = format.replace('%(levelcolor)s', level_color).replace('%(namecolor)s', name_color).replace('%(reset)s', Color.Reset)
-		formatter = logging.Formatter(format)
-		formatted = formatter.format(record)
+		formatted = self.formatter(record.levelno, record.name).format(record)
 		if 'FIXME' in formatted:
 			formatted = formatted.replace('FIXME', f'{Color.BrightRed}FIXME{Color.Reset}')
 		return formatted
 
 
 
-def set_up_logging(console_level=20, file_level=10, filename=None):
+class QueueHandler(logging.handlers.QueueHandler):
+	"""Puts records on the queue as they are. The stock prepare() formats
+	the message and copies the record on the logging thread, which is the
+	work the listener thread is there to take over. Arguments are formatted
+	later, so log values, not objects that change right after.
+	"""
+	def prepare(self, record):
+		return record
+
+
+
+def set_up_logging(console_level=20, file_level=15, filename=None, levels=None):
+	"""Log to the console, and to filename if given, from a background thread.
+	levels is {logger name: level}, to silence (the lower levels of) loggers;
+	those records aren't even created.
+	"""
 	logging.addLevelName(10, 'debug')
 	logging.addLevelName(15, 'verbose')
 	logging.addLevelName(20, 'info')
@@ -73,20 +107,38 @@ def set_up_logging(console_level=20, file_level=10, filename=None):
 	logging.addLevelName(40, 'error')
 	logging.addLevelName(50, 'critical')
 
-	logger = logging.getLogger()
-	logger.setLevel(logging.NOTSET)
-
+	handlers = []
 	if filename:
 		handler = logging.handlers.WatchedFileHandler(filename)
 		handler.setLevel(file_level)
 		format = '%(asctime)s %(levelname)8s: %(name)20s.%(funcName)-20s -> %(message)s'
 		handler.setFormatter(logging.Formatter(format))
-		logger.addHandler(handler)
+		handlers.append(handler)
 
 	handler = logging.StreamHandler()
 	handler.setLevel(console_level)
 	handler.setFormatter(ColoredFormatter())
-	logger.addHandler(handler)
+	handlers.append(handler)
+
+	# Records below what any handler wants are dropped at the log call
+	logger = logging.getLogger()
+	logger.setLevel(min(handler.level for handler in handlers))
+	for name, level in (levels or {}).items():
+		logging.getLogger(name).setLevel(level)
+
+	records = queue.SimpleQueue()
+	queue_handler = QueueHandler(records)
+	logger.addHandler(queue_handler)
+	listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+	listener.start()
+
+	def stop():
+		# Write out what is still queued; exit handlers that run after this one log directly
+		listener.stop()
+		logger.removeHandler(queue_handler)
+		for handler in handlers:
+			logger.addHandler(handler)
+	atexit.register(stop)
 
 
 
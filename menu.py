@@ -5,19 +5,27 @@
 # (SPDX GPL-2.0-or-later) See LICENSE file for details.
 
 import os  # FIXME
+import json
 import datetime
 import time
-import uuid
 import zipfile
+import functools
+import queue
 
 import loghelper
 import config
+import redraw
 import dbs
-from tile import Tile
+import worker
+from tile import Tile, TileModel
 from font import Font
 from worker import Pool
-from image import ImgLib
-from draw import FlatQuad
+from decor import Decorations
+from draw import Quad, FlatQuad
+from profiler import Profiler
+from layout import Layout
+from journal import StateJournal
+from prefetch import Prefetcher, Folder
 
 
 
@@ -28,15 +36,23 @@ log = loghelper.get_logger('Menu', loghelper.Color.Cyan)
 class Menu:
 	enabled = False
 	path = None
-	tiles = []
+	tiles = None
 	tiles_per_row = 1
 	current_idx = 0
-	current_offset = 0
 	menu_font = None
 	tile_font = None
 	breadcrumbs = []
 	bread_text = None
 	clock_text = None
+	db_stamps = {}
+	cover_db_name = None
+	covers_stamp = None
+	prefetched_size = dbs.COVER_DEFAULT_SIZE
+	prefetched_covers = {}
+	load_generation = 0
+	loading = False
+	select = None
+	last_refresh = 0
 
 	def __init__(self, path='/', enabled=False):
 		log.info(f'Created instance, path={path}, enabled={enabled}')
@@ -44,38 +60,252 @@ class Menu:
 		# FIXME: number of threads
 		self.render_pool = Pool('render', threads=3)
 		self.tile_pool = Pool('tile', threads=1)
+		self.released = []
+		self.new_tiles = []
+		self.messages = queue.SimpleQueue()
+		self.layout = Layout()
+		self.prefetcher = Prefetcher(self.read_folder, self.read_stamps)
 		self.tile_font = Font(config.tile.text_font, config.tile.text_size)
 		self.menu_font = Font(config.menu.text_font, config.menu.text_size)
+		self.tiles = TileModel(path, self.tile_font, self.render_pool, created=self.tile_created)
 		self.load(path)
 		self.enabled = enabled
 
-		ImgLib.add('Unseen', 'img/unseen.png', 48, 48, self.render_pool, shadow=(2, 12))
-		ImgLib.add('Watching', 'img/watching.png', 48, 48, self.render_pool, shadow=(2, 12))
-		ImgLib.add('Tagged', 'img/tagged.png', 48, 48, self.render_pool, shadow=(2, 12))
+		Decorations.load()
 
-		self.bread_text = self.menu_font.text(None, pool=self.render_pool)
-		self.clock_text = self.menu_font.text(None, pool=self.render_pool)
-		self.name_text = self.menu_font.text(None, lines=4, pool=self.render_pool)
-		self.duration_text = self.menu_font.text(None, pool=self.render_pool)
+		self.bread_text = self.menu_font.label(None, pool=self.render_pool)
+		self.clock_text = self.menu_font.label(None, pool=self.render_pool)
+		self.name_text = self.menu_font.text(None, lines=4, pool=self.render_pool, priority=worker.PRIORITY_HIGH)
+		self.duration_text = self.menu_font.label(None, pool=self.render_pool)
 
 	def open(self):
 		log.info('Opening Menu')
 		self.enabled = True
+		redraw.request('menu opened')
 
 	def close(self):
 		log.info('Closing Menu')
 		self.enabled = False
-
-	def load(self, path):
+		redraw.request('menu closed')
+
+	def poll(self):
+		"""Housekeeping that has to happen whether frames are drawn or not.
+		Called every main loop iteration; returns the number of seconds until
+		it wants to be called again.
+		"""
+		now = time.time()
+		if now - self.last_refresh > config.menu.refresh_interval:
+			self.last_refresh = now
+			self.tile_pool.schedule(self.refresh, priority=worker.PRIORITY_LOW)
+
+		# Results from the pools, to be applied on this thread
+		while True:
+			try:
+				message = self.messages.get_nowait()
+			except queue.Empty:
+				break
+			message()
+
+		if config.prefetch.enabled and self.tiles:
+			self.prefetch()
+
+		# Tiles dropped by refresh(); their textures can only be released from here
+		if self.released:
+			released = []
+			while self.released:
+				released.append(self.released.pop())
+			Tile.release_all_textures(released)
+
+		return self.last_refresh + config.menu.refresh_interval - now
+
+	def load(self, path, select=None):
+		"""Switch to path. Returns right away, with an empty grid; the folder
+		is read on the tile pool (unless it was prefetched) and applied by
+		apply_folder() through the message queue. Tile select is selected
+		if given, else the first "watching" or "unseen" one.
+		"""
 		self.forget()
 		log.info(f'Loading {path}')
 		# BENCHMARK
 		self.bench = time.time()
 
-		state_db_name = os.path.join(path, dbs.STATE_DB_NAME)
-		state = dbs.json_read(state_db_name, dbs.STATE_DB_SCHEMA)
+		self.load_generation += 1
+		self.path = path
+		self.tiles = TileModel(path, self.tile_font, self.render_pool, created=self.tile_created)
+		self.current_idx = 0
+		self.layout.reset()
+		self.select = select
+		self.loading = True
+		redraw.request('load')
+
+		folder = self.prefetcher.take(path)
+		if folder is not None:
+			self.apply_folder(folder, self.load_generation)
+		else:
+			self.tile_pool.schedule(functools.partial(self.read_async, path, self.load_generation), priority=worker.PRIORITY_HIGH)
+
+	def read_async(self, path, generation):
+		"""Runs on the tile pool."""
+		start = time.time()
+		try:
+			folder = self.read_folder(path)
+		except Exception as e:
+			# Still apply an empty folder, or we'd stay loading forever
+			log.error(f'Reading {path}: {e!r}')
+			folder = Folder(path, {}, [], {}, os.path.join(path, dbs.COVER_DB_NAME), None)
+		start = int((time.time() - start) * 1000); log.warning(f'Reading index: {start}ms')
+		self.post(functools.partial(self.apply_folder, folder, generation))
+
+	def apply_folder(self, folder, generation):
+		"""Make tiles of a Folder read by load(). Main thread only."""
+		if generation != self.load_generation:
+			log.info(f'Discarding stale {folder}')
+			return
+		self.loading = False
+
+		# Stamped before reading, so changes made since are picked up by the next refresh
+		self.db_stamps = folder.stamps
+		self.last_refresh = time.time()
+		self.cover_db_name, self.covers_stamp = folder.cover_db_name, folder.covers_stamp
+		self.prefetched_size, self.prefetched_covers = folder.cover_size, folder.covers
 
 		start = time.time()
+		self.tiles = TileModel.from_index(folder.path, folder.index, folder.state, self.tile_font, self.render_pool, created=self.tile_created)
+		# A prefetched folder may be older than our latest updates
+		self.tiles.apply_state(StateJournal.unmerged(folder.path))
+		start = int((time.time() - start) * 1000); log.warning(f'Loading metadata: {start}ms')
+		redraw.request('folder loaded')
+
+		self.current_idx = self.initial_index(folder.index, folder.state, self.select)
+
+	def post(self, message):
+		"""Have message (a callable) run on the main thread, from poll()."""
+		self.messages.put(message)
+		redraw.request('menu message')
+
+	@staticmethod
+	def initial_index(index, state, select=None):
+		"""Index of the entry a folder opens at: select if given, else the
+		first "watching" video, otherwise the first "unseen" one.
+		"""
+		binary = isinstance(index, dbs.BinaryIndex)
+		if select is not None:
+			if binary:
+				return index.find(select) or 0
+			return next((i for i, entry in enumerate(index) if entry['name'] == select), 0)
+
+		if binary:
+			# Only the names in state matter; don't decode all the others
+			watching = None
+			seen = set()
+			for name, entry in state.items():
+				position = (entry or {}).get('position', 0)
+				idx = index.find(name) if position != 0 else None
+				if idx is None:
+					continue
+				if 0 < position < 1 and (watching is None or idx < watching):
+					watching = idx
+				seen.add(idx)
+			if watching is not None:
+				return watching
+			return next((i for i in range(len(index)) if i not in seen), 0)
+
+		unseen = None
+		for i, entry in enumerate(index):
+			position = (state.get(entry['name']) or entry).get('position', 0)
+			if 0 < position < 1:
+				return i
+			if position == 0 and unseen is None:
+				unseen = i
+		return unseen or 0
+
+	@classmethod
+	def read_folder(cls, path, covers=0, select=None):
+		"""Read the DBs of path into a Folder, with the covers of the covers
+		entries around the one it opens at (see initial_index()).
+		The index and covers come from the bundle if Clerk wrote one: that
+		takes one open, and no looking at the DBs it copies. Else they come
+		from the separate DBs.
+		"""
+		# Stamp before reading, so changes made since are picked up by the next refresh
+		stamps = cls.read_stamps(path, (dbs.STATE_DB_NAME,))
+		state = cls.read_state(path)
+		folder = cls.read_bundle(path, stamps, state, covers, select)
+		if folder is not None:
+			return folder
+
+		stamps.update(cls.read_stamps(path, (dbs.INDEX_DB_NAME, dbs.INDEX_BIN_NAME, dbs.COVER_DB_NAME)))
+		cover_db_name = os.path.join(path, dbs.COVER_DB_NAME)
+		folder = Folder(path, stamps, cls.read_index(path, stamps), state, cover_db_name, stamps[dbs.COVER_DB_NAME])
+		if covers:
+			cls.read_ahead(folder, cover_db_name, covers, select)
+		return folder
+
+	@classmethod
+	def read_bundle(cls, path, stamps, state, covers=0, select=None):
+		"""A Folder read from the bundle of path (see read_folder()), None if
+		there is no usable one. stamps are those of the other DBs read.
+		"""
+		bundle_name = os.path.join(path, dbs.BUNDLE_NAME)
+		try:
+			with open(bundle_name, 'rb') as fd:
+				stat = os.fstat(fd.fileno())
+				bundle = dbs.Bundle(fd, bundle_name)
+				stamps = {**stamps, dbs.BUNDLE_NAME: (stat.st_mtime_ns, stat.st_size)}
+				cover_db_name = bundle_name if bundle.has_covers else os.path.join(path, dbs.COVER_DB_NAME)
+				folder = Folder(path, stamps, bundle.index, state, cover_db_name, bundle.sources[dbs.COVER_DB_NAME])
+				if covers and bundle.has_covers:
+					cls.read_ahead(folder, fd, covers, select)
+				return folder
+		except FileNotFoundError:
+			log.debug(f'No bundle {bundle_name}')
+		except (OSError, dbs.BundleError) as e:
+			log.warning(f'Reading {bundle_name}: {e}')
+		return None
+
+	@classmethod
+	def read_ahead(cls, folder, cover_db, covers, select=None):
+		"""Read the covers of the covers entries of folder around the one it
+		opens at from cover_db, a file name or open file.
+		"""
+		count = len(folder.index)
+		start = max(cls.initial_index(folder.index, folder.state, select) - covers // 2, 0)
+		start = max(min(start, count - covers), 0)
+		try:
+			with zipfile.ZipFile(cover_db, 'r') as fd:
+				folder.cover_size = cls.cover_size(fd)
+				for i in range(start, min(start + covers, count)):
+					name = folder.index[i]['name']
+					cover = Tile.read_cover(fd, name, folder.cover_size)
+					if cover is not None:
+						folder.covers[name] = cover
+		except (OSError, zipfile.BadZipFile) as e:
+			log.warning(f'Reading covers from {folder.cover_db_name}: {e}')
+
+	@staticmethod
+	def read_state(path):
+		"""The state DB of path, with our updates that Clerk hasn't merged yet."""
+		unmerged = StateJournal.unmerged(path, prune=True)
+		state = dbs.json_read(os.path.join(path, dbs.STATE_DB_NAME), dbs.STATE_DB_SCHEMA)
+		return StateJournal.overlay(state, unmerged)
+
+	@staticmethod
+	def read_index(path, stamps):
+		"""The index of path: the binary one from Clerk if it is there,
+		intact and made from the current JSON one (as stamped in stamps), else
+		the JSON one, else a scandir() of path.
+		"""
+		index_bin_name = os.path.join(path, dbs.INDEX_BIN_NAME)
+		try:
+			index = dbs.BinaryIndex.open(index_bin_name)
+			if index.source == dbs.source_stamp(stamps[dbs.INDEX_DB_NAME]):
+				return index
+			log.info(f'{index_bin_name} is older than {dbs.INDEX_DB_NAME}, not using it')
+		except FileNotFoundError:
+			log.debug(f'No binary index {index_bin_name}')
+		except (OSError, dbs.BinaryIndexError) as e:
+			log.warning(f'Reading {index_bin_name}: {e}')
+
 		index_db_name = os.path.join(path, dbs.INDEX_DB_NAME)
 		index = dbs.json_read(index_db_name, dbs.INDEX_DB_SCHEMA, default=None)
 		if index is None:
@@ -84,107 +314,202 @@ class Menu:
 			for isfile, name in sorted((not de.is_dir(), de.name) for de in os.scandir(path)):
 				if not name.startswith('.') and name.endswith(dbs.VIDEO_EXTENSIONS):
 					index.append({'name': name, 'isdir': not isfile})
-		else:
-			index = index['files']
-		start = int((time.time() - start) * 1000); log.warning(f'Reading index: {start}ms')
-
-		self.path = path
-		self.tiles = []
-		start = time.time()
-		for entry in index:
-			name = entry['name']
-			isdir = entry['isdir']
-			self.tiles.append(Tile(path, name, isdir, self, self.tile_font, self.render_pool))
-		start = int((time.time() - start) * 1000); log.warning(f'Creating tiles: {start}ms')
+			return index
+		return index['files']
+
+	@staticmethod
+	def read_stamps(path, db_names):
+		"""Return {db_name: (mtime, size)} for db_names of path, None for missing ones."""
+		stamps = {}
+		for db_name in db_names:
+			try:
+				stat = os.stat(os.path.join(path, db_name))
+				stamps[db_name] = (stat.st_mtime_ns, stat.st_size)
+			except OSError:
+				stamps[db_name] = None
+		return stamps
+
+	def refresh(self):
+		"""Pick up changes to the index, state and cover DBs of the current
+		folder, instead of reloading the whole folder. Builds a new model;
+		apply_refresh() then carries the existing Tiles, their textures and
+		the selection over to it. Runs on the tile pool.
+		"""
+		path, tiles = self.path, self.tiles
+		if path is None or self.loading:
+			return
 
-		start = time.time()
-		for tile, entry in zip(self.tiles, index):
-			meta = {**entry, **state.get(tile.name, {})}
-			tile.update_meta(meta)
-		start = int((time.time() - start) * 1000); log.warning(f'Updating meta: {start}ms')
+		# Only the DBs the folder was read from
+		stamps = self.read_stamps(path, self.db_stamps.keys())
+		changed = {db_name for db_name, stamp in stamps.items() if stamp != self.db_stamps[db_name]}
+		if not changed:
+			return
+		log.info(f'Refreshing {path}, changed: {sorted(changed)}')
 
-		self.tile_pool.schedule(self.load_covers)
+		if changed == {dbs.STATE_DB_NAME}:
+			# Keep the index and covers we have
+			folder = Folder(path, stamps, tiles.entries, self.read_state(path), self.cover_db_name, self.covers_stamp)
+		else:
+			folder = self.read_folder(path)
+		covers_changed = (folder.cover_db_name, folder.covers_stamp) != (self.cover_db_name, self.covers_stamp)
+		new = TileModel.from_index(path, folder.index, folder.state, self.tile_font, self.render_pool, created=self.tile_created)
+
+		# Existing Tiles (and their textures) are kept, unless the entry is gone
+		removed = set()
+		update_covers = set()
+		for name, idx in tiles.index.items():
+			new_idx = new.index.get(name)
+			if new_idx is None or new.isdir[new_idx] != tiles.isdir[idx]:
+				removed.add(name)
+			elif covers_changed or new.entries[new_idx] != tiles.entries[idx]:
+				update_covers.add(name)
+		log.info(f'Refresh: {len(new.index.keys() - tiles.index.keys())} added, {len(removed)} removed')
+
+		# Tiles are created and drawn by the main thread, so swap it in there
+		self.post(functools.partial(self.apply_refresh, tiles, new, removed, update_covers, folder.stamps, folder.cover_db_name, folder.covers_stamp))
+
+	def apply_refresh(self, tiles, new, removed, update_covers, stamps, cover_db_name, covers_stamp):
+		"""Swap in the model built by refresh(). Main thread only."""
+		# The user may have navigated away while we were reading
+		if self.tiles is not tiles:
+			log.info(f'Refresh of {new.path} is stale, discarding')
+			return
 
-		self.current_idx = 0
-		self.current_offset = 0
+		# Updates made while refresh() was reading
+		new.apply_state(StateJournal.unmerged(new.path))
+
+		current = tiles.names[self.current_idx] if len(tiles) else None
+		for name, tile in tiles.views.items():
+			if name in removed:
+				self.released.append(tile)
+			else:
+				new.adopt(tile)
+		self.tiles = new
+		self.current_idx = self.index_of(current, self.current_idx) if current else 0
+		self.db_stamps = stamps
+		self.cover_db_name, self.covers_stamp = cover_db_name, covers_stamp
+		self.prefetched_covers = {}
+
+		update_covers = [new.views[name] for name in update_covers if name in new.views]
+		if update_covers:
+			self.tile_pool.schedule(functools.partial(self.load_covers, update_covers), priority=worker.PRIORITY_LOW)
+
+	def prefetch(self):
+		"""Have the prefetcher read the selected folder, its neighbours and the parent."""
+		tiles, idx = self.tiles, self.current_idx
+		paths = []
+		for i in (idx, idx + 1, idx - 1):
+			if 0 <= i < len(tiles) and tiles.isdir[i]:
+				paths.append((os.path.join(self.path, tiles.names[i]), None))
+		if self.breadcrumbs:
+			# back() reopens the parent at this folder
+			paths.append((os.path.dirname(self.path), os.path.basename(self.path)))
+		self.prefetcher.want(paths)
+
+	def tile_created(self, tile):
+		self.new_tiles.append(tile)
+
+	def index_of(self, name, default=0):
+		try:
+			return self.tiles.index[name]
+		except KeyError:
+			return min(default, max(len(self.tiles) - 1, 0))
 
-		# Find first "watching" video
-		for i, tile in enumerate(self.tiles):
-			if tile.watching:
-				self.current_idx = i
-				return
+	def load_covers(self, tiles):
+		start = time.time()
 
-		# Otherwise, find first "unseen" video
-		for i, tile in enumerate(self.tiles):
-			if tile.unseen:
-				self.current_idx = i
+		# Read ahead by the prefetcher, if this folder came from there
+		if self.prefetched_covers:
+			prefetched, remaining = self.prefetched_covers, []
+			for tile in tiles:
+				cover = prefetched.pop(tile.name, None)
+				if cover is not None:
+					tile.set_cover(*cover, self.prefetched_size)
+				else:
+					remaining.append(tile)
+			tiles = remaining
+			if not tiles:
 				return
 
-	def load_covers(self):
-		start = time.time()
-		cover_db_name = os.path.join(self.path, '.fabella', 'covers.zip')
+		cover_db_name = self.cover_db_name
 		try:
 			with zipfile.ZipFile(cover_db_name, 'r') as fd:
-				for tile in self.tiles:
-					tile.update_cover(fd)
-		except OSError as e:
+				size = self.cover_size(fd)
+				for tile in tiles:
+					tile.update_cover(fd, size)
+		except (OSError, zipfile.BadZipFile) as e:
 			log.error(f'Parsing cover DB {cover_db_name}: {e}')
 		start = int((time.time() - start) * 1000); log.warning(f'Updating covers: {start}ms')
 
+	@staticmethod
+	def cover_size(covers_zip):
+		"""The cover variant in covers_zip that best fits our tiles."""
+		try:
+			meta = json.loads(covers_zip.read(dbs.COVER_META_TAG))
+			sizes = [tuple(int(d) for d in size.split('x')) for size in meta.get('sizes', [])]
+		except (KeyError, ValueError, AttributeError) as e:
+			log.warning(f'Reading cover sizes: {e}')
+			sizes = []
+		return dbs.closest_cover_size(sizes, config.tile.width, config.tile.thumb_height)
+
 	def forget(self):
 		log.info('Forgetting tiles')
 		self.tile_pool.flush()
 		self.render_pool.flush()
-		Tile.release_all_textures(self.tiles)
-		self.tiles = []
+		Tile.release_all_textures(list(self.tiles.views.values()) + self.released)
+		self.tiles = TileModel(self.path, self.tile_font, self.render_pool, created=self.tile_created)
+		self.released = []
+		self.new_tiles = []
 		self.current_idx = None
 
 	@property
 	def current(self):
 		return self.tiles[self.current_idx]
 
-	def previous_row(self):
-		log.info('Select previous row')
-		if self.current_idx >= self.tiles_per_row:
-			self.current_idx -= self.tiles_per_row
+	def previous_row(self, count=1):
+		log.info('Select previous row (x%d)', count)
+		rows = min(count, self.current_idx // self.tiles_per_row)
+		self.current_idx -= rows * self.tiles_per_row
 
-	def next_row(self):
-		log.info('Select next row')
-		if self.current_idx // self.tiles_per_row < (len(self.tiles) - 1) // self.tiles_per_row:
+	def next_row(self, count=1):
+		log.info('Select next row (x%d)', count)
+		rows = min(count, (len(self.tiles) - 1) // self.tiles_per_row - self.current_idx // self.tiles_per_row)
+		if rows > 0:
 			self.current_idx = min(
 				len(self.tiles) - 1,
-				self.current_idx + self.tiles_per_row
+				self.current_idx + rows * self.tiles_per_row
 			)
 
-	def previous(self):
-		log.info('Select previous')
+	def previous(self, count=1):
+		log.info('Select previous (x%d)', count)
 		if self.current_idx > 0:
-			self.current_idx -= 1
+			self.current_idx = max(self.current_idx - count, 0)
 
-	def next(self):
-		log.info('Select next')
+	def next(self, count=1):
+		log.info('Select next (x%d)', count)
 		if self.current_idx < len(self.tiles) - 1:
-			self.current_idx += 1
+			self.current_idx = min(self.current_idx + count, len(self.tiles) - 1)
 
 	def toggle_seen(self):
-		self.current.toggle_seen()
+		if self.tiles:
+			self.current.toggle_seen()
 
 	def toggle_seen_all(self):
-		position = 1 if any(t.unseen and not t.isdir for t in self.tiles) else 0
-		state = {}
-		for tile in self.tiles:
-			if not tile.isdir:
-				tile.position = position
-				state[tile.name] = {'position': position}
-
-		update_name = os.path.join(self.path, dbs.QUEUE_DIR_NAME, str(uuid.uuid4()))
-		dbs.json_write(update_name, state)
+		tiles = self.tiles
+		files = [i for i, isdir in enumerate(tiles.isdir) if not isdir]
+		position = 1 if any(tiles.positions[i] == 0 for i in files) else 0
+		for i in files:
+			tiles.positions[i] = position
+			StateJournal.update(self.path, tiles.names[i], {'position': position})
 
 	def toggle_tagged(self):
-		self.current.toggle_tagged()
+		if self.tiles:
+			self.current.toggle_tagged()
 
 	def enter(self, video):
 		log.info('Enter')
+		if not self.tiles:
+			return
 		tile = self.current
 		if tile.isdir:
 			self.breadcrumbs.append(tile.name)
@@ -218,68 +543,44 @@ class Menu:
 		new = os.path.dirname(self.path)
 		if not new:
 			return
-		previous = os.path.basename(self.path)
-		self.load(new)
-		for i, tile in enumerate(self.tiles):
-			if tile.name == previous:
-				self.current_idx = i
-				break
+		self.load(new, select=os.path.basename(self.path))
 
 	def draw(self, width, height, transparent=False):
-		# FIXME: really not the place for this
-		if int(time.time() * 1000) % 97 == 0:
-			self.tile_pool.schedule(self.load_covers)
-
 		# Background
 		FlatQuad((0, 0, width, height), 100, (0, 0, 0, 0.66) if transparent else config.menu.background_color)
 
-		if self.bench and self.tiles:
-			t = self.tiles[-1]
-			if t.title and t.title.rendered:
-				log.warning(f'Rendering: {int((time.time() - self.bench) * 1000)}ms')
-				self.bench = None
-
 		self.draw_header(width, height)
 
-		tile_width = config.tile.width
-		tile_hspace = config.tile.min_hspace
-		tile_htotal = tile_width + tile_hspace
+		# FIXME: yuck
+		height -= int(config.menu.header_vspace + config.menu.text_size * 1.65)
+		Profiler.mark('submit')
+		self.layout.update(width, height, len(self.tiles))
+		# Partly visible rows must not slide over the header
+		Quad.clip(200, 300, (0, 0, width, height))
+		# Hmm, this is kinda dirty. But I need this in other places.
+		self.tiles_per_row = self.layout.tiles_per_row
 
-		tile_height = config.tile.thumb_height + config.tile.text_vspace + int(config.tile.text_size * 1.65) * config.tile.text_lines
-		tile_vspace = config.tile.min_vspace
-		tile_vtotal = tile_height + tile_vspace
+		self.layout.follow(self.current_idx)
+		Profiler.mark('layout')
+		tile = None
+		for idx, x, y in self.layout.visible():
+			tile = self.tiles[idx]
+			tile.draw(x, y, idx == self.current_idx)
 
-		tiles_per_row = max(width // tile_htotal, 1)
-		tile_hoffset = (width - tiles_per_row * tile_htotal + tile_hspace) // 2
-		# Hmm, this is kinda dirty. But I need this in other places.
-		self.tiles_per_row = tiles_per_row
+		if self.bench and tile and tile.title.rendered:
+			log.warning(f'Rendering: {int((time.time() - self.bench) * 1000)}ms')
+			self.bench = None
 
-		# FIXME: yuck
-		height -= int(config.menu.header_vspace + config.menu.text_size * 1.65)
-		tile_rows = max(height // tile_vtotal, 1)
-		tile_voffset = (height - tile_rows * tile_vtotal) // 2 + tile_vspace
-
-		# Fix offset
-		while self.current_idx // tiles_per_row < self.current_offset:
-			self.current_offset -= 1
-
-		while self.current_idx // tiles_per_row >= (self.current_offset + tile_rows):
-			self.current_offset += 1
-
-		if self.current_offset > (len(self.tiles) - 1) // tiles_per_row + 1 - tile_rows:
-			self.current_offset = (len(self.tiles) - 1) // tiles_per_row + 1 - tile_rows
-
-		if self.current_offset < 0:
-			self.current_offset = 0
-
-		for y in range(tile_rows):
-			for x in range(tiles_per_row):
-				idx = y * tiles_per_row + x + self.current_offset * tiles_per_row
-				try:
-					tile = self.tiles[idx]
-				except IndexError:
-					break
-				tile.draw(tile_hoffset + x * tile_htotal, height - tile_voffset - y * tile_vtotal, idx == self.current_idx)
+		# Covers of the tiles that came into view for the first time
+		if self.new_tiles:
+			self.tile_pool.schedule(functools.partial(self.load_covers, self.new_tiles))
+			self.new_tiles = []
+
+		if self.tiles:
+			Tile.draw_highlight(*self.layout.highlight())
+
+		if self.layout.animating:
+			redraw.request('menu animation')
 
 	def draw_header(self, width, height):
 		# Breadcrumbs
@@ -0,0 +1,96 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+import threading
+import functools
+import collections
+
+import config
+import loghelper
+import dbs
+from worker import Pool
+
+log = loghelper.get_logger('Prefetch', loghelper.Color.BrightBlack)
+
+
+
+class Folder:
+	"""Everything read from the DBs of a folder, before tiles are made of it."""
+	def __init__(self, path, stamps, index, state, cover_db_name, covers_stamp):
+		self.path = path
+		self.stamps = stamps
+		self.index = index
+		self.state = state
+		self.cover_db_name = cover_db_name
+		self.covers_stamp = covers_stamp
+		# Covers read ahead: {name: (mode, width, height, data)}, of size cover_size
+		self.cover_size = dbs.COVER_DEFAULT_SIZE
+		self.covers = {}
+
+	def __str__(self):
+		return f'Folder({self.path}, {len(self.index)} entries, {len(self.covers)} covers)'
+
+	def __repr__(self):
+		return self.__str__()
+
+
+
+class Prefetcher:
+	"""Reads the folders the user is likely to enter next, on its own thread,
+	so entering them is served from memory.
+	read(path, covers, select) returns a Folder; stamp(path, db_names) the
+	stamps of those DBs of path, to tell whether a cached Folder is still current.
+	"""
+	def __init__(self, read, stamp):
+		self.read = read
+		self.stamp = stamp
+		self.pool = Pool('prefetch', threads=1)
+		self.cache = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.generation = 0
+		self.wanted = ()
+
+	def want(self, paths):
+		"""Prefetch paths, (path, entry it would open at or None) tuples, most
+		wanted first. Prefetches of other paths that have not started yet are
+		cancelled.
+		"""
+		paths = tuple(paths)
+		if paths == self.wanted:
+			return
+		log.debug('Prefetching %s', paths)
+		self.wanted = paths
+		self.generation += 1
+		self.pool.flush()
+		for path, select in paths:
+			self.pool.schedule(functools.partial(self.fetch, path, select, self.generation))
+
+	def fetch(self, path, select, generation):
+		if generation != self.generation:
+			return
+
+		with self.lock:
+			folder = self.cache.get(path)
+		if folder is not None and folder.stamps == self.stamp(path, folder.stamps.keys()):
+			with self.lock:
+				if path in self.cache:
+					self.cache.move_to_end(path)
+			return
+
+		folder = self.read(path, covers=config.prefetch.covers, select=select)
+		log.info(f'Prefetched {folder}')
+		with self.lock:
+			self.cache[path] = folder
+			while len(self.cache) > config.prefetch.folders:
+				self.cache.popitem(last=False)
+
+	def take(self, path):
+		"""Return (and forget) the prefetched Folder for path, or None."""
+		with self.lock:
+			folder = self.cache.pop(path, None)
+		if folder is not None:
+			log.info(f'Serving {folder} from memory')
+		return folder
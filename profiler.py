@@ -0,0 +1,159 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+# Frame profiler: CPU (wall clock) time per frame, split by phase of the main
+# loop, for the last config.profiler.frames frames. Optionally drawn as a
+# graph over everything else; percentiles are logged on exit.
+
+import time
+import json
+import atexit
+import collections
+
+import config
+import loghelper
+from draw import Quad, FlatQuad
+
+log = loghelper.get_logger('Profiler', loghelper.Color.BrightBlack)
+
+# Phases, in main loop order, with their colors in the HUD
+PHASES = {
+	'events': (0.6, 0.6, 0.6, 0.8),
+	'poll': (0.3, 0.8, 0.8, 0.8),
+	'video': (0.9, 0.3, 0.3, 0.8),
+	'upload': (0.9, 0.7, 0.2, 0.8),
+	'layout': (0.7, 0.9, 0.3, 0.8),
+	'submit': (0.3, 0.8, 0.3, 0.8),
+	'draw': (0.3, 0.5, 1.0, 0.8),
+	'swap': (0.7, 0.3, 0.9, 0.8),
+}
+
+
+
+def percentiles(values, ps=(50, 95, 99)):
+	"""The ps percentiles of values, sorting them only once."""
+	if not values:
+		return (0.0,) * len(ps)
+	values = sorted(values)
+	return tuple(values[min(int(len(values) * p / 100), len(values) - 1)] for p in ps)
+
+
+
+class Profiler:
+	frames = collections.deque(maxlen=config.profiler.frames)
+	totals = collections.deque(maxlen=config.profiler.frames)  # Sum of the phases of each frame
+	drawn = collections.deque(maxlen=config.profiler.frames)  # (quads, batches) per frame
+	latencies = collections.deque(maxlen=config.profiler.frames)  # From a key press to its frame being swapped
+	input_time = None
+	current = None
+	last = 0
+	hud = config.profiler.hud
+	hud_label = None  # Label for the HUD's numbers; set by whoever has a font
+	hud_frame = None  # Last frame the label's numbers include
+
+	@classmethod
+	def begin(cls):
+		"""Start timing a frame; time until the first mark() counts as 'events'."""
+		cls.current = dict.fromkeys(PHASES, 0.0)
+		cls.last = time.perf_counter()
+
+	@classmethod
+	def mark(cls, phase):
+		"""The time since the previous mark() (or begin()) was spent on phase."""
+		if cls.current is None:
+			return
+		now = time.perf_counter()
+		cls.current[phase] += now - cls.last
+		cls.last = now
+
+	@classmethod
+	def end(cls):
+		if cls.current is not None:
+			cls.frames.append(cls.current)
+			cls.totals.append(sum(cls.current.values()))
+			cls.drawn.append(Quad.drawn)
+			if cls.input_time is not None:
+				cls.latencies.append(time.perf_counter() - cls.input_time)
+				cls.input_time = None
+		cls.current = None
+
+	@classmethod
+	def pressed(cls, late=0.0):
+		"""A key was pressed, late seconds ago; the next frame shows its effect."""
+		if cls.input_time is None:
+			cls.input_time = time.perf_counter() - late
+
+	@classmethod
+	def cancel(cls):
+		"""No frame after all (nothing to draw)."""
+		cls.current = None
+
+	@classmethod
+	def toggle_hud(cls):
+		cls.hud = not cls.hud
+		log.info(f'HUD {"on" if cls.hud else "off"}')
+
+	@classmethod
+	def stats(cls):
+		"""{phase: (p50, p95, p99)} in seconds, 'total' being the whole frame."""
+		frames = list(cls.frames)
+		series = {phase: [frame[phase] for frame in frames] for phase in PHASES}
+		series['total'] = list(cls.totals)
+		return {phase: percentiles(values) for phase, values in series.items()}
+
+	@classmethod
+	def report(cls):
+		if not cls.frames:
+			return
+		log.info(f'Frame times over the last {len(cls.frames)} frames (p50 / p95 / p99):')
+		for phase, values in cls.stats().items():
+			log.info(f'  {phase:>7}: ' + ' / '.join(f'{v * 1000:.2f}ms' for v in values))
+		if cls.latencies:
+			log.info('  latency: ' + ' / '.join(f'{v * 1000:.2f}ms' for v in percentiles(cls.latencies)))
+		for i, name in enumerate(['quads', 'batches']):
+			counts = [drawn[i] for drawn in cls.drawn]
+			log.info(f'  {name:>7}: ' + ' / '.join(str(v) for v in percentiles(counts)))
+
+	@classmethod
+	def dump(cls, filename):
+		"""Write every recorded frame, and the percentiles, to filename as JSON."""
+		frames = [dict(frame, quads=quads, batches=batches) for frame, (quads, batches) in zip(cls.frames, cls.drawn)]
+		with open(filename, 'w') as fd:
+			json.dump({'frames': frames, 'latencies': list(cls.latencies), 'percentiles': cls.stats()}, fd, indent=4)
+		log.info(f'Wrote {len(frames)} frames to {filename}')
+
+	@classmethod
+	def draw_hud(cls, width):
+		if not cls.hud:
+			return
+
+		# One stacked bar per frame, 1px per 0.1ms; the line is 60fps
+		scale = 10000
+		x2 = width - 16
+		y = 16
+		bar = max(1, min(4, (width // 3) // config.profiler.frames))
+		x1 = x2 - bar * config.profiler.frames
+		FlatQuad((x1, y, x2, y + 1000 / 60 * 10), 1000, (0, 0, 0, 0.5))
+		for i, frame in enumerate(cls.frames):
+			x = x1 + i * bar
+			bottom = y
+			for phase, color in PHASES.items():
+				top = bottom + frame[phase] * scale
+				if top > bottom:
+					FlatQuad((x, bottom, x + bar, top), 1001, color)
+				bottom = top
+		FlatQuad((x1, y + 1000 / 60 * 10, x2, y + 1000 / 60 * 10 + 1), 1002, (1, 1, 1, 0.8))
+
+		if cls.hud_label is not None and cls.frames:
+			# Only the totals, and only once per new frame
+			if cls.hud_frame is not cls.frames[-1]:
+				cls.hud_frame = cls.frames[-1]
+				p50, p95, p99 = percentiles(cls.totals)
+				cls.hud_label.text = f'{p50 * 1000:.1f}  {p95 * 1000:.1f}  {p99 * 1000:.1f} ms'
+			cls.hud_label.as_quad(-(width - 16), y + 1000 / 60 * 10 + 8, 1002)
+
+
+atexit.register(Profiler.report)
@@ -0,0 +1,46 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+# Frames are only drawn when something asked for one: input, a finished
+# render job, a changed label, a new video frame. Anything may call request(),
+# from any thread; it wakes up the main loop if it is waiting for events.
+
+import threading
+
+import loghelper
+
+log = loghelper.get_logger('Redraw', loghelper.Color.BrightBlack)
+
+
+
+requested = threading.Event()
+requested.set()
+
+# Wakes up the window's event wait; set by the window
+wakeup = None
+
+
+
+def request(reason=None):
+	"""Ask for a new frame. Thread-safe."""
+	if not requested.is_set():
+		log.debug('Redraw requested: %s', reason)
+		requested.set()
+		if wakeup:
+			wakeup()
+
+
+
+def pending():
+	return requested.is_set()
+
+
+
+def consume():
+	"""Called by the main loop right before it draws a frame.
+	Requests made while the frame is being drawn will cause another frame.
+	"""
+	requested.clear()
@@ -0,0 +1,92 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+# Recording and replaying key events, to repeat a session against different
+# builds. A recording is a JSON array per line:
+# [seconds since the start, key, scancode, action, modifiers]
+
+import json
+import time
+
+import loghelper
+
+log = loghelper.get_logger('Replay', loghelper.Color.BrightBlack)
+
+
+
+class Recorder:
+	def __init__(self, filename):
+		log.info(f'Recording key events to {filename}')
+		self.filename = filename
+		# Line buffered; quitting is an exit() from the middle of the main loop
+		self.fd = open(filename, 'w', buffering=1)
+		self.start = time.monotonic()
+
+	def record(self, event):
+		key, scancode, action, modifiers = event
+		self.fd.write(json.dumps([round(time.monotonic() - self.start, 4), key, scancode, action, modifiers]) + '\n')
+
+	def close(self):
+		self.fd.close()
+
+	def __str__(self):
+		return f'Recorder({self.filename})'
+
+	def __repr__(self):
+		return self.__str__()
+
+
+
+class Replayer:
+	"""Hands out the events of a recording at their recorded times, divided by
+	speed. The clock starts at the first call to timeout() or due().
+	"""
+	def __init__(self, filename, speed=1.0):
+		self.filename = filename
+		self.speed = speed
+		self.start = None
+		self.events = []
+		with open(filename) as fd:
+			for number, line in enumerate(fd, 1):
+				if not line.strip():
+					continue
+				try:
+					t, key, scancode, action, modifiers = json.loads(line)
+					self.events.append((t / speed, (key, scancode, action, modifiers)))
+				except (ValueError, TypeError) as e:
+					raise ValueError(f'{filename}:{number}: {e}')
+		self.events.reverse()
+		log.info(f'Replaying {len(self.events)} key events from {filename} at {speed}x')
+
+	def elapsed(self):
+		if self.start is None:
+			self.start = time.monotonic()
+		return time.monotonic() - self.start
+
+	def timeout(self):
+		"""Seconds until the next event is due; None when all were handed out."""
+		if not self.events:
+			return None
+		return max(self.events[-1][0] - self.elapsed(), 0)
+
+	def due(self):
+		"""(event, seconds since it was due) for the events that are due by now, in order."""
+		elapsed = self.elapsed()
+		events = []
+		while self.events and self.events[-1][0] <= elapsed:
+			t, event = self.events.pop()
+			events.append((event, elapsed - t))
+		return events
+
+	@property
+	def done(self):
+		return not self.events
+
+	def __str__(self):
+		return f'Replayer({self.filename}, {len(self.events)} events left)'
+
+	def __repr__(self):
+		return self.__str__()
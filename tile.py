@@ -7,152 +7,369 @@
 import os
 import time
 import math
-import uuid
 import OpenGL.GL as gl
 import functools
+from array import array
 
 import dbs
 import config
 import loghelper
-from image import Image, ImgLib
+from image import Image
+from decor import Decorations
 from draw import FlatQuad, TexturedQuad
+from upload import Uploader
+from journal import StateJournal
 
 log = loghelper.get_logger('Tile', loghelper.Color.Cyan)
 
 
 
-# FIXME: UGH
-shadow_blursize = 32
-shadow_expand = 4
-shadow_img = None
-shadow_texture = None
+# Packed 0xRRGGBB tile colors, and these
+UNKNOWN_COLOR = -1  # Not in the index (yet)
+NO_COLOR = -2  # No cover to take a color from
+# Durations: NaN if unknown, this if not in the index (yet)
+NO_DURATION = -1.0
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_color(color):
+	"""Index tile_color '#rrggbb' (or None) to a packed color."""
+	if color is None:
+		return NO_COLOR
+	try:
+		return int(color.strip('#')[:6], 16)
+	except ValueError:
+		log.warning(f'Invalid tile color: {color}')
+		return NO_COLOR
 
-def get_shadow():
-	global shadow_img, shadow_texture
-	if shadow_texture is not None:
-		return shadow_texture
 
-	import PIL.Image, PIL.ImageFilter
-	w, h = config.tile.width + shadow_blursize * 2, config.tile.thumb_height + shadow_blursize * 2
+@functools.lru_cache(maxsize=4096)
+def unpack_color(color):
+	if color == UNKNOWN_COLOR:
+		return (0, 0, 0, 1)
+	if color == NO_COLOR:
+		return (0.3, 0.3, 0.3, 1)
+	return ((color >> 16) / 255, ((color >> 8) & 255) / 255, (color & 255) / 255, 1)
 
-	shadow_img = PIL.Image.new('RGBA', (w, h), (255, 255, 255, 0))
-	shadow_img.paste((255, 255, 255, 255), (shadow_blursize - shadow_expand, shadow_blursize - shadow_expand, w - shadow_blursize + shadow_expand, h - shadow_blursize + shadow_expand))
-	shadow_img = shadow_img.filter(PIL.ImageFilter.GaussianBlur((shadow_blursize - shadow_expand) // 2))
-	#shadow_img.paste((255, 255, 255, 255), (shadow_blursize, shadow_blursize, w - shadow_blursize, h - shadow_blursize))
-	#shadow_img = shadow_img.filter(PIL.ImageFilter.GaussianBlur(shadow_blursize // 3))
 
-	shadow_texture = gl.glGenTextures(1)
-	gl.glBindTexture(gl.GL_TEXTURE_2D, shadow_texture)
-	gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
-	gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
-	gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, w, h, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, shadow_img.tobytes())
-	gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-	return shadow_texture
 
-# FIXME: UGH
-hl_blursize = 19
-hl_expand = 10
-hl_img = None
-hl_texture = None
+# Marks values of a LazyColumn not computed yet; None is a value like any other
+_NOT_COMPUTED = object()
 
-def get_hl():
-	global hl_img, hl_texture
-	if hl_texture is not None:
-		return hl_texture
 
-	import PIL.Image, PIL.ImageFilter
-	w, h = config.tile.width + hl_blursize * 2, config.tile.thumb_height + hl_blursize * 2
 
-	hl_img = PIL.Image.new('RGBA', (w, h), (255, 255, 255, 0))
-	hl_img.paste((255, 255, 255, 255), (hl_blursize - hl_expand, hl_blursize - hl_expand, w - hl_blursize + hl_expand, h - hl_blursize + hl_expand))
-	hl_img = hl_img.filter(PIL.ImageFilter.GaussianBlur((hl_blursize - hl_expand) // 2))
-	#hl_img.paste((255, 255, 255, 255), (hl_blursize, hl_blursize, w - hl_blursize, h - hl_blursize))
-	#hl_img = hl_img.filter(PIL.ImageFilter.GaussianBlur(hl_blursize // 3))
+class LazyColumn:
+	"""A column of a TileModel whose values are computed on first access,
+	for models straight from a binary index. Can be assigned to like an array.
+	"""
+	def __init__(self, count, compute):
+		self.count = count
+		self.compute = compute
+		self.values = {}
 
-	hl_texture = gl.glGenTextures(1)
-	gl.glBindTexture(gl.GL_TEXTURE_2D, hl_texture)
-	gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
-	gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
-	gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, w, h, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, hl_img.tobytes())
-	gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-	return hl_texture
+	def __len__(self):
+		return self.count
 
+	def __getitem__(self, idx):
+		if idx < 0:
+			idx += self.count
+		value = self.values.get(idx, _NOT_COMPUTED)
+		if value is _NOT_COMPUTED:
+			if not 0 <= idx < self.count:
+				raise IndexError(idx)
+			value = self.values[idx] = self.compute(idx)
+		return value
 
+	def __setitem__(self, idx, value):
+		if idx < 0:
+			idx += self.count
+		if not 0 <= idx < self.count:
+			raise IndexError(idx)
+		self.values[idx] = value
 
-class Tile:
-	def __init__(self, path, name, isdir, menu, font, render_pool):
-		self.name = name
+	def __iter__(self):
+		return (self[idx] for idx in range(self.count))
+
+
+
+class LazyNameIndex:
+	"""name -> idx of a TileModel straight from a binary index. Single names
+	are looked up without decoding the others; the whole mapping is only
+	built for iterating it.
+	"""
+	def __init__(self, index):
+		self.binary = index
+		self.found = {}
+		self.mapping = None
+
+	def get(self, name, default=None):
+		if self.mapping is not None:
+			return self.mapping.get(name, default)
+		idx = self.found.get(name)
+		if idx is None:
+			idx = self.binary.find(name)
+			if idx is None:
+				return default
+			self.found[name] = idx
+		return idx
+
+	def __getitem__(self, name):
+		idx = self.get(name)
+		if idx is None:
+			raise KeyError(name)
+		return idx
+
+	def __contains__(self, name):
+		return self.get(name) is not None
+
+	def __len__(self):
+		return len(self.binary)
+
+	def all(self):
+		if self.mapping is None:
+			self.mapping = {name: idx for idx, name in enumerate(self.binary.names())}
+		return self.mapping
+
+	def __iter__(self):
+		return iter(self.all())
+
+	def keys(self):
+		return self.all().keys()
+
+	def items(self):
+		return self.all().items()
+
+
+
+class TileModel:
+	"""Metadata of all entries of a folder, as parallel arrays in index order.
+	Tile objects, which hold the text and cover renderables, are only created
+	for entries that are actually looked at; see tile().
+	"""
+	def __init__(self, path, font, render_pool, created=None):
 		self.path = path
-		self.full_path = os.path.join(path, name)
-		self.isdir = isdir
-		self.menu = menu
-		self.render_pool = render_pool
 		self.font = font
-		self.state_last_update = 0  # FIXME: is this still needed?
+		self.render_pool = render_pool
+		self.created = created  # Called with every newly created Tile
+
+		self.names = []
+		self.entries = []  # Index DB entries, as last applied
+		self.states = []  # State DB entries, as last applied
+		self.isdir = array('b')
+		self.colors = array('l')
+		self.durations = array('d')
+		self.positions = array('d')
+		self.tagged = array('b')
+
+		self.index = {}  # name -> idx
+		self.views = {}  # name -> Tile
+
+	@classmethod
+	def from_index(cls, path, index, state, font, render_pool, created=None):
+		"""Build the model for a whole folder at once, a column at a time."""
+		if isinstance(index, dbs.BinaryIndex):
+			return cls.from_binary_index(path, index, state, font, render_pool, created)
+
+		model = cls(path, font, render_pool, created)
+		model.entries = list(index)
+		model.names = [entry['name'] for entry in model.entries]
+		model.states = [state.get(name) for name in model.names]
+		model.isdir = array('b', [entry['isdir'] for entry in model.entries])
+		model.colors = array('l', [
+			parse_color(entry['tile_color']) if 'tile_color' in entry else UNKNOWN_COLOR
+			for entry in model.entries
+		])
+		model.durations = array('d', [
+			NO_DURATION if 'duration' not in entry else math.nan if entry['duration'] is None else entry['duration']
+			for entry in model.entries
+		])
+		model.positions = array('d', [
+			(s or e).get('position', e.get('position', 0))
+			for e, s in zip(model.entries, model.states)
+		])
+		model.tagged = array('b', [
+			(s or e).get('tagged', e.get('tagged', False))
+			for e, s in zip(model.entries, model.states)
+		])
+		model.index = {name: i for i, name in enumerate(model.names)}
+		return model
+
+	@classmethod
+	def from_binary_index(cls, path, index, state, font, render_pool, created=None):
+		"""Like from_index(), but lazily: an entry's name, metadata and state
+		are only decoded when something looks at it, usually its Tile.
+		"""
+		model = cls(path, font, render_pool, created)
+		count = len(index)
+
+		def color(idx):
+			offset, length, isdir, flags, color, *rest = index.record(idx)
+			return (NO_COLOR if color < 0 else color) if flags & dbs.INDEX_BIN_HAS_COLOR else UNKNOWN_COLOR
+
+		def duration(idx):
+			offset, length, isdir, flags, color, duration, *rest = index.record(idx)
+			return (math.nan if duration < 0 else duration) if flags & dbs.INDEX_BIN_HAS_DURATION else NO_DURATION
+
+		model.entries = index
+		model.names = LazyColumn(count, index.name)
+		model.states = LazyColumn(count, lambda idx: state.get(model.names[idx]))
+		model.isdir = LazyColumn(count, lambda idx: index.record(idx)[2])
+		model.colors = LazyColumn(count, color)
+		model.durations = LazyColumn(count, duration)
+		model.positions = LazyColumn(count, lambda idx: (model.states[idx] or {}).get('position', 0))
+		model.tagged = LazyColumn(count, lambda idx: (model.states[idx] or {}).get('tagged', False))
+		model.index = LazyNameIndex(index)
+		return model
+
+	def __len__(self):
+		return len(self.names)
+
+	def __getitem__(self, idx):
+		return self.tile(idx)
+
+	def tile(self, idx):
+		"""The Tile for entry idx, created on first use. Main thread only."""
+		name = self.names[idx]
+		tile = self.views.get(name)
+		if tile is None:
+			tile = self.views[name] = Tile(self, name, idx)
+			if self.created:
+				self.created(tile)
+		return tile
+
+	def apply_state(self, updates):
+		"""Lay {name: state} updates over the model, e.g. ones of our own that
+		Clerk has not merged into the state DB it was built from yet.
+		"""
+		for name, update in updates.items():
+			idx = self.index.get(name)
+			if idx is None:
+				continue
+			if 'position' in update:
+				self.positions[idx] = update['position']
+			if 'tagged' in update:
+				self.tagged[idx] = update['tagged']
+
+	def adopt(self, tile):
+		"""Take over a Tile of a previous model of the same folder."""
+		tile.model = self
+		tile.idx = self.index[tile.name]
+		self.views[tile.name] = tile
+		tile.update_meta()
+
+	def __str__(self):
+		return f'TileModel(path={self.path}, entries={len(self)}, views={len(self.views)})'
+
+	def __repr__(self):
+		return self.__str__()
+
 
-		log.debug(f'Created {self}')
 
-		# Metadata, will be populated later
-		self.tile_color = (0, 0, 0, 1)
-		self.duration = None
-		self.position = 0
-		self.tagged = False
+class Tile:
+	"""One entry of a TileModel, with its renderables."""
+	def __init__(self, model, name, idx):
+		self.model = model
+		self.name = name
+		self.idx = idx  # Into model; kept up to date by TileModel.adopt()
+		self.path = model.path
+		self.full_path = os.path.join(model.path, name)
+		self.isdir = bool(model.isdir[idx])
+		self.render_pool = model.render_pool
+		self.font = model.font
+		self.state_last_update = 0  # FIXME: is this still needed?
+
+		log.debug('Created %s', self)
 
 		# Renderables
 		self.title = self.font.text(None, max_width=config.tile.width, lines=config.tile.text_lines, pool=self.render_pool)
 		self.title.text = self.name if self.isdir else os.path.splitext(self.name)[0]
 		self.cover = None
 		self.info = None
+		self.update_meta()
 
-	def update_meta(self, meta):
-		log.debug(f'Update metadata for {self}')
-
-		if meta['name'] != self.name:
-			raise ValueError('{self}.update_meta({meta})')
-		if meta['isdir'] != self.isdir:
-			raise ValueError('{self}.update_meta({meta})')
-
-		# Tile color
-		if 'tile_color' in meta:
-			tile_color = meta.get('tile_color', None)
-			if tile_color is not None:
-				tile_color = tile_color.strip('#')
-				# FIXME: error checking
-				self.tile_color = tuple(int(tile_color[i:i+2], 16) / 255 for i in range(0, 6, 2)) + (1,)
-			else:
-				self.tile_color = (0.3, 0.3, 0.3, 1)
-
-		# Duration
-		if 'duration' in meta:
-			self.duration = meta.get('duration', None)
-			if not self.info:
-				self.info = self.font.text(None, max_width=None, lines=1, pool=self.render_pool)
-			if self.duration is None:
-				self.info.text = '?:??'
-			else:
-				duration = int(self.duration)
-				hours = duration // 3600
-				minutes = (duration % 3600) // 60
-				self.info.text = f'{hours}:{minutes:>02}'
-
-		if 'position' in meta:
-			self.position = meta['position']
-
-		if 'tagged' in meta:
-			self.tagged = meta['tagged']
-
-
-	def update_cover(self, covers_zip):
-		if not self.cover:
-			self.cover = Image(None, config.tile.width, config.tile.thumb_height, self.name, pool=self.render_pool)
-		try:
-			with covers_zip.open(self.name) as fd:
-				image = fd.read()
-				# The cover image can be empty (if no cover is known)
-				if image:
-					self.cover.source = image
-		except KeyError:
+	@property
+	def tile_color(self):
+		return unpack_color(self.model.colors[self.idx])
+
+	@property
+	def duration(self):
+		duration = self.model.durations[self.idx]
+		return None if duration < 0 or math.isnan(duration) else duration
+
+	@property
+	def position(self):
+		return self.model.positions[self.idx]
+	@position.setter
+	def position(self, position):
+		self.model.positions[self.idx] = position
+
+	@property
+	def tagged(self):
+		return bool(self.model.tagged[self.idx])
+	@tagged.setter
+	def tagged(self, tagged):
+		self.model.tagged[self.idx] = tagged
+
+	def update_meta(self):
+		"""Bring the renderables up to date with the model."""
+		duration = self.model.durations[self.idx]
+		if duration == NO_DURATION:
+			return
+		if not self.info:
+			self.info = self.font.label(None, pool=self.render_pool)
+		if math.isnan(duration):
+			self.info.text = '?:??'
+		else:
+			duration = int(duration)
+			hours = duration // 3600
+			minutes = (duration % 3600) // 60
+			self.info.text = f'{hours}:{minutes:>02}'
+
+
+	def update_cover(self, covers_zip, size=dbs.COVER_DEFAULT_SIZE):
+		"""Load the cover from the cover DB, in the variant of the given size
+		if there is one. Those are displayed (mipmapped) without resampling.
+		"""
+		cover = self.read_cover(covers_zip, self.name, size)
+		if cover is None:
 			log.warning(f'Loading thumbnail for {self.name}: Not found in zip')
+			return
+		self.set_cover(*cover, size)
+
+
+	@staticmethod
+	def read_cover(covers_zip, name, size=dbs.COVER_DEFAULT_SIZE):
+		"""Return (mode, width, height, data) of the best cover variant for name,
+		data being empty if no cover is known; None if name is not in the zip.
+		"""
+		candidates = []
+		# Prefer the compressed variant, if Clerk made one and the GPU can use it
+		if config.tile.compressed_covers and Uploader.s3tc:
+			candidates.append((size, 'bc1', 'BC1'))
+		candidates.append((size, 'jpeg', 'RGB'))
+		# Older cover DB; this one gets resampled
+		candidates.append((dbs.COVER_DEFAULT_SIZE, 'jpeg', 'RGB'))
+
+		for (width, height), fmt, mode in candidates:
+			try:
+				with covers_zip.open(dbs.cover_entry(name, (width, height), fmt)) as fd:
+					data = fd.read()
+			except KeyError:
+				continue
+			if mode == 'RGB':
+				width, height = size
+			return mode, width, height, data
+		return None
+
+
+	def set_cover(self, mode, width, height, data, size=dbs.COVER_DEFAULT_SIZE):
+		if not self.cover:
+			self.cover = Image(None, *size, self.name, pool=self.render_pool, mipmap=True)
+		# The cover image can be empty (if no cover is known)
+		if data:
+			self.cover.mode = mode
+			self.cover.width, self.cover.height = width, height
+			self.cover.source = data
 
 
 	@classmethod
@@ -165,11 +382,14 @@ class Tile:
 		gl.glDeleteTextures(textures)
 
 		for o in tobjs:
+			if getattr(o, 'job', None):
+				o.job.cancel()
+			Uploader.cancel(o)
 			o._texture = None
 
 
 	def update_pos(self, position, force=False):
-		log.debug(f'{self} update_pos({position}, {force})')
+		log.debug('%s update_pos(%s, %s)', self, position, force)
 		old_pos = self.position
 		self.position = position
 
@@ -183,8 +403,7 @@ class Tile:
 		if state is None:
 			state = {'position': self.position}
 		log.info(f'Writing state for {self.name}: {state}')
-		update_name = os.path.join(self.path, dbs.QUEUE_DIR_NAME, str(uuid.uuid4()))
-		dbs.json_write(update_name, {self.name: state})
+		StateJournal.update(self.path, self.name, state)
 
 
 	@property
@@ -217,16 +436,19 @@ class Tile:
 		self.write_state_update({'tagged': self.tagged})
 
 
+	@staticmethod
+	def draw_highlight(x, y):
+		"""Selection highlight around the tile at x, y; drawn by the menu, as it moves between tiles."""
+		blur = config.tile.highlight_blursize
+		x1, y1, x2, y2 = x - blur, y - config.tile.thumb_height - blur, x + config.tile.width + blur, y + blur
+		Decorations.highlight.quad((x1, y1, x2, y2), 201, color=config.tile.highlight_color)
+
+
 	def draw(self, x, y, selected=False):
 		# Drop shadow
-		x1, y1, x2, y2 = x - shadow_blursize, y - config.tile.thumb_height - shadow_blursize, x + config.tile.width + shadow_blursize, y + shadow_blursize
-		x1 += 8; x2 += 8; y1 -= 8; y2 -= 8
-		TexturedQuad((x1, y1, x2, y2), 200, get_shadow(), color=config.tile.shadow_color)
-
-		# Select
-		if selected:
-			x1, y1, x2, y2 = x - hl_blursize, y - config.tile.thumb_height - hl_blursize, x + config.tile.width + hl_blursize, y + hl_blursize
-			TexturedQuad((x1, y1, x2, y2), 201, get_hl(), color=config.tile.highlight_color)
+		blur, offset = config.tile.shadow_blursize, config.tile.shadow_offset
+		x1, y1, x2, y2 = x - blur, y - config.tile.thumb_height - blur, x + config.tile.width + blur, y + blur
+		Decorations.shadow.quad((x1 + offset, y1 - offset, x2 + offset, y2 - offset), 200, color=config.tile.shadow_color)
 
 		# Outline
 		x1, y1, x2, y2 = x - 2, y - config.tile.thumb_height - 2, x + config.tile.width + 2, y + 2
@@ -254,21 +476,21 @@ class Tile:
 			FlatQuad((x1 - 1, y1 - 1, x2 + 1, y2 + 1), 204, config.tile.shadow_color)
 			FlatQuad((x1, y1, x2, y2), 205, config.tile.pos_bar_color)
 
-		tagged_xpos = x + config.tile.width + ImgLib.Tagged.width // 2
+		tagged_xpos = x + config.tile.width + Decorations.Tagged.width // 2
 
 		# "Watching" emblem
 		if self.watching:
-			ImgLib.Watching.as_quad(x + config.tile.width - ImgLib.Watching.width // 2, y - ImgLib.Watching.height // 2, 204)
-			tagged_xpos = x + config.tile.width - ImgLib.Watching.width // 2
+			Decorations.Watching.as_quad(x + config.tile.width - Decorations.Watching.width // 2, y - Decorations.Watching.height // 2, 204)
+			tagged_xpos = x + config.tile.width - Decorations.Watching.width // 2
 
 		# "Unseen" emblem
 		if self.unseen:
-			ImgLib.Unseen.as_quad(x + config.tile.width - ImgLib.Unseen.width // 2, y - ImgLib.Unseen.height // 2, 204)
-			tagged_xpos = x + config.tile.width - ImgLib.Unseen.width // 2
+			Decorations.Unseen.as_quad(x + config.tile.width - Decorations.Unseen.width // 2, y - Decorations.Unseen.height // 2, 204)
+			tagged_xpos = x + config.tile.width - Decorations.Unseen.width // 2
 
 		# "Tagged" emblem
 		if self.tagged:
-			ImgLib.Tagged.as_quad(tagged_xpos - ImgLib.Tagged.width, y - ImgLib.Tagged.height // 2, 204)
+			Decorations.Tagged.as_quad(tagged_xpos - Decorations.Tagged.width, y - Decorations.Tagged.height // 2, 204)
 
 		# Title
 		if self.title:
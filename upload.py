@@ -0,0 +1,247 @@
+# Fabella - Simple, elegant video library and player.
+#
+# Copyright 2020-2021 Marcel Moreaux.
+# Licensed under GPL v2.0, or (at your option) any later version.
+# (SPDX GPL-2.0-or-later) See LICENSE file for details.
+
+# Texture uploads, spread out over frames.
+#
+# Render pool workers stage their pixels here instead of having the render
+# thread call glTexImage2D() whenever it first draws something. Where
+# GL_ARB_buffer_storage is available, workers copy the pixels straight into
+# a ring of persistently mapped pixel buffer objects, so the render thread
+# only has to issue a glTexSubImage2D() from the PBO. Each frame, process()
+# uploads staged pixels until the time or byte budget is used up; whatever
+# is left waits for the next frame.
+
+import time
+import ctypes
+import threading
+import collections
+import OpenGL.GL as gl
+import OpenGL.extensions
+
+import config
+import redraw
+import loghelper
+
+log = loghelper.get_logger('Upload', loghelper.Color.BrightBlack)
+
+
+
+class Staged:
+	def __init__(self, target, pixels, width, height, internal, fmt=None, mipmaps=None, generation=0):
+		self.target = target
+		self.generation = generation
+		self.pixels = pixels
+		self.width = width
+		self.height = height
+		self.internal = internal
+		self.format = fmt
+		self.mipmaps = mipmaps
+		self.size = len(pixels)
+		self.slot = None
+
+	def __str__(self):
+		return f'Staged({self.target}, {self.width}x{self.height}, slot={self.slot})'
+
+	def __repr__(self):
+		return self.__str__()
+
+
+
+class Uploader:
+	staged = collections.OrderedDict()
+	lock = threading.Lock()
+
+	# PBO ring; set up by initialize() on the render thread
+	initialized = False
+	s3tc = False
+	pbo = None
+	pointer = None
+	free_slots = []
+	fences = []
+
+	@staticmethod
+	def generation(target):
+		"""target's current generation; cancel() starts a new one."""
+		return getattr(target, '_upload_generation', 0)
+
+	@classmethod
+	def stage(cls, target, pixels, width, height, internal, fmt=None, mipmaps=None, generation=None):
+		"""Queue pixels for upload into target._texture. Thread-safe.
+		target gets its width and height updated through target.uploaded()
+		once the texture holds the new pixels. A newer stage() for the same
+		target replaces one that wasn't uploaded yet.
+		Without fmt, pixels are already compressed in the internal format.
+		mipmaps is True to have the GPU generate them, or a list of
+		precomputed (width, height, pixels) levels below this one.
+		Renders pass the generation() of target from when they started, so
+		pixels of a render that outlived a cancel() are dropped.
+		"""
+		if generation is None:
+			generation = cls.generation(target)
+		staged = Staged(target, pixels, width, height, internal, fmt, mipmaps, generation)
+
+		with cls.lock:
+			if generation != cls.generation(target):
+				log.debug('Dropping upload for cancelled %s', target)
+				return
+			if cls.free_slots and staged.size <= config.upload.pbo_slot_size:
+				staged.slot = cls.free_slots.pop()
+
+		if staged.slot is not None:
+			ctypes.memmove(cls.pointer + staged.slot * config.upload.pbo_slot_size, pixels, staged.size)
+			staged.pixels = None
+
+		with cls.lock:
+			if generation != cls.generation(target):
+				# Cancelled while we were copying
+				log.debug('Dropping upload for cancelled %s', target)
+				if staged.slot is not None:
+					cls.free_slots.append(staged.slot)
+				return
+			old = cls.staged.pop(target, None)
+			if old and old.slot is not None:
+				cls.free_slots.append(old.slot)
+			cls.staged[target] = staged
+		redraw.request('upload staged')
+
+	@classmethod
+	def cancel(cls, target):
+		"""Drop a pending upload, e.g. because target's texture is being released.
+		Also drops any stage() still to come from a render that started before.
+		"""
+		with cls.lock:
+			target._upload_generation = cls.generation(target) + 1
+			old = cls.staged.pop(target, None)
+			if old and old.slot is not None:
+				cls.free_slots.append(old.slot)
+
+	@classmethod
+	def initialize(cls):
+		"""Set up the PBO ring and check texture format support.
+		Needs a current GL context; done by the first process() otherwise.
+		"""
+		cls.initialized = True
+		cls.s3tc = OpenGL.extensions.hasGLExtension('GL_EXT_texture_compression_s3tc')
+		log.info(f'S3TC texture compression supported: {cls.s3tc}')
+
+		if not config.upload.pbo_slots:
+			log.info('PBO uploads disabled')
+			return
+		if not bool(gl.glBufferStorage) or not bool(gl.glFenceSync):
+			log.warning('No GL_ARB_buffer_storage; uploading from client memory')
+			return
+
+		size = config.upload.pbo_slots * config.upload.pbo_slot_size
+		log.info(f'Creating {config.upload.pbo_slots} PBO upload slots, {size // 1024} KiB')
+		flags = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_PERSISTENT_BIT | gl.GL_MAP_COHERENT_BIT
+		cls.pbo = gl.glGenBuffers(1)
+		gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, cls.pbo)
+		gl.glBufferStorage(gl.GL_PIXEL_UNPACK_BUFFER, size, None, flags)
+		pointer = gl.glMapBufferRange(gl.GL_PIXEL_UNPACK_BUFFER, 0, size, flags)
+		gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+		cls.pointer = ctypes.cast(pointer, ctypes.c_void_p).value
+
+		with cls.lock:
+			cls.free_slots = list(range(config.upload.pbo_slots))
+
+	@classmethod
+	def reclaim(cls):
+		"""Return PBO slots the GPU is done reading from to the free list."""
+		busy = []
+		for fence, slot in cls.fences:
+			status = gl.glClientWaitSync(fence, 0, 0)
+			if status in (gl.GL_ALREADY_SIGNALED, gl.GL_CONDITION_SATISFIED):
+				gl.glDeleteSync(fence)
+				with cls.lock:
+					cls.free_slots.append(slot)
+			else:
+				busy.append((fence, slot))
+		cls.fences = busy
+
+	@classmethod
+	def process(cls):
+		"""Upload staged pixels, within this frame's budget. Render thread only."""
+		if not cls.initialized:
+			cls.initialize()
+		if cls.fences:
+			cls.reclaim()
+		if not cls.staged:
+			return
+
+		start = time.perf_counter()
+		deadline = start + config.upload.budget_ms / 1000
+		budget = config.upload.budget_bytes
+		count = 0
+
+		gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+		while budget > 0 and time.perf_counter() < deadline:
+			with cls.lock:
+				if not cls.staged:
+					break
+				target, staged = cls.staged.popitem(last=False)
+				if staged.generation != cls.generation(target):
+					if staged.slot is not None:
+						cls.free_slots.append(staged.slot)
+					continue
+			cls.upload(staged)
+			budget -= staged.size
+			count += 1
+		gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+
+		log.debug('Uploaded %d textures in %dms, %d left', count, (time.perf_counter() - start) * 1000, len(cls.staged))
+		if cls.staged:
+			redraw.request('uploads left')
+
+	@classmethod
+	def upload(cls, staged):
+		target = staged.target
+		levels = staged.mipmaps if isinstance(staged.mipmaps, list) else []
+		shape = (staged.width, staged.height, staged.internal, bool(staged.mipmaps), len(levels))
+		if target._texture is None:
+			target._texture = gl.glGenTextures(1)
+			target._texture_shape = None
+
+		gl.glBindTexture(gl.GL_TEXTURE_2D, target._texture)
+		if target._texture_shape != shape:
+			gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+			if staged.mipmaps:
+				gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR_MIPMAP_LINEAR)
+			else:
+				gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+			if levels:
+				gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAX_LEVEL, len(levels))
+			# (Re)allocate storage; the pixels go in with glTexSubImage2D() like always.
+			# Compressed storage is allocated by uploading it whole, below.
+			if staged.format is not None:
+				gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, staged.internal, staged.width, staged.height, 0, staged.format, gl.GL_UNSIGNED_BYTE, None)
+			target._texture_shape = shape
+
+		if staged.slot is None:
+			data = staged.pixels
+		else:
+			gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, cls.pbo)
+			data = ctypes.c_void_p(staged.slot * config.upload.pbo_slot_size)
+
+		if staged.format is None:
+			gl.glCompressedTexImage2D(gl.GL_TEXTURE_2D, 0, staged.internal, staged.width, staged.height, 0, staged.size, data)
+		else:
+			gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, staged.width, staged.height, staged.format, gl.GL_UNSIGNED_BYTE, data)
+
+		if staged.slot is not None:
+			gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+			cls.fences.append((gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0), staged.slot))
+
+		# Precomputed mip levels are small; they come from client memory
+		for level, (width, height, pixels) in enumerate(levels, 1):
+			if staged.format is None:
+				gl.glCompressedTexImage2D(gl.GL_TEXTURE_2D, level, staged.internal, width, height, 0, len(pixels), pixels)
+			else:
+				gl.glTexImage2D(gl.GL_TEXTURE_2D, level, staged.internal, width, height, 0, staged.format, gl.GL_UNSIGNED_BYTE, pixels)
+		if staged.mipmaps is True:
+			gl.glGenerateMipmap(gl.GL_TEXTURE_2D)
+		gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+
+		target.uploaded(staged.width, staged.height)
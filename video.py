@@ -8,14 +8,15 @@
 
 # https://github.com/mpv-player/mpv/blob/master/libmpv/render_gl.h#L91
 
-import glfw  # FIXME: abstract out
 import ctypes
 import time
 import mpv
 import OpenGL.GL as gl
 
 import loghelper
+import redraw
 from draw import Quad, FlatQuad, ShadedQuad, TexturedQuad
+from journal import StateJournal
 
 log = loghelper.get_logger('Video', loghelper.Color.Yellow)
 
@@ -32,9 +33,12 @@ class Video:
 	position = 0
 	position_immune_until = 0
 	rendered = False
+	direct = False
+	fbo_valid = False
+	update_pending = False
 	tile = None
 
-	def __init__(self):
+	def __init__(self, window):
 		log.debug('Created instance')
 
 		mpv_logger = loghelper.get_logger('libmpv', loghelper.Color.Green)
@@ -68,9 +72,11 @@ class Video:
 		self.context = mpv.MpvRenderContext(
 			self.mpv,
 			'opengl',
-			wl_display=ctypes.c_void_p(glfw.get_wayland_display()),
-			opengl_init_params={'get_proc_address': mpv.OpenGlCbGetProcAddrFn(lambda _, name: glfw.get_proc_address(name.decode('utf8')))},
+			wl_display=ctypes.c_void_p(window.wayland_display()),
+			opengl_init_params={'get_proc_address': mpv.OpenGlCbGetProcAddrFn(lambda _, name: window.get_proc_address(name.decode('utf8')))},
 		)
+		# New video frames wake up the main loop
+		self.context.update_cb = self.on_update
 		self.mpv.observe_property('width', self.size_changed)
 		self.mpv.observe_property('height', self.size_changed)
 		self.mpv.observe_property('percent-pos', self.position_changed)
@@ -109,6 +115,11 @@ class Video:
 			time.sleep(0.5)
 			self.menu.open()
 
+	def on_update(self):
+		"""Called by libmpv, from its own thread, when render() has something to do."""
+		self.update_pending = True
+		redraw.request('video frame')
+
 	def size_changed(self, prop, value):
 		log.info(f'Video {prop} is {value}')
 
@@ -153,17 +164,14 @@ class Video:
 		self.menu = menu
 
 		self.position_immune_until = time.time() + 1
+		# Let libmpv seek by itself once the file is loaded
+		if self.position > 0:
+			log.info(f'Starting at position {self.position}')
+			self.mpv['start'] = f'{self.position * 100:.4f}%'
+		else:
+			self.mpv['start'] = 'none'
 		self.mpv.play(filename)
 		self.pause(False)
-		if self.position > 0:
-			log.info(f'Seeking to position {position}')
-			# FIXME
-			# Updating the position only works after libmpv has had
-			# a chance to initialize the video; so we spin here until
-			# libmpv is ready.
-			while not self.context.update():
-				time.sleep(0.01)
-			self.mpv.percent_pos = position * 100
 
 	def stop(self):
 		log.info(f'Stopping playback for {self.current_file}')
@@ -173,11 +181,13 @@ class Video:
 
 		if self.tile:
 			self.tile.update_pos(self.position, force=True)
+			StateJournal.flush_soon()
 
 		self.current_file = None
 		# Hmm, maybe not do this? Is the memory valid after stop though?
 		self.should_render = False
 		self.rendered = False
+		self.fbo_valid = False
 		self.tile = None
 
 	def seek(self, amount, whence='relative'):
@@ -189,23 +199,52 @@ class Video:
 			log.warning('Seek error')
 			print(e)
 
-	def render(self, width, height):
-		force_render = False
+	def render(self, width, height, direct=False):
+		"""Render the current video frame.
+		With direct, it is rendered straight to the default framebuffer, which
+		saves a copy when nothing but the small overlays is drawn on top.
+		Otherwise it goes into our FBO, so the menu can be redrawn over it
+		without re-rendering the video.
+		Returns True if the default framebuffer now holds the video.
+		"""
+		self.direct = False
+		new_frame = False
+		if self.update_pending:
+			self.update_pending = False
+			new_frame = self.context.update()
+
+		if not self.should_render:
+			return False
+
+		if direct:
+			log.debug('Rendering frame to default framebuffer')
+			# FIXME: apparently, we shouldn't call other mpv functions from the same
+			# thread as render(). Find a way to fix that.
+			self.context.render(flip_y=True, opengl_fbo={'w': width, 'h': height, 'fbo': 0})
+			self.fbo_valid = False
+			self.direct = True
+			self.rendered = True
+			return True
+
 		if self.video_size != (width, height):
 			log.info(f'Resizing video texture from {self.video_size} to {(width, height)}')
 			gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
 			gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, width, height, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, None)
 			gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
 			self.video_size = (width, height)
-			self.rendered = False
-			force_render = True
+			self.fbo_valid = False
 
-		if self.should_render and (self.context.update() or force_render):
-			log.debug('Rendering frame')
-			# FIXME: apparently, we shouldn't call other mpv functions from the same
-			# thread as render(). Find a way to fix that.
-			ret = self.context.render(flip_y=False, opengl_fbo={'w': width, 'h': height, 'fbo': self.fbo})
+		if new_frame or not self.fbo_valid:
+			log.debug('Rendering frame to FBO')
+			self.context.render(flip_y=False, opengl_fbo={'w': width, 'h': height, 'fbo': self.fbo})
+			self.fbo_valid = True
 			self.rendered = True
+		return False
+
+	def report_swap(self):
+		"""Tell libmpv a frame was presented, for its frame timing."""
+		if self.should_render and self.rendered:
+			self.context.report_swap()
 
 	def draw(self, window_width, window_height):
 		if not self.rendered:
@@ -213,10 +252,9 @@ class Video:
 			return
 
 		#log.debug('Drawing frame')
-		video_width, video_height = self.video_size
-
-		# Draw video
-		TexturedQuad((0, 0, window_width, window_height), 0, self.texture)
+		# Draw video, unless render() put it in the framebuffer already
+		if not self.direct:
+			TexturedQuad((0, 0, window_width, window_height), 0, self.texture)
 
 		# Draw position bar + shadow
 		position_bar_height = 3
@@ -5,19 +5,81 @@
 # (SPDX GPL-2.0-or-later) See LICENSE file for details.
 
 import glfw
+import ctypes
+import collections
+import OpenGL.GL as gl
 
+import config
 import loghelper
+import redraw
+from replay import Recorder, Replayer
+from profiler import Profiler
 
 log = loghelper.get_logger('Window', loghelper.Color.Blue)
 
 
 
-class Window:
+class BaseWindow:
+	"""Key event handling shared by the windows: the queue of pressed keys,
+	recording them, and replaying a recording.
+	"""
+	def __init__(self):
+		self.events = collections.deque()
+		self.recorder = None
+		self.replayer = None
+
+	def record(self, filename):
+		self.recorder = Recorder(filename)
+
+	def replay(self, filename, speed=1.0):
+		self.replayer = Replayer(filename, speed)
+
+	def pressed(self, event, late=0.0):
+		"""Queue event; late is how long ago it should have happened."""
+		self.events.append(event)
+		if self.recorder:
+			self.recorder.record(event)
+		# Releases and repeats don't start a latency measurement; presses do
+		if event[2] == glfw.PRESS:
+			Profiler.pressed(late)
+		redraw.request('keypress')
+
+	def replay_timeout(self, timeout):
+		"""timeout, shortened to when the next replayed event is due."""
+		due = self.replayer.timeout() if self.replayer else None
+		if due is None:
+			return timeout
+		return due if timeout is None else min(timeout, due)
+
+	def get_events(self, coalesce=()):
+		"""Yield (key, scancode, action, modifiers, count) for the queued events.
+		Consecutive presses and repeats of a key in coalesce come out as one
+		press with their count, so holding it down can't make us fall behind.
+		"""
+		if self.replayer:
+			for event, late in self.replayer.due():
+				self.pressed(event, late)
+		events = self.events
+		while events:
+			key, scancode, action, modifiers = events.popleft()
+			count = 1
+			if key in coalesce and action in (glfw.PRESS, glfw.REPEAT):
+				action = glfw.PRESS
+				while events and events[0][0] == key and events[0][3] == modifiers and events[0][2] in (glfw.PRESS, glfw.REPEAT):
+					events.popleft()
+					count += 1
+			if count > 1:
+				log.debug('Coalesced %d presses of key %d', count, key)
+			yield key, scancode, action, modifiers, count
+
+
+
+class Window(BaseWindow):
 	window = None
 	fullscreen = False
-	events = []
 
 	def __init__(self, width, height, title):
+		super().__init__()
 		log.info(f'Created instance of {width}x{height}: "{title}"')
 		if not glfw.init():
 			log.critical('glfw.init() failed')
@@ -34,6 +96,9 @@ class Window:
 			raise 'glfw.create_window()'
 		glfw.make_context_current(self.window)
 		glfw.set_key_callback(self.window, self.on_keypress)
+		glfw.set_framebuffer_size_callback(self.window, self.on_resize)
+		glfw.set_window_refresh_callback(self.window, lambda window: redraw.request('refresh'))
+		redraw.wakeup = glfw.post_empty_event
 		#glfw.set_window_user_pointer(window, 5)
 		#print(glfw.get_window_user_pointer(window))
 		log.debug('Hiding mouse cursor')
@@ -44,6 +109,9 @@ class Window:
 		glfw.destroy_window(self.window)
 		glfw.terminate()
 
+	def on_resize(self, window, width, height):
+		redraw.request('resize')
+
 	def set_fullscreen(self, fullscreen=None):
 		if fullscreen is None:
 			self.fullscreen = not self.fullscreen
@@ -58,8 +126,8 @@ class Window:
 			glfw.set_window_monitor(self.window, None, 0, 0, *self.size(), glfw.DONT_CARE)
 
 	def on_keypress(self, window, key, scancode, action, modifiers):
-		log.info(f'Keypress key={key}, scancode={scancode}, action={action}, modifiers={modifiers}')
-		self.events.append((key, scancode, action, modifiers))
+		log.info('Keypress key=%s, scancode=%s, action=%s, modifiers=%s', key, scancode, action, modifiers)
+		self.pressed((key, scancode, action, modifiers))
 
 	def closed(self):
 		return glfw.window_should_close(self.window)
@@ -67,17 +135,149 @@ class Window:
 	def size(self):
 		return glfw.get_window_size(self.window)
 
-	def wait(self):
+	def wait(self, timeout=None):
+		"""Wait for events, or until timeout seconds passed.
+		Other threads can wake us up through redraw.request().
+		"""
 		#log.debug('glfw.wait_events()')
-		glfw.wait_events()
+		timeout = self.replay_timeout(timeout)
+		if timeout is None:
+			glfw.wait_events()
+		elif timeout > 0:
+			glfw.wait_events_timeout(timeout)
+		else:
+			glfw.poll_events()
 
 	def swap_buffers(self):
 		#log.debug('glfw.swap_buffers()')
 		glfw.swap_buffers(self.window)
 
-	def get_events(self):
-		while True:
+	def get_proc_address(self, name):
+		return glfw.get_proc_address(name)
+
+	def wayland_display(self):
+		return glfw.get_wayland_display()
+
+
+
+def parse_script(text):
+	"""Turn a script like 'RIGHT*5 DOWN SHIFT+TAB ENTER' into a list of
+	(key, modifiers). Keys are glfw.KEY_* names; # starts a comment.
+	"""
+	modifier_names = {'SHIFT': glfw.MOD_SHIFT, 'CTRL': glfw.MOD_CONTROL, 'ALT': glfw.MOD_ALT}
+	steps = []
+	for line in text.splitlines():
+		for word in line.split('#')[0].split():
+			word, _, count = word.upper().partition('*')
+			*modifiers, name = word.split('+')
 			try:
-				yield self.events.pop(0)
-			except IndexError:
-				return
+				key = getattr(glfw, 'KEY_' + name)
+				modifiers = sum(modifier_names[m] for m in modifiers)
+			except (AttributeError, KeyError):
+				raise ValueError(f'Unknown key in script: {word}')
+			steps.extend([(key, modifiers)] * int(count or 1))
+	return steps
+
+
+
+class HeadlessWindow(BaseWindow):
+	"""Stands in for Window where there is no display: renders into an EGL
+	pbuffer (with Mesa, EGL_PLATFORM=surfaceless needs no GPU either) and
+	presses the keys of a replay or a script instead of waiting for a keyboard.
+	Every scripted key waits until the previous one has settled: no redraws
+	for config.headless.settle seconds. Closes when both are done.
+	PYOPENGL_PLATFORM must be 'egl' before OpenGL is first imported.
+	"""
+	fullscreen = False
+
+	def __init__(self, width, height, title, script=''):
+		import OpenGL.EGL as egl
+		from OpenGL import arrays
+		super().__init__()
+		log.info(f'Created headless instance of {width}x{height}: "{title}"')
+		self.egl = egl
+		self.width, self.height = width, height
+		self.script = parse_script(script)
+		self.done = False
+
+		self.display = egl.eglGetDisplay(egl.EGL_DEFAULT_DISPLAY)
+		major, minor = ctypes.c_long(), ctypes.c_long()
+		if not egl.eglInitialize(self.display, major, minor):
+			log.critical('eglInitialize() failed')
+			raise RuntimeError('eglInitialize()')
+		log.info(f'EGL {major.value}.{minor.value}')
+
+		attributes = arrays.GLintArray.asArray([
+			egl.EGL_SURFACE_TYPE, egl.EGL_PBUFFER_BIT,
+			egl.EGL_RED_SIZE, 8,
+			egl.EGL_GREEN_SIZE, 8,
+			egl.EGL_BLUE_SIZE, 8,
+			egl.EGL_RENDERABLE_TYPE, egl.EGL_OPENGL_BIT,
+			egl.EGL_NONE,
+		])
+		configs = (egl.EGLConfig * 1)()
+		count = ctypes.c_long()
+		if not egl.eglChooseConfig(self.display, attributes, configs, 1, count) or not count.value:
+			log.critical('eglChooseConfig() found no pbuffer config')
+			raise RuntimeError('eglChooseConfig()')
+		egl.eglBindAPI(egl.EGL_OPENGL_API)
+
+		surface_attributes = arrays.GLintArray.asArray([egl.EGL_WIDTH, width, egl.EGL_HEIGHT, height, egl.EGL_NONE])
+		self.surface = egl.eglCreatePbufferSurface(self.display, configs[0], surface_attributes)
+		self.context = egl.eglCreateContext(self.display, configs[0], egl.EGL_NO_CONTEXT, None)
+		if self.context == egl.EGL_NO_CONTEXT:
+			log.critical('eglCreateContext() failed')
+			raise RuntimeError('eglCreateContext()')
+		egl.eglMakeCurrent(self.display, self.surface, self.surface, self.context)
+
+	def terminate(self):
+		log.info('Terminating')
+		self.egl.eglMakeCurrent(self.display, self.egl.EGL_NO_SURFACE, self.egl.EGL_NO_SURFACE, self.egl.EGL_NO_CONTEXT)
+		self.egl.eglDestroyContext(self.display, self.context)
+		self.egl.eglDestroySurface(self.display, self.surface)
+		self.egl.eglTerminate(self.display)
+
+	def set_fullscreen(self, fullscreen=None):
+		pass
+
+	def closed(self):
+		return self.done
+
+	def size(self):
+		return self.width, self.height
+
+	def wait(self, timeout=None):
+		"""Wait for the next key of the replay; after that, press the next key
+		of the script once nothing was redrawn for a while.
+		"""
+		if self.events or redraw.pending():
+			return
+		if self.replayer and not self.replayer.done:
+			# get_events() picks the key up
+			redraw.requested.wait(self.replay_timeout(timeout))
+			return
+
+		settle = config.headless.settle
+		if timeout is not None:
+			settle = min(settle, timeout)
+		if redraw.requested.wait(settle) or settle < config.headless.settle:
+			return
+
+		if not self.script:
+			log.info('Replay and script done')
+			self.done = True
+			return
+		key, modifiers = self.script.pop(0)
+		log.info('Scripted key=%s, modifiers=%s', key, modifiers)
+		self.pressed((key, 0, glfw.PRESS, modifiers))
+
+	def swap_buffers(self):
+		# Nothing to show; but do wait for the GPU, so frame times include its work
+		gl.glFinish()
+
+	def get_proc_address(self, name):
+		address = self.egl.eglGetProcAddress(name.encode('utf8'))
+		return ctypes.cast(address, ctypes.c_void_p).value
+
+	def wayland_display(self):
+		return None
@@ -4,7 +4,13 @@
 # Licensed under GPL v2.0, or (at your option) any later version.
 # (SPDX GPL-2.0-or-later) See LICENSE file for details.
 
+import os
+import json
+import time
 import queue
+import socket
+import functools
+import itertools
 import threading
 import traceback
 
@@ -14,28 +20,157 @@ log = loghelper.get_logger('Worker', loghelper.Color.BrightMagenta)
 
 
 
+# Lower runs first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+
+class Histogram:
+	"""Counts of durations in power-of-two buckets, from 1us up."""
+	buckets = 32
+
+	def __init__(self):
+		self.counts = [0] * self.buckets
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		us = int(seconds * 1000000)
+		self.counts[min(us.bit_length(), self.buckets - 1)] += 1
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+
+	def percentile(self, p):
+		"""Upper bound of the bucket holding the p-th percentile, in seconds."""
+		if not self.count:
+			return 0.0
+		threshold = self.count * p / 100
+		seen = 0
+		for bucket, count in enumerate(self.counts):
+			seen += count
+			if seen >= threshold:
+				return min((1 << bucket) / 1000000, self.max)
+		return self.max
+
+	def summary(self):
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else 0.0,
+			'p50': self.percentile(50),
+			'p95': self.percentile(95),
+			'p99': self.percentile(99),
+			'max': self.max,
+		}
+
+
+
+class PoolStats:
+	"""Per job type: enqueue-to-start latency, run time and failures; plus
+	queue depth and busy time of the pool as a whole.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.jobs = {}  # {job type: {'latency': Histogram, 'run': Histogram, 'failures': int, 'dropped': int}}
+		self.max_depth = 0
+		self.busy = 0.0
+		self.since = time.monotonic()
+
+	def job_type(self, job_type):
+		stats = self.jobs.get(job_type)
+		if stats is None:
+			stats = self.jobs[job_type] = {'latency': Histogram(), 'run': Histogram(), 'failures': 0, 'dropped': 0}
+		return stats
+
+	def scheduled(self, depth):
+		if depth > self.max_depth:
+			self.max_depth = depth
+
+	def dropped(self, job):
+		with self.lock:
+			self.job_type(job.type)['dropped'] += 1
+
+	def ran(self, job, started, finished, failed):
+		with self.lock:
+			stats = self.job_type(job.type)
+			stats['latency'].add(started - job.enqueued)
+			stats['run'].add(finished - started)
+			if failed:
+				stats['failures'] += 1
+			self.busy += finished - started
+
+
+
+class Job:
+	"""Handle of a scheduled job."""
+	def __init__(self, fn, priority, generation):
+		self.fn = fn
+		self.priority = priority
+		self.generation = generation
+		self.cancelled = False
+		self.started = False
+		self.enqueued = time.monotonic()
+
+	@property
+	def type(self):
+		"""What kind of job this is, for the stats: the name of the function."""
+		fn = self.fn
+		while isinstance(fn, functools.partial):
+			fn = fn.func
+		return getattr(fn, '__qualname__', type(fn).__name__)
+
+	def cancel(self):
+		"""Don't run the job, if it hasn't started yet. Returns whether it had not."""
+		self.cancelled = True
+		return not self.started
+
+	def __str__(self):
+		return f'Job({self.fn}, priority={self.priority})'
+
+	def __repr__(self):
+		return self.__str__()
+
+
+
 class Pool:
-	def __init__(self, name, *, threads=1):
+	pools = []  # All pools, for the stats
+
+	def __init__(self, name, *, threads=1, maxsize=0):
 		log.info(f'Creating pool {name} of {threads} worker threads')
 		self.name = name
-		self.queue = queue.Queue()
+		self.queue = queue.PriorityQueue(maxsize)
+		self.sequence = itertools.count()
+		self.generation = 0
+		self.stats = PoolStats()
 		self.workers = [Worker(self) for i in range(threads)]
+		self.pools.append(self)
 
-	def schedule(self, job):
-		"""Schedule a job for execution, FIFO-style.
-		Job must be a runnable function.
+	def schedule(self, job, priority=PRIORITY_NORMAL, block=True):
+		"""Schedule a job for execution; by priority, then FIFO.
+		Job must be a runnable function. Returns a Job handle.
+		If the queue is bounded and full, blocks until there is room, or
+		raises queue.Full if not block.
 		"""
-		log.debug(f'Scheduling job {job} on pool {self.name}')
-		self.queue.put(job)
+		log.debug('Scheduling job %s on pool %s', job, self.name)
+		handle = Job(job, priority, self.generation)
+		self.queue.put((priority, next(self.sequence), handle), block=block)
+		self.stats.scheduled(self.queue.qsize())
+		return handle
 
 	def flush(self):
 		"""Clear the job queue, aborting any jobs that haven't been run yet.
 		Jobs that already started processing will still be completed.
 		"""
 		log.info(f'Flushing pool {self.name}')
+		# Anything a worker already took off the queue, but hasn't started, is dropped too
+		self.generation += 1
 		try:
 			while True:
 				self.queue.get_nowait()
+				self.queue.task_done()
 		except queue.Empty:
 			pass
 
@@ -43,6 +178,31 @@ class Pool:
 		"""Blocks until all jobs have finished processing."""
 		self.queue.join()
 
+	def snapshot(self):
+		"""The stats of this pool, as plain data."""
+		stats = self.stats
+		with stats.lock:
+			elapsed = time.monotonic() - stats.since
+			return {
+				'threads': len(self.workers),
+				'depth': self.queue.qsize(),
+				'max_depth': stats.max_depth,
+				'utilization': stats.busy / elapsed / len(self.workers) if elapsed else 0.0,
+				'jobs': {
+					job_type: {
+						'latency': s['latency'].summary(),
+						'run': s['run'].summary(),
+						'failures': s['failures'],
+						'dropped': s['dropped'],
+					}
+					for job_type, s in stats.jobs.items()
+				},
+			}
+
+	@classmethod
+	def snapshot_all(cls):
+		return {pool.name: pool.snapshot() for pool in cls.pools}
+
 	def __str__(self):
 		return f'Pool({self.name}, workers={len(self.workers)})'
 
@@ -60,14 +220,24 @@ class Worker:
 	def run(self):
 		log.info(f'Thread {self.thread.name} running for pool {self.pool.name}')
 		while True:
-			job = self.queue.get()
+			priority, sequence, job = self.queue.get()
+			if job.cancelled or job.generation != self.pool.generation:
+				log.debug('Dropping %s on pool %s', job, self.pool.name)
+				self.pool.stats.dropped(job)
+				self.queue.task_done()
+				continue
 
+			job.started = True
+			failed = False
+			started = time.monotonic()
 			try:
-				job()
+				job.fn()
 			except Exception:
+				failed = True
 				log.error(f'Unhandled exception on thread {self.pool.name} while executing job {job}')
 				for line in traceback.format_exc().splitlines():
 					log.error(line)
+			self.pool.stats.ran(job, started, time.monotonic(), failed)
 
 			self.queue.task_done()
 
@@ -76,3 +246,53 @@ class Worker:
 
 	def __repr__(self):
 		return self.__str__()
+
+
+
+def format_stats(snapshot):
+	"""Human-readable lines for Pool.snapshot_all()."""
+	ms = lambda seconds: f'{seconds * 1000:.1f}ms'
+	lines = []
+	for name, pool in snapshot.items():
+		lines.append(f'Pool {name}: depth {pool["depth"]} (max {pool["max_depth"]}), {pool["utilization"] * 100:.0f}% busy over {pool["threads"]} threads')
+		for job_type, job in sorted(pool['jobs'].items()):
+			latency, run = job['latency'], job['run']
+			lines.append(
+				f'  {job_type}: {run["count"]} ran, {job["failures"]} failed, {job["dropped"]} dropped;'
+				f' wait p50 {ms(latency["p50"])} p99 {ms(latency["p99"])};'
+				f' run p50 {ms(run["p50"])} p99 {ms(run["p99"])} max {ms(run["max"])}'
+			)
+	return lines
+
+
+
+def start_reporter(interval=60, socket_path=None):
+	"""Log the stats of all pools every interval seconds (if interval), and
+	serve them as JSON to anyone connecting to socket_path (if given).
+	"""
+	if interval:
+		def report():
+			while True:
+				time.sleep(interval)
+				for line in format_stats(Pool.snapshot_all()):
+					log.info(line)
+		threading.Thread(target=report, name='pool stats', daemon=True).start()
+
+	if socket_path:
+		try:
+			os.unlink(socket_path)
+		except FileNotFoundError:
+			pass
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(socket_path)
+		server.listen(1)
+		def serve():
+			while True:
+				connection, address = server.accept()
+				with connection:
+					try:
+						connection.sendall(json.dumps(Pool.snapshot_all(), indent=4).encode('utf8') + b'\n')
+					except OSError as e:
+						log.warning(f'Serving pool stats: {e}')
+		threading.Thread(target=serve, name='pool stats server', daemon=True).start()
+		log.info(f'Serving pool stats on {socket_path}')